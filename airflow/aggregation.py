@@ -0,0 +1,368 @@
+"""
+Partition-scoped, idempotent refresh of the aggregate tables.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import date
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+from clickhouse_driver import Client
+
+import metrics
+from utilities import get_logger
+
+LOGGER = get_logger("aggregation")
+
+# Date keys are days since 1970-01-01, i.e. toUInt32(toDate(...)) in ClickHouse.
+DATE_KEY_EPOCH = date(1970, 1, 1)
+
+
+# Source-side expression mapping a date key to the key of its period.
+PERIOD_EXPRESSIONS = {
+    "day": "{column}",
+    "week": "toUInt32(toMonday(toDate({column})))",
+    "month": "toUInt32(toStartOfMonth(toDate({column})))",
+}
+
+_STORE_REGION_JOIN = """
+    INNER JOIN (SELECT StoreKey, Region, Territory FROM DimStore FINAL) AS store
+        ON state.StoreKey = store.StoreKey
+    LEFT JOIN DimRegion ON store.Region = DimRegion.RegionName
+"""
+
+
+@dataclass(frozen=True)
+class AggregateSpec:
+    """
+    One aggregate table rebuilt from a fact table or a finer aggregate.
+
+    ``select_sql`` must produce the target's columns in order and contain a
+    ``{where}`` placeholder restricting the source rows. ``period`` is the
+    target grain (``day``, ``week`` or ``month``) and ``date_column`` the
+    target's period key column; the target must be partitioned by
+    ``toYYYYMM(toDate(date_column))``. ``trailing_periods`` also refreshes the
+    following periods, for measures that compare with the previous one.
+    """
+
+    table: str
+    source: str
+    date_column: str
+    select_sql: str
+    period: str = "day"
+    source_date_column: str = "SalesDateKey"
+    trailing_periods: int = 0
+
+    @property
+    def staging_table(self) -> str:
+        return f"{self.table}_staging"
+
+    @property
+    def period_expression(self) -> str:
+        return PERIOD_EXPRESSIONS[self.period].format(column=self.source_date_column)
+
+
+# Refresh order follows this dict: a table's rollups are refreshed right after
+# it. FactSales is scanned once, into agg_daily_sales_state; everything else is
+# merged from those states, so averages, min/max and distinct counts stay exact
+# at every grain.
+AGGREGATES: Dict[str, AggregateSpec] = {
+    "agg_daily_sales_state": AggregateSpec(
+        table="agg_daily_sales_state",
+        source="FactSales",
+        date_column="SalesDateKey",
+        select_sql="""
+            SELECT
+                FactSales.SalesDateKey AS SalesDateKey,
+                FactSales.StoreKey AS StoreKey,
+                DimProductCategory.ProductCategoryKey AS ProductCategoryKey,
+                DimCustomerSegment.SegmentKey AS CustomerSegmentKey,
+                sum(FactSales.SalesAmount),
+                sum(FactSales.Quantity),
+                sum(FactSales.DiscountAmount),
+                count(),
+                avgState(FactSales.SalesAmount),
+                min(FactSales.SalesAmount),
+                max(FactSales.SalesAmount),
+                uniqExactState(FactSales.OrderNumber),
+                uniqExactState(FactSales.CustomerKey)
+            FROM FactSales
+            INNER JOIN (SELECT ProductKey, Category FROM DimProduct FINAL) AS product
+                ON FactSales.ProductKey = product.ProductKey
+            INNER JOIN DimProductCategory ON product.Category = DimProductCategory.CategoryName
+            LEFT JOIN (SELECT CustomerKey, CustomerSegment FROM DimCustomer FINAL) AS customer
+                ON FactSales.CustomerKey = customer.CustomerKey
+            LEFT JOIN DimCustomerSegment ON customer.CustomerSegment = DimCustomerSegment.SegmentName
+            WHERE {where}
+            GROUP BY SalesDateKey, StoreKey, ProductCategoryKey, CustomerSegmentKey
+        """,
+    ),
+    "agg_daily_sales": AggregateSpec(
+        table="agg_daily_sales",
+        source="agg_daily_sales_state",
+        date_column="SalesDateKey",
+        select_sql="""
+            SELECT
+                SalesDateKey,
+                StoreKey,
+                ProductCategoryKey,
+                sum(TotalRevenue) AS TotalRevenue,
+                sum(TotalQuantity) AS TotalQuantity,
+                sum(TotalDiscount) AS TotalDiscount,
+                sum(TransactionCount) AS TransactionCount
+            FROM agg_daily_sales_state
+            WHERE {where}
+            GROUP BY SalesDateKey, StoreKey, ProductCategoryKey
+        """,
+    ),
+    "agg_weekly_sales": AggregateSpec(
+        table="agg_weekly_sales",
+        source="agg_daily_sales_state",
+        date_column="WeekStartDateKey",
+        period="week",
+        select_sql="""
+            SELECT
+                toUInt32(toMonday(toDate(SalesDateKey))) AS WeekStartDateKey,
+                DimRegion.RegionKey AS RegionKey,
+                state.ProductCategoryKey AS ProductCategoryKey,
+                sum(state.TotalRevenue) AS RevenueSum,
+                avgMerge(state.RevenueAvg) AS RevenueAvg,
+                min(state.RevenueMin) AS RevenueMin,
+                max(state.RevenueMax) AS RevenueMax
+            FROM agg_daily_sales_state AS state
+            """
+        + _STORE_REGION_JOIN
+        + """
+            WHERE {where}
+            GROUP BY WeekStartDateKey, RegionKey, ProductCategoryKey
+        """,
+    ),
+    "agg_monthly_sales": AggregateSpec(
+        table="agg_monthly_sales",
+        source="agg_daily_sales_state",
+        date_column="MonthStartDateKey",
+        period="month",
+        select_sql="""
+            SELECT
+                toUInt32(toStartOfMonth(toDate(SalesDateKey))) AS MonthStartDateKey,
+                state.CustomerSegmentKey AS CustomerSegmentKey,
+                DimRegion.RegionKey AS RegionKey,
+                sum(state.TotalRevenue) AS TotalRevenue,
+                TotalRevenue / greatest(uniqExactMerge(state.OrderCount), 1) AS AvgOrderValue,
+                uniqExactMerge(state.CustomerCount) AS DistinctCustomerCount
+            FROM agg_daily_sales_state AS state
+            """
+        + _STORE_REGION_JOIN
+        + """
+            WHERE {where}
+            GROUP BY MonthStartDateKey, CustomerSegmentKey, RegionKey
+        """,
+    ),
+    "agg_regional_sales": AggregateSpec(
+        table="agg_regional_sales",
+        source="agg_daily_sales_state",
+        date_column="MonthStartDateKey",
+        period="month",
+        trailing_periods=1,
+        select_sql="""
+            SELECT
+                current.MonthStartDateKey,
+                current.RegionKey,
+                current.SalesTerritoryKey,
+                current.Revenue,
+                if(
+                    previous.PreviousRevenue > 0,
+                    least(greatest(
+                        toFloat64(current.Revenue - previous.PreviousRevenue)
+                            / toFloat64(previous.PreviousRevenue) * 100,
+                        -9999.99), 9999.99),
+                    0
+                ) AS GrowthRate
+            FROM
+            (
+                SELECT
+                    toUInt32(toStartOfMonth(toDate(SalesDateKey))) AS MonthStartDateKey,
+                    toUInt32(addMonths(toDate(MonthStartDateKey), -1)) AS PreviousMonthKey,
+                    DimRegion.RegionKey AS RegionKey,
+                    territory.TerritoryKey AS SalesTerritoryKey,
+                    sum(state.TotalRevenue) AS Revenue
+                FROM agg_daily_sales_state AS state
+                """
+        + _STORE_REGION_JOIN
+        + """
+                LEFT JOIN (SELECT TerritoryKey, TerritoryName FROM DimSalesTerritory FINAL WHERE IsCurrent = 1)
+                    AS territory ON store.Territory = territory.TerritoryName
+                WHERE {where}
+                GROUP BY MonthStartDateKey, PreviousMonthKey, RegionKey, SalesTerritoryKey
+            ) AS current
+            LEFT JOIN
+            (
+                SELECT MonthStartDateKey, RegionKey, SalesTerritoryKey, sum(Revenue) AS PreviousRevenue
+                FROM agg_regional_sales
+                GROUP BY MonthStartDateKey, RegionKey, SalesTerritoryKey
+            ) AS previous
+                ON current.PreviousMonthKey = previous.MonthStartDateKey
+                AND current.RegionKey = previous.RegionKey
+                AND current.SalesTerritoryKey = previous.SalesTerritoryKey
+        """,
+    ),
+    # Product grain is finer than any maintained aggregate, so this one reads
+    # FactSales for the touched months only. There is no product-level rating
+    # source, so AverageRating stays 0.
+    "agg_monthly_product_performance": AggregateSpec(
+        table="agg_monthly_product_performance",
+        source="FactSales",
+        date_column="MonthStartDateKey",
+        period="month",
+        select_sql="""
+            SELECT
+                sales.MonthStartDateKey,
+                sales.ProductKey,
+                sales.StoreKey,
+                sales.Revenue,
+                sales.UnitsSold,
+                if(sales.UnitsSold > 0, least(returns.ReturnedQuantity / sales.UnitsSold * 100, 999.99), 0)
+                    AS ReturnsRate,
+                0 AS AverageRating
+            FROM
+            (
+                SELECT
+                    toUInt32(toStartOfMonth(toDate(SalesDateKey))) AS MonthStartDateKey,
+                    ProductKey,
+                    StoreKey,
+                    sum(SalesAmount) AS Revenue,
+                    sum(Quantity) AS UnitsSold
+                FROM FactSales
+                WHERE {where}
+                GROUP BY MonthStartDateKey, ProductKey, StoreKey
+            ) AS sales
+            LEFT JOIN
+            (
+                SELECT
+                    toUInt32(toStartOfMonth(toDate(ReturnDateKey))) AS MonthStartDateKey,
+                    ProductKey,
+                    StoreKey,
+                    sum(ReturnedQuantity) AS ReturnedQuantity
+                FROM FactReturns
+                WHERE MonthStartDateKey IN %(date_keys)s
+                GROUP BY MonthStartDateKey, ProductKey, StoreKey
+            ) AS returns
+                ON sales.MonthStartDateKey = returns.MonthStartDateKey
+                AND sales.ProductKey = returns.ProductKey
+                AND sales.StoreKey = returns.StoreKey
+        """,
+    ),
+}
+
+
+def date_key(value: str) -> int:
+    """Date key for an ISO date string."""
+    return (date.fromisoformat(value[:10]) - DATE_KEY_EPOCH).days
+
+
+def touched_date_keys(df: pd.DataFrame, column: str) -> List[int]:
+    """Distinct date keys present in ``df[column]``, empty when the column is absent."""
+    if column not in df.columns or df.empty:
+        return []
+    keys = pd.to_numeric(df[column], errors="coerce").dropna().astype("int64").unique()
+    return sorted(int(key) for key in keys)
+
+
+def period_keys(date_keys: Iterable[int], period: str, trailing_periods: int = 0) -> List[int]:
+    """Distinct period start keys (``day``, ``week`` or ``month``) covering ``date_keys``."""
+    keys = np.unique(np.asarray(list(date_keys), dtype="int64"))
+    if not len(keys):
+        return []
+    if period == "day":
+        starts = keys + np.arange(trailing_periods + 1)[:, None]
+    elif period == "week":
+        # Day 0 was a Thursday; weeks start on Monday as with toMonday.
+        monday = keys - (keys + 3) % 7
+        starts = monday + 7 * np.arange(trailing_periods + 1)[:, None]
+    elif period == "month":
+        months = pd.to_datetime(keys, unit="D").to_period("M")
+        starts = np.concatenate(
+            [
+                ((months + offset).to_timestamp() - pd.Timestamp(DATE_KEY_EPOCH)).days.to_numpy()
+                for offset in range(trailing_periods + 1)
+            ]
+        )
+    else:
+        raise ValueError(f"Unknown period {period}")
+    return sorted(int(key) for key in np.unique(starts))
+
+
+def partitions_for_date_keys(date_keys: Iterable[int]) -> Dict[int, List[int]]:
+    """Group date keys by their ``toYYYYMM`` partition id."""
+    keys = np.unique(np.asarray(list(date_keys), dtype="int64"))
+    if not len(keys):
+        return {}
+    days = pd.to_datetime(keys, unit="D")
+    partition_ids = (days.year * 100 + days.month).to_numpy()
+    return {
+        int(partition): keys[partition_ids == partition].tolist()
+        for partition in np.unique(partition_ids)
+    }
+
+
+def refresh_aggregates(
+    client: Client,
+    source: str,
+    date_keys: Iterable[int],
+    aggregates: Optional[Iterable[str]] = None,
+    full_partition: bool = False,
+) -> Dict[str, List[int]]:
+    """
+    Rebuild the aggregates of ``source``, and their rollups, for the given date keys.
+
+    Each touched partition is assembled in the aggregate's staging table and
+    swapped in with ``REPLACE PARTITION``, so reruns give the same result.
+    Untouched periods of the partition are copied from the live aggregate;
+    ``full_partition`` recomputes them from the source instead.
+    Returns the refreshed partition ids per aggregate.
+    """
+    date_keys = list(date_keys)
+    selected = set(aggregates) if aggregates is not None else None
+    refreshed: Dict[str, List[int]] = {}
+    for name, spec in AGGREGATES.items():
+        if spec.source != source or (selected is not None and name not in selected):
+            continue
+        partitions = partitions_for_date_keys(period_keys(date_keys, spec.period, spec.trailing_periods))
+        with metrics.stage("aggregate_refresh", spec.table):
+            client.execute(f"CREATE TABLE IF NOT EXISTS {spec.staging_table} AS {spec.table}")
+            for partition, keys in partitions.items():
+                _refresh_partition(client, spec, partition, keys, full_partition)
+        refreshed[spec.table] = sorted(partitions)
+        LOGGER.info("Aggregate %s refreshed partitions=%s", spec.table, sorted(partitions))
+        refreshed.update(refresh_aggregates(client, spec.table, date_keys, full_partition=full_partition))
+    return refreshed
+
+
+def _refresh_partition(
+    client: Client,
+    spec: AggregateSpec,
+    partition: int,
+    keys: List[int],
+    full_partition: bool,
+) -> None:
+    params = {"partition": partition, "date_keys": keys}
+    client.execute(f"ALTER TABLE {spec.staging_table} DROP PARTITION %(partition)s", params)
+    if full_partition:
+        where = f"toYYYYMM(toDate({spec.period_expression})) = %(partition)s"
+    else:
+        client.execute(
+            f"INSERT INTO {spec.staging_table} SELECT * FROM {spec.table} "
+            f"WHERE toYYYYMM(toDate({spec.date_column})) = %(partition)s "
+            f"AND {spec.date_column} NOT IN %(date_keys)s",
+            params,
+        )
+        where = f"{spec.period_expression} IN %(date_keys)s"
+    client.execute(f"INSERT INTO {spec.staging_table} " + spec.select_sql.format(where=where), params)
+    client.execute(
+        f"ALTER TABLE {spec.table} REPLACE PARTITION %(partition)s FROM {spec.staging_table}",
+        params,
+    )
+    client.execute(f"ALTER TABLE {spec.staging_table} DROP PARTITION %(partition)s", params)
@@ -0,0 +1,225 @@
+"""
+Parallel, partition-atomic backfill of fact tables over a date range.
+
+Usage:
+    python airflow/backfill.py --start 2025-01-01 --end 2025-03-31 [--fact FactSales] [--workers 4]
+
+Connections come from the DWH_PG_* and DWH_CH_* environment variables.
+"""
+
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, List
+
+import extraction
+import loading
+from aggregation import date_key
+from utilities import (
+    ClickHouseConfig,
+    PostgresConfig,
+    clickhouse_config_from_env,
+    get_clickhouse_client,
+    get_logger,
+    get_processing_batch_id,
+    postgres_config_from_env,
+)
+
+LOGGER = get_logger("backfill")
+
+DEFAULT_BACKFILL_WORKERS = int(os.getenv("DWH_BACKFILL_WORKERS", str(os.cpu_count() or 1)))
+
+
+@dataclass(frozen=True)
+class BackfillChunk:
+    """Days ``[start, end)``, all within one ``toYYYYMM`` partition."""
+
+    start: date
+    end: date
+
+    @property
+    def partition(self) -> int:
+        return self.start.year * 100 + self.start.month
+
+    @property
+    def first_key(self) -> int:
+        return date_key(self.start.isoformat())
+
+    @property
+    def end_key(self) -> int:
+        return date_key(self.end.isoformat())
+
+
+def monthly_chunks(start: date, end: date) -> List[BackfillChunk]:
+    """Split the inclusive range ``[start, end]`` at month boundaries."""
+    if end < start:
+        raise ValueError(f"Backfill end {end} is before start {start}")
+    chunks: List[BackfillChunk] = []
+    cursor = start
+    stop = end + timedelta(days=1)
+    while cursor < stop:
+        next_month = (cursor.replace(day=1) + timedelta(days=32)).replace(day=1)
+        chunks.append(BackfillChunk(cursor, min(next_month, stop)))
+        cursor = next_month
+    return chunks
+
+
+def run_backfill(
+    start: date,
+    end: date,
+    pg_config: PostgresConfig,
+    ch_config: ClickHouseConfig,
+    workers: int = DEFAULT_BACKFILL_WORKERS,
+    fact_name: str = "FactSales",
+) -> List[Dict[str, Any]]:
+    """
+    Reload ``fact_name`` for ``[start, end]`` one month partition per process.
+
+    Each chunk's rows (see ``run_chunk``) are transformed, assembled in
+    ``<fact>_staging`` and swapped in with ``REPLACE PARTITION``, so a
+    rerun replaces rather than duplicates. Extraction watermarks are not
+    touched. Aggregates of every reloaded day are rebuilt once all chunks are
+    done. Dimensions are not backfilled; they must already hold the members
+    the facts reference.
+    """
+    chunks = monthly_chunks(start, end)
+    workers = max(1, min(workers, len(chunks)))
+    LOGGER.info("Backfilling %s chunks from %s to %s with %s workers", len(chunks), start, end, workers)
+    results: List[Dict[str, Any]] = []
+    failures: Dict[int, BaseException] = {}
+    if workers == 1:
+        for chunk in chunks:
+            try:
+                results.append(run_chunk(chunk, pg_config, ch_config, fact_name))
+            except Exception as exc:  # pylint: disable=broad-except
+                LOGGER.error("Backfill failed for partition %s: %s", chunk.partition, exc)
+                failures[chunk.partition] = exc
+    else:
+        # Spawned workers start without the parent's pooled connections.
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = {executor.submit(run_chunk, chunk, pg_config, ch_config, fact_name): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    results.append(future.result())
+                except Exception as exc:  # pylint: disable=broad-except
+                    LOGGER.error("Backfill failed for partition %s: %s", chunk.partition, exc)
+                    failures[chunk.partition] = exc
+
+    date_keys = sorted(key for result in results for key in result["date_keys"])
+    if date_keys:
+        loading.update_aggregates(start.isoformat(), ch_config, {fact_name: date_keys}, full_partition=True)
+    if failures:
+        raise RuntimeError(f"Backfill failed for partitions {sorted(failures)}") from next(iter(failures.values()))
+    return sorted(results, key=lambda result: result["partition"])
+
+
+def run_chunk(
+    chunk: BackfillChunk,
+    pg_config: PostgresConfig,
+    ch_config: ClickHouseConfig,
+    fact_name: str = "FactSales",
+) -> Dict[str, Any]:
+    """
+    Extract, transform and swap in one chunk's partition of ``fact_name``.
+
+    The staging partition starts as a copy of the live rows dated outside the
+    chunk, so a chunk covering part of a month leaves the other days intact,
+    and the chunk's days are rebuilt from the extract alone. A row is never
+    modified before its fact date, but may be modified any time after it, so
+    the extract takes every row modified since the chunk's first day and
+    keeps those whose ``date_column`` falls inside the chunk; later rows are
+    left to their own chunk or the daily load. A chunk that extracts nothing
+    keeps the live partition unchanged.
+    """
+    spec = loading.FACT_SPECS[fact_name]
+    staging_table = f"{spec.name}_staging"
+    frames = extraction.extract_window(
+        datetime.combine(chunk.start, time.min),
+        datetime.combine(date.today() + timedelta(days=1), time.min),
+        pg_config,
+        tables=[spec.source],
+    )
+    fact_df = frames[spec.source]
+    summary: Dict[str, Any] = {
+        "partition": chunk.partition,
+        "start": chunk.start.isoformat(),
+        "end": chunk.end.isoformat(),
+        "extracted": len(fact_df),
+        "inserted": 0,
+        "failed": 0,
+        "date_keys": [],
+    }
+    if not fact_df.empty and spec.date_column not in fact_df.columns:
+        # Without the date key the extract cannot be placed in partitions, and
+        # swapping it in would drop the chunk's live rows.
+        raise ValueError(f"{spec.source} extract lacks {spec.date_column}; cannot backfill {spec.name}")
+    if spec.date_column in fact_df.columns:
+        keys = fact_df[spec.date_column]
+        in_chunk = (keys >= chunk.first_key) & (keys < chunk.end_key)
+        LOGGER.info(
+            "Partition %s: %s of %s rows modified since %s are dated inside the chunk",
+            chunk.partition,
+            int(in_chunk.sum()),
+            len(fact_df),
+            chunk.start,
+        )
+        fact_df = fact_df[in_chunk]
+    if fact_df.empty:
+        LOGGER.info("Partition %s: nothing extracted, live partition kept", chunk.partition)
+        return summary
+
+    client = get_clickhouse_client(ch_config)
+    params = {"partition": chunk.partition, "first_key": chunk.first_key, "end_key": chunk.end_key}
+    client.execute(f"CREATE TABLE IF NOT EXISTS {staging_table} AS {spec.name}")
+    client.execute(f"ALTER TABLE {staging_table} DROP PARTITION %(partition)s", params)
+    client.execute(
+        f"INSERT INTO {staging_table} SELECT * FROM {spec.name} "
+        f"WHERE toYYYYMM(toDate({spec.date_column})) = %(partition)s "
+        f"AND ({spec.date_column} < %(first_key)s OR {spec.date_column} >= %(end_key)s)",
+        params,
+    )
+    loaded = loading.load_fact_spec(
+        spec,
+        fact_df,
+        ch_config,
+        get_processing_batch_id(chunk.start.isoformat(), f"{spec.name}_backfill"),
+        target=staging_table,
+    )
+    client.execute(f"ALTER TABLE {spec.name} REPLACE PARTITION %(partition)s FROM {staging_table}", params)
+    client.execute(f"ALTER TABLE {staging_table} DROP PARTITION %(partition)s", params)
+    summary.update(
+        inserted=loaded["inserted"],
+        failed=loaded["failed"],
+        date_keys=list(range(chunk.first_key, chunk.end_key)),
+    )
+    LOGGER.info(
+        "%s partition %s backfilled inserted=%s failed=%s",
+        spec.name,
+        chunk.partition,
+        loaded["inserted"],
+        loaded["failed"],
+    )
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Backfill a fact table by month partition")
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="First day (YYYY-MM-DD)")
+    parser.add_argument("--end", required=True, type=date.fromisoformat, help="Last day, inclusive")
+    parser.add_argument("--fact", default="FactSales", choices=sorted(loading.FACT_SPECS))
+    parser.add_argument("--workers", type=int, default=DEFAULT_BACKFILL_WORKERS)
+    args = parser.parse_args()
+    pg_config, ch_config = postgres_config_from_env(), clickhouse_config_from_env()
+    for result in run_backfill(args.start, args.end, pg_config, ch_config, args.workers, args.fact):
+        LOGGER.info("%s", {key: value for key, value in result.items() if key != "date_keys"})
+
+
+if __name__ == "__main__":
+    main()
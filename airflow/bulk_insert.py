@@ -0,0 +1,145 @@
+"""
+Partition-aware, parallel block inserts with deterministic deduplication tokens.
+"""
+
+from __future__ import annotations
+
+import hashlib
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from utilities import ClickHouseClientManager, get_logger, insert_dataframe_columnar
+
+LOGGER = get_logger("bulk_insert")
+
+
+@dataclass(frozen=True)
+class InsertBlock:
+    """Rows of one ``toYYYYMM`` partition, at most ``block_rows`` long."""
+
+    partition: Optional[int]
+    index: int
+    frame: pd.DataFrame
+
+    def token(self, batch_id: str) -> str:
+        """
+        Deduplication token for this block.
+
+        The batch id and block position make a retry of the same load
+        resend the same tokens. The content digest keeps a retry whose
+        payload shifted (e.g. rows already loaded drop out of an SCD2 diff)
+        from being mistaken for the blocks it replaces.
+        """
+        hashes = pd.util.hash_pandas_object(self.frame, index=False).to_numpy()
+        digest = hashlib.blake2b(hashes.tobytes(), digest_size=8).hexdigest()
+        return f"{batch_id}:{self.partition}:{self.index}:{digest}"
+
+
+def partition_ids(values: pd.Series) -> np.ndarray:
+    """
+    ``toYYYYMM`` of each value: days since the epoch for integer date keys,
+    dates or timestamps otherwise.
+    """
+    if pd.api.types.is_integer_dtype(values.dtype):
+        days = values.to_numpy(dtype="int64").astype("datetime64[D]")
+    else:
+        days = pd.to_datetime(values).to_numpy().astype("datetime64[D]")
+    months = days.astype("datetime64[M]").astype("int64")
+    return (1970 + months // 12) * 100 + months % 12 + 1
+
+
+def plan_blocks(
+    df: pd.DataFrame,
+    block_rows: int,
+    partition_column: Optional[str] = None,
+) -> List[InsertBlock]:
+    """
+    Split ``df`` by target partition, then into blocks of at most ``block_rows``.
+
+    ClickHouse writes one part per partition per block, so single-partition
+    blocks keep one insert from fanning out into many small parts. Rows keep
+    their order within a partition, so the same frame always yields the same
+    blocks.
+    """
+    if df.empty:
+        return []
+    block_rows = max(1, block_rows)
+    if partition_column is None or partition_column not in df.columns:
+        return [
+            InsertBlock(None, index, df.iloc[start : start + block_rows])
+            for index, start in enumerate(range(0, len(df), block_rows))
+        ]
+
+    ids = partition_ids(df[partition_column])
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+    boundaries = np.flatnonzero(np.diff(sorted_ids)) + 1
+    blocks: List[InsertBlock] = []
+    for rows in np.split(order, boundaries):
+        partition = int(ids[rows[0]])
+        for index, start in enumerate(range(0, len(rows), block_rows)):
+            blocks.append(InsertBlock(partition, index, df.iloc[rows[start : start + block_rows]]))
+    return blocks
+
+
+def insert_frame(
+    manager: ClickHouseClientManager,
+    table: str,
+    df: pd.DataFrame,
+    batch_id: str,
+    partition_column: Optional[str] = None,
+    deduplicate: Optional[bool] = None,
+) -> int:
+    """
+    Insert ``df`` into ``table`` as partition-aligned blocks sent concurrently.
+
+    Each block goes over its own pooled connection (``manager.client()``),
+    with up to ``cfg.insert_workers`` blocks in flight. When deduplication is
+    on (``cfg.insert_deduplication`` unless ``deduplicate`` overrides it),
+    every block carries ``insert_deduplication_token`` from ``batch_id``, so
+    a task retry after a partial failure skips the blocks that already
+    landed. The table needs ``non_replicated_deduplication_window`` (see
+    ``sql/07``) unless it is replicated.
+
+    Pass ``deduplicate=False`` for tables that are emptied and refilled, such
+    as partition-swap staging tables: a rerun must write again there, even
+    though the blocks are identical to the previous run's.
+    """
+    cfg = manager.cfg
+    blocks = plan_blocks(df, cfg.insert_chunk_rows, partition_column)
+    if not blocks:
+        return 0
+    deduplicate = cfg.insert_deduplication if deduplicate is None else deduplicate
+
+    def send(block: InsertBlock) -> int:
+        settings = {"insert_deduplication_token": block.token(batch_id)} if deduplicate else {"insert_deduplicate": 0}
+        with manager.client() as client:
+            return insert_dataframe_columnar(client, table, block.frame, settings=settings)
+
+    workers = max(1, min(cfg.insert_workers, len(blocks)))
+    if workers == 1:
+        inserted = sum(send(block) for block in blocks)
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"insert-{table}") as executor:
+            futures = [executor.submit(send, block) for block in blocks]
+            done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in pending:
+                future.cancel()
+            failed = next((future for future in done if future.exception() is not None), None)
+            if failed is not None:
+                # Blocks already sent stay in; the retry's tokens skip them.
+                raise failed.exception()
+            inserted = sum(future.result() for future in futures)
+    LOGGER.info(
+        "Inserted %s rows into %s as %s blocks over %s partitions (workers=%s)",
+        inserted,
+        table,
+        len(blocks),
+        len({block.partition for block in blocks}),
+        workers,
+    )
+    return inserted
@@ -4,6 +4,7 @@ Main Airflow DAG orchestrating the DWH pipeline.
 
 from __future__ import annotations
 
+import functools
 import os
 import sys
 
@@ -12,21 +13,30 @@ if DAG_DIR not in sys.path:
     sys.path.append(DAG_DIR)
 
 from datetime import datetime, timedelta
-from typing import Dict
+from typing import Dict, Iterable, Optional
 
 import pandas as pd
 from airflow import DAG
 from airflow.models import Variable
 from airflow.operators.python import PythonOperator
+from airflow.utils.state import State
+from airflow.utils.trigger_rule import TriggerRule
 
+import aggregation
+import backfill
 import error_handling
+import error_monitoring
 import extraction
 import loading
+import metrics
+import profiling
+import staging
 import validation
 from utilities import (
     ClickHouseConfig,
     PostgresConfig,
     get_clickhouse_client,
+    get_clickhouse_manager,
     get_processing_batch_id,
 )
 
@@ -39,6 +49,10 @@ DEFAULT_ARGS = {
     "start_date": datetime(2025, 1, 1),
 }
 
+# Airflow pool bounding concurrent ClickHouse writers; create it with
+# `airflow pools set clickhouse_writes 4 "ClickHouse write slots"`.
+CLICKHOUSE_WRITE_POOL = Variable.get("ch_write_pool", default_var="clickhouse_writes")
+
 PG_CONFIG = PostgresConfig(
     host=Variable.get("pg_host"),
     port=int(Variable.get("pg_port", default_var=5432)),
@@ -53,147 +67,172 @@ CH_CONFIG = ClickHouseConfig(
     user=Variable.get("ch_user"),
     password=Variable.get("ch_password", default_var=""),
     database=Variable.get("ch_db"),
+    compression=Variable.get("ch_compression", default_var="lz4") or None,
+    insert_block_size=int(Variable.get("ch_insert_block_size", default_var=1_048_576)),
+    settings_profile=Variable.get("ch_settings_profile", default_var="bulk_insert"),
+    pool_size=int(Variable.get("ch_pool_size", default_var=8)),
+    insert_chunk_rows=int(Variable.get("ch_insert_chunk_rows", default_var=250_000)),
+    insert_workers=int(Variable.get("ch_insert_workers", default_var=4)),
+    insert_deduplication=Variable.get("ch_insert_deduplication", default_var="true").lower() != "false",
 )
 
 
+def _profile_options(context) -> profiling.ProfileOptions:
+    """Profiling switch: the run's ``conf["profile"]``, else the ``etl_profile`` Variable."""
+    dag_run = context.get("dag_run")
+    conf = getattr(dag_run, "conf", None) or {}
+    if "profile" in conf:
+        return profiling.resolve_options(conf)
+    return profiling.resolve_options(None, Variable.get("etl_profile", default_var=None, deserialize_json=True))
+
+
+def _instrumented(fn):
+    """
+    Collect the task's stage metrics into etl_run_metrics and an OpenMetrics
+    file, and profile the callable when the run asks for it.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **context):
+        ti = context["ti"]
+        map_index = getattr(ti, "map_index", -1)
+        task_name = ti.task_id if map_index is None or map_index < 0 else f"{ti.task_id}.{map_index}"
+        options = _profile_options(context)
+        if not options.applies_to(ti.task_id):
+            options = profiling.ProfileOptions()
+        with metrics.collect(context["run_id"], task_name, lambda: get_clickhouse_client(CH_CONFIG)):
+            with profiling.profile(context["run_id"], task_name, options):
+                return fn(*args, **context)
+
+    return wrapper
+
+
+@_instrumented
 def _extract(**context):
     ti = context["ti"]
     processing_date = context["ds"]
-    frames = extraction.extract_incremental_data(processing_date, PG_CONFIG)
-    ti.xcom_push(
-        key="frames",
-        value={k: v.to_json(orient="records") for k, v in frames.items()},
+    manifest = extraction.stage_incremental_data(
+        processing_date,
+        PG_CONFIG,
+        context["run_id"],
+        max_workers=int(Variable.get("extract_workers", default_var=extraction.DEFAULT_MAX_WORKERS)),
+        table_timeouts=Variable.get("extract_table_timeouts", default_var={}, deserialize_json=True),
+        engines=Variable.get("extract_engines", default_var={}, deserialize_json=True),
+        projections=Variable.get("extract_projections", default_var={}, deserialize_json=True),
     )
+    ti.xcom_push(key="manifest", value=manifest)
 
 
-def _frames_from_xcom(context) -> Dict[str, pd.DataFrame]:
+def _frames_from_xcom(context, tables: Optional[Iterable[str]] = None) -> Dict[str, pd.DataFrame]:
     ti = context["ti"]
-    frames_json = ti.xcom_pull(task_ids="extract_incremental_data", key="frames") or {}
-    return {k: pd.read_json(v) for k, v in frames_json.items()}
+    manifest = ti.xcom_pull(task_ids="extract_incremental_data", key="manifest") or {}
+    return staging.load_staged_frames(manifest, tables)
 
 
+@_instrumented
 def _validate(**context):
     frames = _frames_from_xcom(context)
-    return validation.validate_extracted_data(frames)
-
-
-def _load_dim_customer(**context):
-    frames = _frames_from_xcom(context)
-    customer_df = frames.get("customer", pd.DataFrame())
-    current = _fetch_clickhouse_df("SELECT * FROM DimCustomer WHERE IsCurrent = 1")
-    loading.load_dimension_scd2(
-        "DimCustomer",
-        current,
-        customer_df,
-        natural_key="CustomerID",
-        tracked_columns={
-            "CustomerName": "string",
-            "Email": "string",
-            "City": "string",
-            "Country": "string",
-            "CustomerSegment": "string",
-            "AccountStatus": "string",
-        },
+    batch_id = get_processing_batch_id(context["ds"], "validation")
+    with error_handling.ErrorRecordWriter(get_clickhouse_client(CH_CONFIG)) as error_writer:
+        return validation.validate_extracted_data(frames, error_writer, batch_id)
+
+
+def _load_dimension(name: str, context) -> None:
+    spec = loading.DIMENSION_SPECS[name]
+    frames = _frames_from_xcom(context, [spec.source])
+    loading.load_dimension_spec(
+        spec,
+        _fetch_clickhouse_df(spec.current_query),
+        frames.get(spec.source, pd.DataFrame()),
         processing_date=context["ds"],
         ch_config=CH_CONFIG,
     )
 
 
+@_instrumented
+def _load_dim_customer(**context):
+    _load_dimension("customer", context)
+
+
+@_instrumented
 def _load_dim_product(**context):
-    frames = _frames_from_xcom(context)
-    product_df = frames.get("product", pd.DataFrame())
-    current = _fetch_clickhouse_df("SELECT * FROM DimProduct WHERE IsCurrent = 1")
-    loading.load_dimension_scd2(
-        "DimProduct",
-        current,
-        product_df,
-        natural_key="ProductID",
-        tracked_columns={
-            "ListPrice": "decimal",
-            "Cost": "decimal",
-            "Category": "string",
-            "ProductStatus": "string",
-        },
-        processing_date=context["ds"],
-        ch_config=CH_CONFIG,
-    )
+    _load_dimension("product", context)
 
 
+@_instrumented
 def _load_dim_store(**context):
-    frames = _frames_from_xcom(context)
-    store_df = frames.get("store", pd.DataFrame())
-    current = _fetch_clickhouse_df("SELECT * FROM DimStore WHERE IsCurrent = 1")
-    loading.load_dimension_scd2(
-        "DimStore",
-        current,
-        store_df,
-        natural_key="StoreID",
-        tracked_columns={
-            "Address": "string",
-            "Region": "string",
-            "Territory": "string",
-            "ManagerName": "string",
-            "StoreStatus": "string",
-        },
-        processing_date=context["ds"],
-        ch_config=CH_CONFIG,
-    )
+    _load_dimension("store", context)
 
 
+@_instrumented
 def _load_dim_employee(**context):
-    frames = _frames_from_xcom(context)
-    employee_df = frames.get("employee", pd.DataFrame())
-    current = _fetch_clickhouse_df("SELECT * FROM DimEmployee WHERE IsCurrent = 1")
-    loading.load_dimension_scd2(
-        "DimEmployee",
-        current,
-        employee_df,
-        natural_key="EmployeeID",
-        tracked_columns={
-            "JobTitle": "string",
-            "Department": "string",
-            "Region": "string",
-            "Territory": "string",
-            "SalesQuota": "decimal",
-        },
-        processing_date=context["ds"],
-        ch_config=CH_CONFIG,
-    )
+    _load_dimension("employee", context)
 
 
-def _load_fact_sales(**context):
-    frames = _frames_from_xcom(context)
-    fact_df = frames.get("FactSales", pd.DataFrame())
-    lookup_maps = {
-        "customer": _build_lookup_map("DimCustomer", "CustomerKey", "CustomerID"),
-        "product": _build_lookup_map("DimProduct", "ProductKey", "ProductID"),
-        "store": _build_lookup_map("DimStore", "StoreKey", "StoreID"),
-        "employee": _build_lookup_map("DimEmployee", "EmployeeKey", "EmployeeID"),
-    }
-    fk_columns = {
-        "customer": "CustomerKey",
-        "product": "ProductKey",
-        "store": "StoreKey",
-        "employee": "EmployeeKey",
-    }
-    batch_id = get_processing_batch_id(context["ds"], "sales")
-    loading.load_fact_table(
-        "FactSales",
-        fact_df,
-        lookup_maps,
-        fk_columns,
+@_instrumented
+def _load_fact(fact_name: str, **context):
+    spec = loading.FACT_SPECS[fact_name]
+    frames = _frames_from_xcom(context, [spec.source])
+    return loading.load_fact_spec(
+        spec,
+        frames.get(spec.source, pd.DataFrame()),
         CH_CONFIG,
-        batch_id,
+        get_processing_batch_id(context["ds"], fact_name),
     )
 
 
+@_instrumented
 def _update_aggregates(**context):
-    loading.update_aggregates(context["ds"], CH_CONFIG)
+    loads = context["ti"].xcom_pull(task_ids="load_fact_tables") or []
+    touched = {load["fact"]: load["date_keys"] for load in loads if load}
+    loading.update_aggregates(context["ds"], CH_CONFIG, touched or None)
 
 
+@_instrumented
 def _reprocess_errors(**context):
-    client = get_clickhouse_client(CH_CONFIG)
-    error_handling.reprocess_recoverable_errors(client)
+    manager = get_clickhouse_manager(CH_CONFIG)
+    client = manager.thread_client()
+    touched = {}
+    for spec in loading.FACT_SPECS.values():
+        result = error_handling.reprocess_foreign_key_errors(
+            manager,
+            spec.name,
+            spec.lookup_maps(client),
+            dict(spec.fk_columns),
+            partition_column=spec.date_column,
+        )
+        # Reloaded rows may belong to earlier days; refresh their aggregates too.
+        touched[spec.name] = aggregation.touched_date_keys(result.reloaded, spec.date_column)
+    if any(touched.values()):
+        loading.update_aggregates(context["ds"], CH_CONFIG, touched)
+    error_monitoring.report_error_rates(
+        client,
+        context["run_id"],
+        get_processing_batch_id(context["ds"]),
+        alert_rate=float(Variable.get("error_rate_alert", default_var=error_monitoring.DEFAULT_ALERT_ERROR_RATE)),
+    )
+
+
+@_instrumented
+def _backfill(**context):
+    params = context["params"]
+    return backfill.run_backfill(
+        datetime.fromisoformat(params["start"]).date(),
+        datetime.fromisoformat(params["end"]).date(),
+        PG_CONFIG,
+        CH_CONFIG,
+        workers=int(params["workers"]),
+        fact_name=params["fact"],
+    )
+
+
+def _cleanup_staging(**context):
+    # A failed run keeps its files so its tasks can be cleared and rerun; the
+    # retention sweep removes them later.
+    failed = context["dag_run"].get_task_instances(state=[State.FAILED, State.UPSTREAM_FAILED])
+    if not failed:
+        staging.cleanup_staged_run(context["run_id"])
+    staging.sweep_staged_runs()
 
 
 def _fetch_clickhouse_df(query: str) -> pd.DataFrame:
@@ -203,13 +242,6 @@ def _fetch_clickhouse_df(query: str) -> pd.DataFrame:
     return pd.DataFrame(data, columns=column_names)
 
 
-def _build_lookup_map(table: str, surrogate: str, natural: str) -> Dict[int, int]:
-    df = _fetch_clickhouse_df(f"SELECT {surrogate}, {natural} FROM {table} WHERE IsCurrent = 1")
-    if df.empty:
-        return {}
-    return dict(zip(df[natural], df[surrogate]))
-
-
 with DAG(
     dag_id="dwh_etl_pipeline",
     default_args=DEFAULT_ARGS,
@@ -253,22 +285,33 @@ with DAG(
         provide_context=True,
     )
 
-    load_fact_sales_task = PythonOperator(
-        task_id="load_fact_sales",
-        python_callable=_load_fact_sales,
-        provide_context=True,
-    )
+    # One mapped task instance per registered fact; the pool caps how many
+    # write to ClickHouse at once.
+    load_fact_tasks = PythonOperator.partial(
+        task_id="load_fact_tables",
+        python_callable=_load_fact,
+        pool=CLICKHOUSE_WRITE_POOL,
+    ).expand(op_kwargs=[{"fact_name": fact_name} for fact_name in loading.FACT_SPECS])
 
     update_aggregates_task = PythonOperator(
         task_id="update_aggregates",
         python_callable=_update_aggregates,
         provide_context=True,
+        pool=CLICKHOUSE_WRITE_POOL,
     )
 
     reprocess_errors_task = PythonOperator(
         task_id="reprocess_recoverable_errors",
         python_callable=_reprocess_errors,
         provide_context=True,
+        pool=CLICKHOUSE_WRITE_POOL,
+    )
+
+    cleanup_staging_task = PythonOperator(
+        task_id="cleanup_staging",
+        python_callable=_cleanup_staging,
+        provide_context=True,
+        trigger_rule=TriggerRule.ALL_DONE,
     )
 
     extract_task >> validate_task
@@ -283,7 +326,26 @@ with DAG(
         load_dim_product_task,
         load_dim_store_task,
         load_dim_employee_task,
-    ] >> load_fact_sales_task
-    load_fact_sales_task >> update_aggregates_task >> reprocess_errors_task
+    ] >> load_fact_tasks
+    load_fact_tasks >> update_aggregates_task >> reprocess_errors_task >> cleanup_staging_task
 
 
+with DAG(
+    dag_id="dwh_backfill",
+    default_args=DEFAULT_ARGS,
+    schedule_interval=None,
+    catchup=False,
+    description="Parallel fact backfill by month partition",
+    params={
+        "fact": "FactSales",
+        "start": "2025-01-01",
+        "end": "2025-01-31",
+        "workers": backfill.DEFAULT_BACKFILL_WORKERS,
+    },
+) as backfill_dag:
+    PythonOperator(
+        task_id="backfill_fact_table",
+        python_callable=_backfill,
+        provide_context=True,
+        retries=0,
+    )
@@ -4,17 +4,220 @@ Centralized error handling utilities.
 
 from __future__ import annotations
 
+import hashlib
+import io
 import json
+import os
+import secrets
+import threading
+import time
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Dict, Iterable
+from decimal import Decimal
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
 
+import pandas as pd
 from clickhouse_driver import Client
 
-from utilities import get_logger
+import bulk_insert
+
+from error_monitoring import record_resolutions
+from key_cache import SurrogateKeyCache
+from transformation import build_fact_payload
+from utilities import ClickHouseClientManager, get_logger
 
 LOGGER = get_logger("error_handling")
 
 
+DEFAULT_FLUSH_RECORDS = 10_000
+DEFAULT_FLUSH_SECONDS = 30.0
+DEFAULT_MAX_RETRIES = 3
+# error_record_status.Status of rows claimed for a reload that may not have
+# landed yet; ResolutionComment holds the batch id they were claimed under.
+RELOADING_STATUS = "Reloading"
+_NODE_MASK = (1 << 64) - 1
+
+# error_records columns, in the order _build_record fills them.
+ERROR_RECORD_COLUMNS = (
+    "ErrorID",
+    "ErrorDate",
+    "SourceTable",
+    "RecordNaturalKey",
+    "ErrorType",
+    "ErrorSeverity",
+    "ErrorMessage",
+    "ErrorDetails",
+    "FailedData",
+    "ProcessingBatchID",
+    "TaskName",
+    "IsRecoverable",
+    "RetryCount",
+    "LastAttemptDate",
+    "IsResolved",
+    "ResolutionComment",
+)
+
+
+class ErrorIdGenerator:
+    """
+    Time-ordered UInt128 ids: 48-bit milliseconds | 16-bit sequence | 64-bit node.
+
+    The node is 64 random bits drawn once per process, and again after a
+    fork, because Airflow forks task processes from a parent that has
+    already imported this module. Ids never repeat within a process; two
+    processes can only collide by drawing the same node, about one chance in
+    10**11 even with 10,000 processes writing at once. The sequence allows
+    65,536 ids per millisecond before it waits for the next one.
+    """
+
+    def __init__(self, node: Optional[int] = None) -> None:
+        self._fixed_node = node is not None
+        self._pid = os.getpid()
+        self._node = node & _NODE_MASK if node is not None else secrets.randbits(64)
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_id(self) -> int:
+        with self._lock:
+            if not self._fixed_node and os.getpid() != self._pid:
+                self._pid = os.getpid()
+                self._node = secrets.randbits(64)
+                self._last_ms = 0
+                self._sequence = 0
+            now_ms = int(time.time() * 1000)
+            if now_ms <= self._last_ms:
+                now_ms = self._last_ms
+                self._sequence = (self._sequence + 1) & 0xFFFF
+                if self._sequence == 0:
+                    now_ms += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return (now_ms << 80) | (self._sequence << 64) | self._node
+
+_ID_GENERATOR = ErrorIdGenerator()
+
+
+@dataclass
+class ReprocessResult:
+    """Rows reloaded into the fact table and the count of errors still failing."""
+
+    reloaded: pd.DataFrame
+    still_failing: int
+
+
+class ErrorRecordWriter:
+    """
+    Buffer ``error_records`` rows and insert them in bounded blocks.
+
+    Use as a context manager; pending records are flushed on exit, including
+    when the block raises, so the errors behind a failure are not lost.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        max_records: int = DEFAULT_FLUSH_RECORDS,
+        max_interval_seconds: float = DEFAULT_FLUSH_SECONDS,
+    ) -> None:
+        self.client = client
+        self.max_records = max_records
+        self.max_interval_seconds = max_interval_seconds
+        self.written = 0
+        self._buffer: List[Dict[str, Any]] = []
+        self._last_flush = time.monotonic()
+
+    def __enter__(self) -> "ErrorRecordWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.flush()
+
+    def add(
+        self,
+        error_type: str,
+        error_message: str,
+        failed_data: Dict[str, Any],
+        source_table: str,
+        natural_key: str,
+        processing_batch_id: str,
+        task_name: str,
+        is_recoverable: bool,
+    ) -> None:
+        self._buffer.append(
+            _build_record(
+                error_type,
+                error_message,
+                json.dumps(failed_data, default=str),
+                source_table,
+                natural_key,
+                processing_batch_id,
+                task_name,
+                is_recoverable,
+            )
+        )
+        self._maybe_flush()
+
+    def add_frame(
+        self,
+        error_type: str,
+        error_message: str,
+        failed_rows: pd.DataFrame,
+        source_table: str,
+        processing_batch_id: str,
+        task_name: str,
+        is_recoverable: bool,
+    ) -> int:
+        """
+        Buffer one record per row of ``failed_rows``, keyed by its index.
+        """
+        if failed_rows.empty:
+            return 0
+        payloads = failed_rows.to_json(
+            orient="records",
+            lines=True,
+            date_format="iso",
+            default_handler=str,
+        ).splitlines()
+        for natural_key, payload in zip(failed_rows.index, payloads):
+            self._buffer.append(
+                _build_record(
+                    error_type,
+                    error_message,
+                    payload,
+                    source_table,
+                    str(natural_key),
+                    processing_batch_id,
+                    task_name,
+                    is_recoverable,
+                )
+            )
+        LOGGER.warning("Queued %s %s errors for %s", len(payloads), error_type, source_table)
+        self._maybe_flush()
+        return len(payloads)
+
+    def flush(self) -> int:
+        flushed = 0
+        while self._buffer:
+            block = self._buffer[: self.max_records]
+            _insert_error_records(self.client, block)
+            del self._buffer[: len(block)]
+            flushed += len(block)
+        self.written += flushed
+        self._last_flush = time.monotonic()
+        if flushed:
+            LOGGER.info("Flushed %s error records", flushed)
+        return flushed
+
+    def _maybe_flush(self) -> None:
+        if (
+            len(self._buffer) >= self.max_records
+            or time.monotonic() - self._last_flush >= self.max_interval_seconds
+        ):
+            self.flush()
+
+
 def log_error_record(
     client: Client,
     error_type: str,
@@ -26,64 +229,225 @@ def log_error_record(
     task_name: str,
     is_recoverable: bool,
 ) -> None:
-    record = {
-        "ErrorID": int(datetime.utcnow().timestamp() * 1000),
-        "ErrorDate": datetime.utcnow(),
+    record = _build_record(
+        error_type,
+        error_message,
+        json.dumps(failed_data),
+        source_table,
+        natural_key,
+        processing_batch_id,
+        task_name,
+        is_recoverable,
+    )
+    _insert_error_records(client, [record])
+    LOGGER.warning("Logged error %s for %s", error_type, natural_key)
+
+
+def _insert_error_records(client: Client, records: List[Dict[str, Any]]) -> None:
+    client.execute(
+        f"INSERT INTO error_records ({', '.join(ERROR_RECORD_COLUMNS)}) VALUES",
+        [[record[column] for record in records] for column in ERROR_RECORD_COLUMNS],
+        columnar=True,
+    )
+
+
+def _build_record(
+    error_type: str,
+    error_message: str,
+    failed_data: str,
+    source_table: str,
+    natural_key: str,
+    processing_batch_id: str,
+    task_name: str,
+    is_recoverable: bool,
+) -> Dict[str, Any]:
+    now = datetime.utcnow()
+    return {
+        "ErrorID": _ID_GENERATOR.next_id(),
+        "ErrorDate": now,
         "SourceTable": source_table,
         "RecordNaturalKey": natural_key,
         "ErrorType": error_type,
         "ErrorSeverity": "Critical" if not is_recoverable else "Warning",
         "ErrorMessage": error_message,
         "ErrorDetails": "",
-        "FailedData": json.dumps(failed_data),
+        "FailedData": failed_data,
         "ProcessingBatchID": processing_batch_id,
         "TaskName": task_name,
         "IsRecoverable": int(is_recoverable),
         "RetryCount": 0,
-        "LastAttemptDate": datetime.utcnow(),
+        "LastAttemptDate": now,
         "IsResolved": 0,
         "ResolutionComment": None,
     }
-    client.insert("error_records", [record])
-    LOGGER.warning("Logged error %s for %s", error_type, natural_key)
 
 
-def reprocess_recoverable_errors(client: Client, limit: int = 100) -> None:
-    query = """
-        SELECT *
-        FROM error_records
-        WHERE IsResolved = 0
-          AND IsRecoverable = 1
-          AND RetryCount < 3
-        ORDER BY LastAttemptDate ASC
-        LIMIT %(limit)s
+def reprocess_foreign_key_errors(
+    manager: ClickHouseClientManager,
+    fact_name: str,
+    lookup_maps: Mapping[str, Union[Dict[int, int], SurrogateKeyCache]],
+    fk_columns: Dict[str, str],
+    processing_batch_id: Optional[str] = None,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    partition_column: Optional[str] = None,
+) -> ReprocessResult:
+    """
+    Reload open ``ForeignKeyMissing`` rows of ``fact_name`` whose keys now resolve.
+
+    All open rows (optionally of one batch) are read in one query and
+    re-resolved in one vectorized pass. Before the resolving rows are
+    inserted, they are claimed in ``error_record_status`` as ``Reloading``
+    under a batch id derived from their error ids. A retry sends claimed rows
+    again under the batch id they were claimed with, so
+    ``bulk_insert.insert_frame`` deduplicates them even when more rows
+    resolve on the retry. Every attempt is then recorded with a single insert
+    into ``error_record_status``.
     """
-    rows = client.execute(query, {"limit": limit})
-    for row in rows:
-        _retry_error(client, row)
-
-
-def _retry_error(client: Client, row: Dict[str, Any]) -> None:
-    LOGGER.info("Retrying error %s", row["ErrorID"])
-    try:
-        # Placeholder for real retry logic
-        client.execute(
-            """
-            ALTER TABLE error_records
-            UPDATE IsResolved = 1, ResolutionComment = %(comment)s
-            WHERE ErrorID = %(id)s
-            """,
-            {"comment": "Auto-resolved during retry", "id": row["ErrorID"]},
+    client = manager.thread_client()
+    where = [
+        "e.ErrorType = 'ForeignKeyMissing'",
+        "e.SourceTable = %(fact_name)s",
+        "e.IsRecoverable = 1",
+        "e.IsResolved = 0",
+        "s.IsResolved = 0",
+        "greatest(e.RetryCount, s.RetryCount) < %(max_retries)s",
+    ]
+    params: Dict[str, Any] = {"fact_name": fact_name, "max_retries": max_retries}
+    if processing_batch_id:
+        where.append("e.ProcessingBatchID = %(batch)s")
+        params["batch"] = processing_batch_id
+    rows = client.execute(
+        f"""
+        SELECT
+            e.ErrorID,
+            e.FailedData,
+            greatest(e.RetryCount, s.RetryCount),
+            e.ErrorDate,
+            e.TaskName,
+            e.ProcessingBatchID,
+            s.Status,
+            s.ResolutionComment
+        FROM error_records AS e
+        LEFT JOIN (
+            SELECT ErrorID, RetryCount, IsResolved, Status, ResolutionComment FROM error_record_status FINAL
+        ) AS s
+            ON e.ErrorID = s.ErrorID
+        WHERE {" AND ".join(where)}
+        """,
+        params,
+        columnar=True,
+    )
+    if not rows or not len(rows[0]):
+        LOGGER.info("No open ForeignKeyMissing errors for %s", fact_name)
+        return ReprocessResult(reloaded=pd.DataFrame(), still_failing=0)
+    error_ids, payloads, retry_counts, error_dates, task_names, batch_ids, states, comments = (
+        list(column) for column in rows
+    )
+
+    failed = pd.read_json(io.StringIO("\n".join(payloads)), lines=True, dtype=False)
+    failed = _coerce_to_table(client, fact_name, failed)
+    enriched = build_fact_payload(fact_name, failed, lookup_maps, fk_columns)
+    present = [column for column in fk_columns.values() if column in enriched]
+    unresolved = enriched[present].isna().any(axis=1).to_numpy()
+
+    # Rows claimed by an earlier attempt keep its batch id; the rest are
+    # claimed under a new one before anything is inserted.
+    claims = pd.Series(
+        [comment if state == RELOADING_STATUS else None for state, comment in zip(states, comments)],
+        dtype=object,
+    )
+    unclaimed = ~unresolved & claims.isna().to_numpy()
+    now = datetime.utcnow()
+    if unclaimed.any():
+        new_ids = [int(error_id) for error_id in pd.Series(error_ids)[unclaimed]]
+        batch_id = _reprocess_batch_id(fact_name, new_ids)
+        claims[unclaimed] = batch_id
+        retries = pd.Series(retry_counts)[unclaimed]
+        _record_status(
+            client,
+            [(error_id, RELOADING_STATUS, int(retry), 0, batch_id, now) for error_id, retry in zip(new_ids, retries)],
         )
-    except Exception as exc:  # pylint: disable=broad-except
-        LOGGER.error("Retry failed for %s: %s", row["ErrorID"], exc)
-        client.execute(
-            """
-            ALTER TABLE error_records
-            UPDATE RetryCount = RetryCount + 1, LastAttemptDate = %(attempt)s
-            WHERE ErrorID = %(id)s
-            """,
-            {"attempt": datetime.utcnow(), "id": row["ErrorID"]},
+
+    reloaded = enriched[~unresolved].astype({column: "uint32" for column in present})
+    reloaded_claims = claims[~unresolved].to_numpy()
+    for batch_id in dict.fromkeys(reloaded_claims):
+        bulk_insert.insert_frame(
+            manager,
+            fact_name,
+            reloaded[reloaded_claims == batch_id],
+            batch_id,
+            partition_column=partition_column,
         )
 
+    statuses = []
+    for error_id, retry_count, failing in zip(error_ids, retry_counts, unresolved):
+        attempts = int(retry_count) + int(failing)
+        if not failing:
+            status, comment = "Resolved", "Reloaded after surrogate keys resolved"
+        elif attempts >= max_retries:
+            status, comment = "Exhausted", "Foreign keys still missing after retry budget"
+        else:
+            status, comment = "Retrying", None
+        statuses.append((int(error_id), status, min(attempts, 255), int(not failing), comment, now))
+    _record_status(client, statuses)
+    resolved = ~unresolved
+    record_resolutions(
+        client,
+        pd.DataFrame(
+            {
+                "ErrorDate": pd.Series(error_dates)[resolved],
+                "SourceTable": fact_name,
+                "ErrorType": "ForeignKeyMissing",
+                "TaskName": pd.Series(task_names)[resolved],
+                "ProcessingBatchID": pd.Series(batch_ids)[resolved],
+            }
+        ),
+    )
+
+    LOGGER.info(
+        "Reprocessed %s ForeignKeyMissing errors for %s reloaded=%s still_failing=%s",
+        len(error_ids),
+        fact_name,
+        len(reloaded),
+        int(unresolved.sum()),
+    )
+    return ReprocessResult(reloaded=reloaded, still_failing=int(unresolved.sum()))
+
+
+def _reprocess_batch_id(fact_name: str, error_ids: List[int]) -> str:
+    digest = hashlib.blake2b(",".join(map(str, error_ids)).encode(), digest_size=8).hexdigest()
+    return f"reprocess_{fact_name}_{digest}"
+
+
+def _record_status(client: Client, statuses: List[Tuple[int, str, int, int, Optional[str], datetime]]) -> None:
+    # Version is the attempt time in milliseconds, so the latest attempt wins
+    # when ReplacingMergeTree collapses rows.
+    version = int(time.time() * 1000)
+    columns = list(zip(*statuses))
+    client.execute(
+        "INSERT INTO error_record_status "
+        "(ErrorID, Status, RetryCount, IsResolved, ResolutionComment, LastAttemptDate, Version) VALUES",
+        [list(column) for column in columns] + [[version] * len(statuses)],
+        columnar=True,
+    )
+
 
+def _coerce_to_table(client: Client, table: str, df: pd.DataFrame) -> pd.DataFrame:
+    # FailedData round-trips through JSON, so decimals and dates come back as
+    # strings; restore the types the target columns expect.
+    described = client.execute(f"DESCRIBE TABLE {table}")
+    types = {row[0]: row[1] for row in described}
+    df = df[[column for column in df.columns if column in types]].copy()
+    for column in df.columns:
+        column_type = types[column].replace("Nullable(", "").rstrip(")")
+        if column_type.startswith("Decimal"):
+            df[column] = [None if pd.isna(value) else Decimal(str(value)) for value in df[column]]
+        elif column_type.startswith(("UInt", "Int")):
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype("Int64")
+        elif column_type.startswith("Float"):
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+        elif column_type.startswith("Date"):
+            df[column] = pd.to_datetime(df[column], errors="coerce")
+        elif column_type.startswith("String"):
+            df[column] = df[column].fillna("").astype(str)
+    return df
@@ -0,0 +1,246 @@
+"""
+Error monitoring summary maintenance and cached dashboard queries.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import pandas as pd
+from clickhouse_driver import Client
+
+from metrics import METRICS_TABLE
+from utilities import get_logger
+
+LOGGER = get_logger("error_monitoring")
+
+SUMMARY_TABLE = "error_monitoring_summary"
+DEFAULT_CACHE_TTL_SECONDS = 60.0
+DEFAULT_ALERT_ERROR_RATE = 0.01
+SUMMARY_KEY_COLUMNS = ["SourceTable", "ErrorType", "TaskName", "ProcessingBatchID"]
+_GRAINS = {"hour": "h", "day": "D"}
+# Stages whose RowsIn counts the rows errors are raised against: validation
+# errors per source table, ForeignKeyMissing per fact.
+PROCESSED_STAGES = ("validate", "fact_insert")
+
+
+def record_resolutions(client: Client, resolved: pd.DataFrame) -> int:
+    """
+    Add ``ResolvedCount`` deltas for resolved ``error_records`` rows.
+
+    ``resolved`` needs ``ErrorDate`` plus the summary key columns; counts land
+    in the hour and day buckets of the original error so the buckets' open
+    backlog drops to zero once all their errors are resolved.
+    """
+    if resolved.empty:
+        return 0
+    blocks = []
+    for grain, freq in _GRAINS.items():
+        bucket = pd.to_datetime(resolved["ErrorDate"]).dt.floor(freq).rename("SnapshotDate")
+        counts = (
+            resolved[SUMMARY_KEY_COLUMNS]
+            .assign(SnapshotDate=bucket)
+            .groupby(["SnapshotDate"] + SUMMARY_KEY_COLUMNS, sort=False)
+            .size()
+            .rename("ResolvedCount")
+            .reset_index()
+        )
+        counts["Grain"] = grain
+        blocks.append(counts)
+    deltas = pd.concat(blocks, ignore_index=True)
+    for column in ("ErrorCount", "RecoverableCount", "CriticalCount"):
+        deltas[column] = 0
+    columns = ["SnapshotDate", "Grain"] + SUMMARY_KEY_COLUMNS + [
+        "ErrorCount",
+        "RecoverableCount",
+        "CriticalCount",
+        "ResolvedCount",
+    ]
+    client.execute(
+        f"INSERT INTO {SUMMARY_TABLE} ({', '.join(columns)}) VALUES",
+        [deltas[column].tolist() for column in columns],
+        columnar=True,
+    )
+    return len(resolved)
+
+
+def report_error_rates(
+    client: Client,
+    run_id: str,
+    processing_batch_id: str,
+    alert_rate: float = DEFAULT_ALERT_ERROR_RATE,
+) -> pd.DataFrame:
+    """Log a run's error rates (``ErrorMonitor.error_rates``), warning above ``alert_rate``."""
+    rates = ErrorMonitor(client, ttl_seconds=0).error_rates(run_id, processing_batch_id)
+    for row in rates.itertuples(index=False):
+        alerting = pd.notna(row.ErrorRate) and row.ErrorRate > alert_rate
+        (LOGGER.warning if alerting else LOGGER.info)(
+            "Error rate %s %s errors=%s rows=%s rate=%s",
+            row.SourceTable,
+            row.ErrorType,
+            row.ErrorCount,
+            row.RowsProcessed,
+            f"{row.ErrorRate:.4%}" if pd.notna(row.ErrorRate) else "n/a",
+        )
+    return rates
+
+
+class ErrorMonitor:
+    """
+    Dashboard queries over ``error_monitoring_summary`` with a TTL result cache.
+
+    Results are shared between callers for ``ttl_seconds``; returned frames
+    are copies, so callers may modify them.
+    """
+
+    def __init__(self, client: Client, ttl_seconds: float = DEFAULT_CACHE_TTL_SECONDS) -> None:
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self._cache: Dict[Hashable, Tuple[float, pd.DataFrame]] = {}
+        self._lock = threading.Lock()
+
+    def open_errors(self, source_table: Optional[str] = None) -> pd.DataFrame:
+        """Unresolved errors per source table, error type and task."""
+        where = "Grain = 'day'"
+        params: Dict[str, Any] = {}
+        if source_table:
+            where += " AND SourceTable = %(source_table)s"
+            params["source_table"] = source_table
+        return self._cached(
+            ("open_errors", source_table),
+            f"""
+            SELECT
+                SourceTable,
+                ErrorType,
+                TaskName,
+                sum(ErrorCount) - sum(ResolvedCount) AS OpenCount,
+                sum(CriticalCount) AS CriticalCount,
+                min(SnapshotDate) AS OldestErrorDate
+            FROM {SUMMARY_TABLE}
+            WHERE {where}
+            GROUP BY SourceTable, ErrorType, TaskName
+            HAVING OpenCount > 0
+            ORDER BY OpenCount DESC
+            """,
+            params,
+        )
+
+    def errors_by_batch(self, limit: int = 30) -> pd.DataFrame:
+        """Error counts and recoverable/resolved shares for the most recent batches."""
+        return self._cached(
+            ("errors_by_batch", limit),
+            f"""
+            SELECT
+                ProcessingBatchID,
+                min(SnapshotDate) AS FirstErrorDate,
+                sum(ErrorCount) AS ErrorCount,
+                sum(RecoverableCount) / greatest(sum(ErrorCount), 1) AS RecoverableRate,
+                sum(ResolvedCount) / greatest(sum(ErrorCount), 1) AS ResolvedRate,
+                sum(CriticalCount) AS CriticalCount
+            FROM {SUMMARY_TABLE}
+            WHERE Grain = 'day'
+            GROUP BY ProcessingBatchID
+            ORDER BY FirstErrorDate DESC
+            LIMIT %(limit)s
+            """,
+            {"limit": limit},
+        )
+
+    def error_rates(self, run_id: str, processing_batch_id: str) -> pd.DataFrame:
+        """
+        Errors per source table and error type of one run, over the rows it processed.
+
+        Error counts come from the summary rows whose batch id starts with
+        ``processing_batch_id`` (the run's validation and per-fact batches);
+        processed rows are the largest ``RowsIn`` that ``run_id`` recorded
+        for the table in ``etl_run_metrics``. Tables without metrics report
+        zero processed rows and a NULL rate.
+        """
+        return self._cached(
+            ("error_rates", run_id, processing_batch_id),
+            f"""
+            SELECT
+                e.SourceTable AS SourceTable,
+                e.ErrorType AS ErrorType,
+                e.ErrorCount AS ErrorCount,
+                p.RowsProcessed AS RowsProcessed,
+                if(p.RowsProcessed > 0, e.ErrorCount / p.RowsProcessed, NULL) AS ErrorRate
+            FROM
+            (
+                SELECT SourceTable, ErrorType, sum(ErrorCount) AS ErrorCount
+                FROM {SUMMARY_TABLE}
+                WHERE Grain = 'day' AND startsWith(ProcessingBatchID, %(batch)s)
+                GROUP BY SourceTable, ErrorType
+            ) AS e
+            LEFT JOIN
+            (
+                SELECT TableName, max(RowsIn) AS RowsProcessed
+                FROM {METRICS_TABLE}
+                WHERE RunID = %(run_id)s AND Stage IN %(stages)s
+                GROUP BY TableName
+            ) AS p ON e.SourceTable = p.TableName
+            ORDER BY ErrorRate DESC
+            """,
+            {"run_id": run_id, "batch": processing_batch_id, "stages": PROCESSED_STAGES},
+        )
+
+    def aging_backlog(self) -> pd.DataFrame:
+        """Open errors bucketed by age of the error."""
+        return self._cached(
+            ("aging_backlog",),
+            f"""
+            SELECT
+                multiIf(
+                    dateDiff('day', SnapshotDate, now()) < 1, '0-1d',
+                    dateDiff('day', SnapshotDate, now()) < 3, '1-3d',
+                    dateDiff('day', SnapshotDate, now()) < 7, '3-7d',
+                    dateDiff('day', SnapshotDate, now()) < 30, '7-30d',
+                    '30d+'
+                ) AS AgeBucket,
+                SourceTable,
+                ErrorType,
+                sum(ErrorCount) - sum(ResolvedCount) AS OpenCount
+            FROM {SUMMARY_TABLE}
+            WHERE Grain = 'day'
+            GROUP BY AgeBucket, SourceTable, ErrorType
+            HAVING OpenCount > 0
+            ORDER BY AgeBucket, OpenCount DESC
+            """,
+        )
+
+    def hourly_trend(self, hours: int = 24) -> pd.DataFrame:
+        """Errors per hour and error type over the last ``hours``."""
+        return self._cached(
+            ("hourly_trend", hours),
+            f"""
+            SELECT SnapshotDate, ErrorType, sum(ErrorCount) AS ErrorCount
+            FROM {SUMMARY_TABLE}
+            WHERE Grain = 'hour' AND SnapshotDate >= now() - toIntervalHour(%(hours)s)
+            GROUP BY SnapshotDate, ErrorType
+            ORDER BY SnapshotDate, ErrorType
+            """,
+            {"hours": hours},
+        )
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def _cached(self, key: Hashable, query: str, params: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+        now = time.monotonic()
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit is not None and hit[0] > now:
+                return hit[1].copy()
+        frame = self._query(query, params or {})
+        with self._lock:
+            self._cache[key] = (now + self.ttl_seconds, frame)
+        return frame.copy()
+
+    def _query(self, query: str, params: Dict[str, Any]) -> pd.DataFrame:
+        started = time.perf_counter()
+        data, columns = self.client.execute(query, params, with_column_types=True)
+        LOGGER.debug("Monitoring query took %.1f ms", (time.perf_counter() - started) * 1000)
+        return pd.DataFrame(data, columns=[column[0] for column in columns])
@@ -4,82 +4,317 @@ Extraction logic for AdventureWorks source in PostgreSQL.
 
 from __future__ import annotations
 
-from datetime import datetime
-from typing import Dict, Iterable, Optional
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import pandas as pd
 
+import metrics
+import staging
+from source_schema import apply_source_dtypes
 from utilities import (
+    DEFAULT_ITERSIZE,
     PostgresConfig,
-    dataframe_from_query,
-    determine_processing_window,
     get_logger,
     get_postgres_conn,
-    load_last_run_time,
+    get_postgres_pool,
+    iter_dataframes_from_copy,
+    iter_dataframes_from_query,
     log_row_counts,
-    save_last_run_time,
+    pooled_postgres_conn,
 )
+from query_planner import (
+    DIMENSION_TABLES,
+    FACT_TABLES,
+    SOURCE_KEYS,
+    QueryPlan,
+    plan_extraction,
+    source_columns,
+)
+from watermarks import Bound, HighWaterTracker, WatermarkStore
 
 LOGGER = get_logger("extraction")
 
+DEFAULT_MAX_WORKERS = int(os.getenv("DWH_EXTRACT_WORKERS", "4"))
+# Seconds; 0 disables the Postgres statement_timeout.
+DEFAULT_TABLE_TIMEOUT = float(os.getenv("DWH_EXTRACT_TABLE_TIMEOUT", "0"))
 
-DIMENSION_TABLES = {
-    "customer": "sales.customer",
-    "product": "production.product",
-    "store": "sales.store",
-    "employee": "humanresources.employee",
-    "vendor": "purchasing.vendor",
-}
 
-FACT_TABLES = {
-    "FactSales": "sales.salesorderdetail",
-    "FactPurchases": "purchasing.purchaseorderdetail",
-    "FactInventory": "production.productinventory",
-    "FactReturns": "sales.salesorderheadersalesreason",
+# Extraction engine per table: "cursor" streams rows through a server-side
+# cursor, "copy" streams COPY ... TO STDOUT bytes into Arrow's CSV reader.
+# Tables not listed use "cursor".
+EXTRACTION_ENGINES = {
+    "FactSales": "copy",
+    "FactPurchases": "copy",
+    "FactInventory": "copy",
 }
 
 
 def extract_incremental_data(
     processing_date: str,
     pg_config: PostgresConfig,
+    run_id: str,
     tables: Optional[Iterable[str]] = None,
+    itersize: int = DEFAULT_ITERSIZE,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    table_timeouts: Optional[Dict[str, float]] = None,
+    engines: Optional[Dict[str, str]] = None,
+    watermark_store: Optional[WatermarkStore] = None,
+    projections: Optional[Dict[str, Sequence[str]]] = None,
 ) -> Dict[str, pd.DataFrame]:
     """
-    Pull incremental data for the provided processing date.
+    Pull rows past each table's watermark, up to the end of the processing date.
+
+    Watermarks are advanced under ``run_id``; rerunning the same run starts
+    again from the watermarks it found.
     """
     LOGGER.info("Starting extraction for %s", processing_date)
-    selected_tables = tables or list(DIMENSION_TABLES.keys()) + list(FACT_TABLES.keys())
+    store = watermark_store or WatermarkStore()
+    upper = _upper_bound(processing_date)
 
-    last_run = load_last_run_time("extraction")
-    window = determine_processing_window(last_run, datetime.fromisoformat(f"{processing_date}T00:00:00"))
+    def extract_one(conn, name: str) -> Tuple[pd.DataFrame, int]:
+        current = store.get(name)
+        lower = current.lower_bound_for(run_id) if current else None
+        tracker = HighWaterTracker(SOURCE_KEYS[name])
+        plan = _plan(conn, name, lower, upper, projections)
+        chunks = list(tracker.track(_iter_table_chunks(conn, plan, itersize, engines)))
+        df = chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+        df = apply_source_dtypes(name, df)
+        log_row_counts(LOGGER, f"extracted_{name}", df)
+        store.advance(name, current, tracker.high_water, run_id)
+        return df, len(df)
 
-    payload: Dict[str, pd.DataFrame] = {}
-    with get_postgres_conn(pg_config) as conn:
-        for name in selected_tables:
-            query = _build_query(name, window)
-            df = dataframe_from_query(conn, query)
-            log_row_counts(LOGGER, f"extracted_{name}", df)
-            payload[name] = df
-
-    save_last_run_time("extraction", datetime.utcnow())
-    return payload
-
-
-def _build_query(table_name: str, window: Dict[str, datetime]) -> str:
-    if table_name in DIMENSION_TABLES:
-        source = DIMENSION_TABLES[table_name]
-        return (
-            f"SELECT * FROM {source} "
-            f"WHERE COALESCE(modifieddate, now()) BETWEEN '{window['from']}' AND '{window['to']}'"
-        )
-
-    source = FACT_TABLES.get(table_name)
-    if not source:
-        raise ValueError(f"Unknown table {table_name}")
-    process_date = window["to"].date()
-    return (
-        f"SELECT * FROM {source} "
-        f"WHERE CAST('{process_date}' AS DATE) = CAST(modifieddate AS DATE)"
+    return _extract_tables(pg_config, _selected_tables(tables), extract_one, max_workers, table_timeouts)
+
+
+def extract_window(
+    start: datetime,
+    end: datetime,
+    pg_config: PostgresConfig,
+    tables: Optional[Iterable[str]] = None,
+    itersize: int = DEFAULT_ITERSIZE,
+    engines: Optional[Dict[str, str]] = None,
+    projections: Optional[Dict[str, Sequence[str]]] = None,
+) -> Dict[str, pd.DataFrame]:
+    """
+    Pull rows with ``start <= modifieddate < end``, ignoring and keeping watermarks.
+
+    Used by backfills, which run one window per process over a single
+    connection.
+    """
+
+    def extract_one(conn, name: str) -> Tuple[pd.DataFrame, int]:
+        plan = _plan(conn, name, None, end, projections, start=start)
+        chunks = list(_iter_table_chunks(conn, plan, itersize, engines))
+        df = chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+        df = apply_source_dtypes(name, df)
+        log_row_counts(LOGGER, f"extracted_{name}", df)
+        return df, len(df)
+
+    return _extract_tables(pg_config, _selected_tables(tables), extract_one, 1, None)
+
+
+def stage_incremental_data(
+    processing_date: str,
+    pg_config: PostgresConfig,
+    run_id: str,
+    tables: Optional[Iterable[str]] = None,
+    itersize: int = DEFAULT_ITERSIZE,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    table_timeouts: Optional[Dict[str, float]] = None,
+    engines: Optional[Dict[str, str]] = None,
+    watermark_store: Optional[WatermarkStore] = None,
+    projections: Optional[Dict[str, Sequence[str]]] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Stream incremental data straight into the staging store.
+
+    Each table is fetched through a server-side cursor and written chunk by
+    chunk, so peak memory is bounded by ``itersize`` rather than table size.
+    Each table's watermark is advanced as soon as it is staged; when the same
+    run is retried, tables it already staged are reused, so only the tables
+    that failed are extracted again. Returns the staging manifest.
+    """
+    LOGGER.info("Starting streamed extraction for %s", processing_date)
+    store = watermark_store or WatermarkStore()
+    upper = _upper_bound(processing_date)
+
+    def extract_one(conn, name: str) -> Tuple[Dict[str, Any], int]:
+        current = store.get(name)
+        if current and current.run_id == run_id and current.staged and Path(current.staged["path"]).exists():
+            LOGGER.info("Reusing %s staged earlier by run %s", name, run_id)
+            return current.staged, current.staged["row_count"]
+        lower = current.lower_bound_for(run_id) if current else None
+        tracker = HighWaterTracker(SOURCE_KEYS[name])
+        plan = _plan(conn, name, lower, upper, projections)
+        chunks = tracker.track(_iter_table_chunks(conn, plan, itersize, engines))
+        entry = staging.stage_frame_chunks(name, chunks, run_id)
+        LOGGER.info("extracted_%s rowcount=%s", name, entry["row_count"])
+        store.advance(name, current, tracker.high_water, run_id, staged=entry)
+        return entry, entry["row_count"]
+
+    return _extract_tables(pg_config, _selected_tables(tables), extract_one, max_workers, table_timeouts)
+
+
+def _extract_tables(
+    pg_config: PostgresConfig,
+    selected_tables: List[str],
+    extract_one: Callable[[Any, str], Tuple[Any, int]],
+    max_workers: int,
+    table_timeouts: Optional[Dict[str, float]],
+) -> Dict[str, Any]:
+    """
+    Run ``extract_one`` per table, serially or on a bounded connection pool.
+
+    Per-table timeouts are enforced server side through ``statement_timeout``
+    so a runaway query is cancelled by Postgres rather than left running.
+    """
+    timeouts = dict(table_timeouts or {})
+    latencies: Dict[str, float] = {}
+    results: Dict[str, Any] = {}
+
+    def timed(conn, name: str) -> Any:
+        started = time.perf_counter()
+        with metrics.stage("extract", name) as timer:
+            _set_statement_timeout(conn, timeouts.get(name, DEFAULT_TABLE_TIMEOUT))
+            result, rows = extract_one(conn, name)
+            timer.rows_out = rows
+            timer.bytes_moved = _result_bytes(result)
+        latencies[name] = time.perf_counter() - started
+        LOGGER.info("Extracted %s rows=%s seconds=%.2f", name, rows, latencies[name])
+        return result
+
+    # Every table is attempted even when another fails, so a retry only has
+    # the failed ones left to extract.
+    failures: Dict[str, BaseException] = {}
+    workers = max(1, min(max_workers, len(selected_tables)))
+    if workers == 1:
+        with get_postgres_conn(pg_config) as conn:
+            for name in selected_tables:
+                try:
+                    results[name] = timed(conn, name)
+                except Exception as exc:  # pylint: disable=broad-except
+                    LOGGER.error("Extraction failed for %s: %s", name, exc)
+                    failures[name] = exc
+                    conn.rollback()
+    else:
+        pool = get_postgres_pool(pg_config, maxconn=workers)
+        try:
+
+            def run(name: str) -> Any:
+                with pooled_postgres_conn(pool) as conn:
+                    return timed(conn, name)
+
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extract") as executor:
+                futures = {executor.submit(run, name): name for name in selected_tables}
+                for future in as_completed(futures):
+                    name = futures[future]
+                    try:
+                        results[name] = future.result()
+                    except Exception as exc:  # pylint: disable=broad-except
+                        LOGGER.error("Extraction failed for %s: %s", name, exc)
+                        failures[name] = exc
+        finally:
+            pool.closeall()
+    if failures:
+        raise RuntimeError(f"Extraction failed for tables {sorted(failures)}") from next(iter(failures.values()))
+
+    LOGGER.info(
+        "Extraction latency by table (slowest first): %s",
+        {name: round(seconds, 2) for name, seconds in sorted(latencies.items(), key=lambda item: -item[1])},
     )
+    return {name: results[name] for name in selected_tables}
+
+
+def _iter_table_chunks(
+    conn,
+    plan: QueryPlan,
+    itersize: int,
+    engines: Optional[Dict[str, str]],
+) -> Iterator[pd.DataFrame]:
+    engine = {**EXTRACTION_ENGINES, **(engines or {})}.get(plan.table, "cursor")
+    if engine == "copy":
+        chunks = iter_dataframes_from_copy(conn, plan.query, plan.params)
+    elif engine == "cursor":
+        chunks = iter_dataframes_from_query(conn, plan.query, plan.params, itersize=itersize)
+    else:
+        raise ValueError(f"Unknown extraction engine {engine} for {plan.table}")
+    # Compact dtypes per chunk; categories are built once the frame is whole
+    # (in memory) or when staged frames are read back.
+    return (apply_source_dtypes(plan.table, chunk, categories=False) for chunk in chunks)
+
+
+def _plan(
+    conn,
+    name: str,
+    lower: Optional[Bound],
+    upper: datetime,
+    projections: Optional[Dict[str, Sequence[str]]],
+    start: Optional[datetime] = None,
+) -> QueryPlan:
+    plan = plan_extraction(
+        name,
+        lower,
+        upper,
+        columns=(projections or {}).get(name),
+        available=source_columns(conn, name),
+        start=start,
+    )
+    LOGGER.debug("Extraction query for %s: %s params=%s", name, plan.query, plan.params)
+    return plan
+
+
+def _result_bytes(result: Any) -> int:
+    # Staged tables report their file size, in-memory frames their column size.
+    if isinstance(result, pd.DataFrame):
+        return metrics.frame_bytes(result)
+    path = Path(result.get("path", "")) if isinstance(result, dict) else None
+    return path.stat().st_size if path and path.is_file() else 0
 
 
+def _set_statement_timeout(conn, seconds: Optional[float]) -> None:
+    # SET LOCAL is scoped to the current transaction, which the named cursor
+    # of the following query runs in.
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL statement_timeout = %s", (int((seconds or 0) * 1000),))
+
+
+def _selected_tables(tables: Optional[Iterable[str]]) -> List[str]:
+    return list(tables or list(DIMENSION_TABLES.keys()) + list(FACT_TABLES.keys()))
+
+
+def _upper_bound(processing_date: str) -> datetime:
+    # Exclusive: everything modified up to the end of the processing date.
+    return datetime.fromisoformat(f"{processing_date}T00:00:00") + timedelta(days=1)
+
+
+def explain_incremental_queries(
+    processing_date: str,
+    pg_config: PostgresConfig,
+    tables: Optional[Iterable[str]] = None,
+    analyze: bool = False,
+    watermark_store: Optional[WatermarkStore] = None,
+    projections: Optional[Dict[str, Sequence[str]]] = None,
+) -> Dict[str, str]:
+    """
+    Return the ``EXPLAIN`` output of the queries the next extraction would run.
+
+    Watermarks are read but never advanced. With ``analyze`` the queries are
+    executed, inside a transaction that is rolled back.
+    """
+    store = watermark_store or WatermarkStore()
+    upper = _upper_bound(processing_date)
+    plans: Dict[str, str] = {}
+    with get_postgres_conn(pg_config) as conn:
+        try:
+            for name in _selected_tables(tables):
+                current = store.get(name)
+                plan = _plan(conn, name, current.bound if current else None, upper, projections)
+                plans[name] = f"{plan.query}\n{plan.explain(conn, analyze=analyze)}"
+        finally:
+            conn.rollback()
+    return plans
@@ -0,0 +1,180 @@
+"""
+Persistent natural-to-surrogate key cache for fact enrichment.
+"""
+
+from __future__ import annotations
+
+import os
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from clickhouse_driver import Client
+
+from utilities import METADATA_DIR, get_logger
+
+LOGGER = get_logger("key_cache")
+
+KEY_CACHE_DIR = Path(os.getenv("DWH_KEY_CACHE_DIR", str(METADATA_DIR / "key_cache")))
+
+# A dense natural-key-indexed array is used when the key range is at most this
+# many times the number of keys (AdventureWorks ids are near-contiguous).
+DENSE_SPAN_FACTOR = 4
+DENSE_MAX_SPAN = 1 << 26
+
+
+class SurrogateKeyCache:
+    """
+    Sorted ``(natural, surrogate)`` array pair for one dimension, kept on disk.
+
+    ``refresh`` pulls only current rows whose ``LoadedAt`` is on or after the
+    latest one already cached. ``LoadedAt`` is stamped by ClickHouse on
+    insert, so versions with a back-dated ``ValidFromDate`` (backfills, late
+    rows, reruns of earlier dates) are still picked up. ``resolve`` maps natural keys with a ``take`` from a
+    dense array when the key range is compact, else with ``searchsorted``.
+    """
+
+    def __init__(
+        self,
+        table: str,
+        surrogate: str,
+        natural: str,
+        cache_dir: Optional[Path] = None,
+    ) -> None:
+        self.table = table
+        self.surrogate = surrogate
+        self.natural = natural
+        self.cache_dir = cache_dir or KEY_CACHE_DIR
+        self.natural_keys = np.empty(0, dtype=np.int64)
+        self.surrogate_keys = np.empty(0, dtype=np.uint32)
+        self.loaded_at: Optional[datetime] = None
+        self._dense: Optional[np.ndarray] = None
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.natural_keys)
+
+    def refresh(self, client: Client, full: bool = False) -> "SurrogateKeyCache":
+        query = (
+            f"SELECT {self.natural}, {self.surrogate}, LoadedAt "
+            f"FROM {self.table} FINAL WHERE IsCurrent = 1"
+        )
+        params = {}
+        if self.loaded_at is not None and not full:
+            query += " AND LoadedAt >= %(since)s"
+            params["since"] = self.loaded_at
+        rows = client.execute(query, params, columnar=True)
+        if full:
+            self.natural_keys = np.empty(0, dtype=np.int64)
+            self.surrogate_keys = np.empty(0, dtype=np.uint32)
+            self.loaded_at = None
+            self._dense = None
+        if rows and len(rows[0]):
+            naturals, surrogates, loaded_at = rows
+            self._merge(np.asarray(naturals, dtype=np.int64), np.asarray(surrogates, dtype=np.uint32))
+            self.loaded_at = max(loaded_at)
+        if full or (rows and len(rows[0])):
+            self._save()
+        LOGGER.info(
+            "Key cache %s refreshed delta=%s size=%s",
+            self.table,
+            len(rows[0]) if rows else 0,
+            len(self),
+        )
+        return self
+
+    def resolve(self, natural_keys: pd.Series) -> pd.Series:
+        """
+        Map natural keys to surrogates; unknown or null keys come back as <NA>.
+        """
+        values = pd.to_numeric(natural_keys, errors="coerce")
+        present = values.notna().to_numpy()
+        lookup = values.fillna(0).astype("int64").to_numpy()
+
+        result = np.zeros(len(lookup), dtype=np.uint32)
+        found = np.zeros(len(lookup), dtype=bool)
+        dense = self._dense_table()
+        if dense is not None:
+            offsets = lookup - int(self.natural_keys[0])
+            in_range = present & (offsets >= 0) & (offsets < len(dense))
+            candidates = dense.take(np.where(in_range, offsets, 0))
+            found = in_range & (candidates >= 0)
+            result = np.where(found, candidates, 0).astype(np.uint32)
+        elif len(self.natural_keys):
+            positions = np.searchsorted(self.natural_keys, lookup)
+            positions = np.minimum(positions, len(self.natural_keys) - 1)
+            found = present & (self.natural_keys[positions] == lookup)
+            result = np.where(found, self.surrogate_keys[positions], 0).astype(np.uint32)
+        return pd.Series(pd.arrays.IntegerArray(result, ~found), index=natural_keys.index, dtype="UInt32")
+
+    def invalidate(self) -> None:
+        path = self._path()
+        if path.exists():
+            path.unlink()
+        self.natural_keys = np.empty(0, dtype=np.int64)
+        self.surrogate_keys = np.empty(0, dtype=np.uint32)
+        self.loaded_at = None
+        self._dense = None
+
+    def _dense_table(self) -> Optional[np.ndarray]:
+        if self._dense is not None or not len(self.natural_keys):
+            return self._dense
+        span = int(self.natural_keys[-1]) - int(self.natural_keys[0]) + 1
+        if span > DENSE_MAX_SPAN or span > DENSE_SPAN_FACTOR * len(self.natural_keys):
+            return None
+        dense = np.full(span, -1, dtype=np.int64)
+        dense[self.natural_keys - self.natural_keys[0]] = self.surrogate_keys
+        self._dense = dense
+        return dense
+
+    def _merge(self, naturals: np.ndarray, surrogates: np.ndarray) -> None:
+        # Stable sort keeps cached entries ahead of refreshed ones for equal
+        # keys, so taking the last of each run lets the newer surrogate win.
+        all_naturals = np.concatenate([self.natural_keys, naturals])
+        all_surrogates = np.concatenate([self.surrogate_keys, surrogates])
+        order = np.argsort(all_naturals, kind="stable")
+        all_naturals = all_naturals[order]
+        all_surrogates = all_surrogates[order]
+        keep = np.append(all_naturals[1:] != all_naturals[:-1], True)
+        self.natural_keys = all_naturals[keep]
+        self.surrogate_keys = all_surrogates[keep]
+        self._dense = None
+
+    def _path(self) -> Path:
+        return (self.cache_dir / self.table).with_suffix(".npz")
+
+    def _load(self) -> None:
+        path = self._path()
+        if not path.exists():
+            return
+        with np.load(path) as data:
+            if "loaded_at" not in data:
+                # Written before the LoadedAt watermark; rebuilt by a full refresh.
+                return
+            self.natural_keys = data["natural"]
+            self.surrogate_keys = data["surrogate"]
+            loaded_at = str(data["loaded_at"])
+        self.loaded_at = datetime.fromisoformat(loaded_at) if loaded_at else None
+
+    def _save(self) -> None:
+        # Concurrent mapped fact tasks refresh the same dimension: each writes
+        # one archive under its own tmp name and swaps it in with a single
+        # rename, so readers never mix keys from two generations.
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path()
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        try:
+            with tmp_path.open("wb") as handle:
+                np.savez(
+                    handle,
+                    natural=np.ascontiguousarray(self.natural_keys),
+                    surrogate=np.ascontiguousarray(self.surrogate_keys),
+                    loaded_at=np.array(self.loaded_at.isoformat() if self.loaded_at else ""),
+                )
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
@@ -4,17 +4,218 @@ Loading logic for ClickHouse targets.
 
 from __future__ import annotations
 
+import os
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Dict, Tuple
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple, Union
 
 import pandas as pd
 
-from error_handling import log_error_record
-from transformation import build_fact_payload, detect_scd2_changes
-from utilities import ClickHouseConfig, get_clickhouse_client, get_logger
+import bulk_insert
+import metrics
+
+from aggregation import AGGREGATES, date_key, refresh_aggregates, touched_date_keys
+from error_handling import ErrorRecordWriter
+from key_cache import SurrogateKeyCache
+from transformation import (
+    ROW_HASH_COLUMN,
+    build_fact_payload,
+    compute_row_hash,
+    detect_scd2_changes,
+    detect_scd2_changes_by_hash,
+)
+from utilities import (
+    ClickHouseConfig,
+    get_clickhouse_client,
+    get_clickhouse_manager,
+    get_logger,
+    get_processing_batch_id,
+    insert_dataframe_columnar,
+)
 
 LOGGER = get_logger("loading")
 
+# How SCD2 expiry is applied: "mutation" issues one ALTER ... UPDATE per block
+# of changed keys, "insert" writes expired copies of the current rows and lets
+# ReplacingMergeTree(ValidFromDate) collapse them (readers must use FINAL).
+SCD2_APPLY_MODE = os.getenv("DWH_SCD2_APPLY_MODE", "mutation")
+# Keeps each IN (...) list well under ClickHouse's default max_query_size.
+MUTATION_KEY_CHUNK = 20_000
+
+
+@dataclass(frozen=True)
+class DimensionLookup:
+    """
+    Natural-to-surrogate key lookup on one dimension.
+
+    SCD2 dimensions go through a persistent ``SurrogateKeyCache``; static
+    dimensions without ``ValidFromDate``/``IsCurrent`` (``scd=False``) are
+    read whole into a dict.
+    """
+
+    table: str
+    surrogate: str
+    natural: str
+    scd: bool = True
+
+    def load(self, client) -> Union[Dict[int, int], SurrogateKeyCache]:
+        if self.scd:
+            return SurrogateKeyCache(self.table, self.surrogate, self.natural).refresh(client)
+        rows = client.execute(f"SELECT {self.natural}, {self.surrogate} FROM {self.table}")
+        return dict(rows)
+
+
+DIMENSION_LOOKUPS: Dict[str, DimensionLookup] = {
+    "customer": DimensionLookup("DimCustomer", "CustomerKey", "CustomerID"),
+    "product": DimensionLookup("DimProduct", "ProductKey", "ProductID"),
+    "store": DimensionLookup("DimStore", "StoreKey", "StoreID"),
+    "employee": DimensionLookup("DimEmployee", "EmployeeKey", "EmployeeID"),
+    "vendor": DimensionLookup("DimVendor", "VendorKey", "VendorID"),
+    "warehouse": DimensionLookup("DimWarehouse", "WarehouseKey", "WarehouseID"),
+    "return_reason": DimensionLookup("DimReturnReason", "ReturnReasonKey", "ReturnReasonID", scd=False),
+}
+
+
+@dataclass(frozen=True)
+class DimensionSpec:
+    """
+    How one extracted frame is loaded into an SCD2 dimension.
+
+    ``tracked_columns`` maps each attribute whose change opens a new version
+    to its hash type (see ``transformation.compute_row_hash``).
+    """
+
+    name: str
+    source: str
+    table: str
+    natural_key: str
+    tracked_columns: Mapping[str, str]
+
+    @property
+    def current_query(self) -> str:
+        """The (natural key, RowHash) snapshot of current rows the change detection compares against."""
+        return f"SELECT {self.natural_key}, {ROW_HASH_COLUMN} FROM {self.table} FINAL WHERE IsCurrent = 1"
+
+
+DIMENSION_SPECS: Dict[str, DimensionSpec] = {
+    "customer": DimensionSpec(
+        name="customer",
+        source="customer",
+        table="DimCustomer",
+        natural_key="CustomerID",
+        tracked_columns={
+            "CustomerName": "string",
+            "Email": "string",
+            "City": "string",
+            "Country": "string",
+            "CustomerSegment": "string",
+            "AccountStatus": "string",
+        },
+    ),
+    "product": DimensionSpec(
+        name="product",
+        source="product",
+        table="DimProduct",
+        natural_key="ProductID",
+        tracked_columns={
+            "ListPrice": "decimal",
+            "Cost": "decimal",
+            "Category": "string",
+            "ProductStatus": "string",
+        },
+    ),
+    "store": DimensionSpec(
+        name="store",
+        source="store",
+        table="DimStore",
+        natural_key="StoreID",
+        tracked_columns={
+            "Address": "string",
+            "Region": "string",
+            "Territory": "string",
+            "ManagerName": "string",
+            "StoreStatus": "string",
+        },
+    ),
+    "employee": DimensionSpec(
+        name="employee",
+        source="employee",
+        table="DimEmployee",
+        natural_key="EmployeeID",
+        tracked_columns={
+            "JobTitle": "string",
+            "Department": "string",
+            "Region": "string",
+            "Territory": "string",
+            "SalesQuota": "decimal",
+        },
+    ),
+}
+
+
+@dataclass(frozen=True)
+class FactSpec:
+    """
+    How one extracted frame is loaded into a fact table.
+
+    ``fk_columns`` maps a ``DIMENSION_LOOKUPS`` name to the fact column that
+    holds its natural key on extraction and its surrogate key once loaded.
+    ``aggregates`` names the ``aggregation.AGGREGATES`` entries (refreshed
+    with their rollups) that read this fact's ``date_column``.
+    """
+
+    name: str
+    source: str
+    date_column: str
+    fk_columns: Mapping[str, str]
+    aggregates: Tuple[str, ...] = ()
+
+    def lookup_maps(self, client) -> Dict[str, Union[Dict[int, int], SurrogateKeyCache]]:
+        return {lookup: DIMENSION_LOOKUPS[lookup].load(client) for lookup in self.fk_columns}
+
+
+# One mapped load task is generated per entry; a new fact only needs a spec
+# here, its extraction in query_planner and its DDL.
+FACT_SPECS: Dict[str, FactSpec] = {
+    "FactSales": FactSpec(
+        name="FactSales",
+        source="FactSales",
+        date_column="SalesDateKey",
+        fk_columns={
+            "customer": "CustomerKey",
+            "product": "ProductKey",
+            "store": "StoreKey",
+            "employee": "EmployeeKey",
+        },
+        aggregates=("agg_daily_sales_state", "agg_monthly_product_performance"),
+    ),
+    "FactPurchases": FactSpec(
+        name="FactPurchases",
+        source="FactPurchases",
+        date_column="PurchaseDateKey",
+        fk_columns={"product": "ProductKey", "vendor": "VendorKey"},
+    ),
+    "FactInventory": FactSpec(
+        name="FactInventory",
+        source="FactInventory",
+        date_column="InventoryDateKey",
+        fk_columns={"product": "ProductKey", "store": "StoreKey", "warehouse": "WarehouseKey"},
+    ),
+    "FactReturns": FactSpec(
+        name="FactReturns",
+        source="FactReturns",
+        date_column="ReturnDateKey",
+        fk_columns={
+            "product": "ProductKey",
+            "customer": "CustomerKey",
+            "store": "StoreKey",
+            "return_reason": "ReturnReasonKey",
+        },
+        # Returns feed the monthly product performance rollup only.
+        aggregates=("agg_monthly_product_performance",),
+    ),
+}
+
 
 def load_dimension_scd2(
     dimension: str,
@@ -24,17 +225,65 @@ def load_dimension_scd2(
     tracked_columns: Dict[str, str],
     processing_date: str,
     ch_config: ClickHouseConfig,
+    apply_mode: Optional[str] = None,
 ) -> Tuple[int, int]:
     """
     Apply SCD type 2 logic.
+
+    When ``current_df`` is a ``(natural_key, RowHash)`` snapshot, changes are
+    detected by hash and changed keys get a new version inserted after their
+    current one is expired. Otherwise the full snapshot is compared column by
+    column.
     """
-    diffs = detect_scd2_changes(current_df, incoming_df, natural_key, list(tracked_columns.keys()))
-    inserted = _insert_dimension_rows(dimension, diffs.inserts, processing_date, ch_config)
-    updated = _expire_dimension_rows(dimension, diffs.updates, processing_date, ch_config, natural_key)
+    apply_mode = apply_mode or SCD2_APPLY_MODE
+    if ROW_HASH_COLUMN not in current_df.columns:
+        with metrics.stage("scd_diff", dimension, rows_in=len(incoming_df)) as timer:
+            diffs = detect_scd2_changes(current_df, incoming_df, natural_key, list(tracked_columns.keys()))
+            timer.rows_out = len(diffs.inserts) + len(diffs.updates)
+        inserted = _insert_dimension_rows(dimension, diffs.inserts, processing_date, ch_config)
+        updated = _expire_dimension_rows(
+            dimension, diffs.updates, processing_date, ch_config, natural_key, apply_mode
+        )
+        LOGGER.info("Dimension %s load complete inserted=%s updated=%s", dimension, inserted, updated)
+        return inserted, updated
+
+    current_df = _backfill_row_hashes(dimension, current_df, incoming_df, natural_key, tracked_columns, ch_config)
+    with metrics.stage("scd_diff", dimension, rows_in=len(incoming_df)) as timer:
+        diffs = detect_scd2_changes_by_hash(current_df, incoming_df, natural_key, tracked_columns)
+        timer.rows_out = len(diffs.inserts) + len(diffs.updates)
+    # Expire before inserting so a mutation cannot close the new versions.
+    updated = _expire_dimension_rows(dimension, diffs.updates, processing_date, ch_config, natural_key, apply_mode)
+    inserted = _insert_dimension_rows(
+        dimension,
+        pd.concat([diffs.inserts, diffs.updates], ignore_index=True),
+        processing_date,
+        ch_config,
+    )
     LOGGER.info("Dimension %s load complete inserted=%s updated=%s", dimension, inserted, updated)
     return inserted, updated
 
 
+def load_dimension_spec(
+    spec: DimensionSpec,
+    current_df: pd.DataFrame,
+    incoming_df: pd.DataFrame,
+    processing_date: str,
+    ch_config: ClickHouseConfig,
+    apply_mode: Optional[str] = None,
+) -> Tuple[int, int]:
+    """Run ``load_dimension_scd2`` for one registered dimension."""
+    return load_dimension_scd2(
+        spec.table,
+        current_df,
+        incoming_df,
+        natural_key=spec.natural_key,
+        tracked_columns=dict(spec.tracked_columns),
+        processing_date=processing_date,
+        ch_config=ch_config,
+        apply_mode=apply_mode,
+    )
+
+
 def load_dimension_scd1(
     dimension: str,
     incoming_df: pd.DataFrame,
@@ -42,70 +291,130 @@ def load_dimension_scd1(
 ) -> int:
     LOGGER.info("Upserting SCD1 dimension %s", dimension)
     client = get_clickhouse_client(ch_config)
-    rows = incoming_df.to_dict("records")
-    if rows:
-        client.insert(dimension, rows)
-    return len(rows)
+    return insert_dataframe_columnar(client, dimension, incoming_df)
 
 
 def load_fact_table(
     fact_name: str,
     fact_df: pd.DataFrame,
-    lookup_maps: Dict[str, Dict[int, int]],
+    lookup_maps: Mapping[str, Union[Dict[int, int], SurrogateKeyCache]],
     fk_columns: Dict[str, str],
     ch_config: ClickHouseConfig,
     processing_batch_id: str,
+    target: Optional[str] = None,
 ) -> Tuple[int, int]:
     """
     Load fact data, tracking failed rows.
+
+    Rows go to ``target`` when given (e.g. a partition-swap staging table),
+    otherwise to ``fact_name``, as partition-aligned blocks deduplicated by
+    ``processing_batch_id`` (see ``bulk_insert.insert_frame``). Staging
+    targets are refilled from scratch on a rerun, so they are not
+    deduplicated.
     """
     if fact_df.empty:
         return 0, 0
     enriched = build_fact_payload(fact_name, fact_df, lookup_maps, fk_columns)
-    success_rows = []
-    error_rows = 0
     client = get_clickhouse_client(ch_config)
 
-    for idx, row in enriched.iterrows():
-        if row.isnull().any():
-            log_error_record(
-                client=client,
-                error_type="ForeignKeyMissing",
-                error_message=f"Null FK in {fact_name}",
-                failed_data=row.to_dict(),
-                source_table=fact_name,
-                natural_key=str(idx),
-                processing_batch_id=processing_batch_id,
-                task_name="load_fact_tables",
-                is_recoverable=True,
-            )
-            error_rows += 1
-            continue
-        success_rows.append(row.to_dict())
+    # Only unresolved FKs are recoverable; other columns may be NULL by design.
+    present = [column for column in fk_columns.values() if column in enriched]
+    error_mask = enriched[present].isna().any(axis=1).to_numpy()
+    with ErrorRecordWriter(client) as error_writer:
+        # Keep the source rows, not the enriched ones: their natural keys are
+        # what error_handling.reprocess_foreign_key_errors resolves again.
+        error_rows = error_writer.add_frame(
+            error_type="ForeignKeyMissing",
+            error_message=f"Null FK in {fact_name}",
+            failed_rows=fact_df[error_mask],
+            source_table=fact_name,
+            processing_batch_id=processing_batch_id,
+            task_name="load_fact_tables",
+            is_recoverable=True,
+        )
+
+    success = enriched[~error_mask]
+    # Unresolved lookups turn the FK columns into floats; restore the UInt32 keys.
+    success = success.astype({column: "uint32" for column in present})
+    with metrics.stage("fact_insert", fact_name, rows_in=len(fact_df)) as timer:
+        spec = FACT_SPECS.get(fact_name)
+        inserted = bulk_insert.insert_frame(
+            get_clickhouse_manager(ch_config),
+            target or fact_name,
+            success,
+            processing_batch_id,
+            partition_column=spec.date_column if spec else None,
+            deduplicate=False if target else None,
+        )
+        timer.rows_out = inserted
+        timer.bytes_moved = metrics.frame_bytes(success)
+    return inserted, error_rows
+
+
+def load_fact_spec(
+    spec: FactSpec,
+    fact_df: pd.DataFrame,
+    ch_config: ClickHouseConfig,
+    processing_batch_id: str,
+    target: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Load one registered fact and report what it touched.
 
-    if success_rows:
-        client.insert(fact_name, success_rows)
-    return len(success_rows), error_rows
+    Returns the inserted and failed row counts and the distinct date keys of
+    the loaded rows, for the aggregate refresh.
+    """
+    if fact_df.empty:
+        inserted, failed = 0, 0
+    else:
+        client = get_clickhouse_client(ch_config)
+        inserted, failed = load_fact_table(
+            spec.name,
+            fact_df,
+            spec.lookup_maps(client),
+            dict(spec.fk_columns),
+            ch_config,
+            processing_batch_id,
+            target=target,
+        )
+    LOGGER.info("Fact %s loaded inserted=%s failed=%s", spec.name, inserted, failed)
+    return {
+        "fact": spec.name,
+        "inserted": inserted,
+        "failed": failed,
+        "date_keys": touched_date_keys(fact_df, spec.date_column),
+    }
 
 
-def update_aggregates(processing_date: str, ch_config: ClickHouseConfig) -> None:
+def update_aggregates(
+    processing_date: str,
+    ch_config: ClickHouseConfig,
+    touched: Optional[Mapping[str, Iterable[int]]] = None,
+    full_partition: bool = False,
+) -> Dict[str, List[int]]:
+    """
+    Rebuild the aggregates fed by each fact for the date keys its load touched.
+
+    ``touched`` maps fact names to date keys; it defaults to the processing
+    date's key for FactSales when the touched keys are unknown.
+    ``full_partition`` is passed on to ``aggregation.refresh_aggregates``.
+    """
     client = get_clickhouse_client(ch_config)
-    query = """
-        INSERT INTO agg_daily_sales
-        SELECT
-            SalesDateKey,
-            StoreKey,
-            ProductCategoryKey,
-            SUM(SalesAmount),
-            SUM(Quantity),
-            SUM(DiscountAmount),
-            COUNT()
-        FROM FactSales
-        WHERE SalesDateKey = toUInt32(toDate(%(date)s))
-        GROUP BY SalesDateKey, StoreKey, ProductCategoryKey
-    """
-    client.execute(query, {"date": processing_date})
-    LOGGER.info("Aggregates updated for %s", processing_date)
+    if touched is None:
+        touched = {"FactSales": [date_key(processing_date)]}
+    refreshed: Dict[str, List[int]] = {}
+    for fact_name, date_keys in touched.items():
+        keys = list(date_keys)
+        if not keys:
+            continue
+        for aggregate in FACT_SPECS[fact_name].aggregates:
+            spec = AGGREGATES[aggregate]
+            for table, partitions in refresh_aggregates(
+                client, spec.source, keys, aggregates=[aggregate], full_partition=full_partition
+            ).items():
+                refreshed[table] = sorted(set(refreshed.get(table, [])) | set(partitions))
+        LOGGER.info("Aggregates updated for %s fact=%s date_keys=%s", processing_date, fact_name, len(keys))
+    return refreshed
 
 
 def _insert_dimension_rows(
@@ -117,12 +426,16 @@ def _insert_dimension_rows(
     if df.empty:
         return 0
     df = df.copy()
-    df["ValidFromDate"] = processing_date
+    df["ValidFromDate"] = datetime.fromisoformat(processing_date).date()
     df["ValidToDate"] = None
     df["IsCurrent"] = 1
-    client = get_clickhouse_client(ch_config)
-    client.insert(dimension, df.to_dict("records"))
-    return len(df)
+    return bulk_insert.insert_frame(
+        get_clickhouse_manager(ch_config),
+        dimension,
+        df,
+        get_processing_batch_id(processing_date, dimension),
+        partition_column="ValidFromDate",
+    )
 
 
 def _expire_dimension_rows(
@@ -131,16 +444,96 @@ def _expire_dimension_rows(
     processing_date: str,
     ch_config: ClickHouseConfig,
     natural_key: str,
+    apply_mode: str = "mutation",
 ) -> int:
+    """
+    Close the current version of every changed key as one set-based operation.
+    """
     if df.empty:
         return 0
     client = get_clickhouse_client(ch_config)
-    expire_date = datetime.fromisoformat(processing_date) - timedelta(days=1)
-    for _, row in df.iterrows():
+    expire_date = (datetime.fromisoformat(processing_date) - timedelta(days=1)).date()
+    key_list = df[natural_key].drop_duplicates().tolist()
+
+    if apply_mode == "insert":
+        expired = _fetch_current_rows(client, dimension, natural_key, key_list)
+        expired["ValidToDate"] = expire_date
+        expired["IsCurrent"] = 0
+        bulk_insert.insert_frame(
+            get_clickhouse_manager(ch_config),
+            dimension,
+            expired,
+            get_processing_batch_id(processing_date, f"{dimension}_expire"),
+            partition_column="ValidFromDate",
+        )
+        return len(key_list)
+
+    if apply_mode != "mutation":
+        raise ValueError(f"Unknown SCD2 apply mode {apply_mode}")
+    for start in range(0, len(key_list), MUTATION_KEY_CHUNK):
         client.execute(
-            f"ALTER TABLE {dimension} UPDATE ValidToDate=%(date)s, IsCurrent=0 WHERE {natural_key}=%(key)s AND IsCurrent=1",
-            {"date": expire_date.date(), "key": row[natural_key]},
+            f"ALTER TABLE {dimension} UPDATE ValidToDate=%(date)s, IsCurrent=0 "
+            f"WHERE IsCurrent=1 AND ValidFromDate < %(valid_from)s AND {natural_key} IN %(keys)s",
+            {
+                "date": expire_date,
+                "valid_from": datetime.fromisoformat(processing_date).date(),
+                "keys": tuple(key_list[start : start + MUTATION_KEY_CHUNK]),
+            },
         )
-    return len(df)
+    return len(key_list)
 
 
+def _fetch_current_rows(client, dimension: str, natural_key: str, keys: List[Any]) -> pd.DataFrame:
+    frames = []
+    for start in range(0, len(keys), MUTATION_KEY_CHUNK):
+        data, columns = client.execute(
+            f"SELECT * FROM {dimension} FINAL WHERE IsCurrent = 1 AND {natural_key} IN %(keys)s",
+            {"keys": tuple(keys[start : start + MUTATION_KEY_CHUNK])},
+            with_column_types=True,
+        )
+        frames.append(pd.DataFrame(data, columns=[column[0] for column in columns]))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def _backfill_row_hashes(
+    dimension: str,
+    current_df: pd.DataFrame,
+    incoming_df: pd.DataFrame,
+    natural_key: str,
+    tracked_columns: Dict[str, str],
+    ch_config: ClickHouseConfig,
+) -> pd.DataFrame:
+    """
+    Persist hashes for current rows loaded before RowHash existed (stored as 0).
+
+    The rows are rewritten with the same sorting key and version, so
+    ReplacingMergeTree replaces them without a mutation. This only runs until
+    every current row carries a hash.
+
+    Stored rows hold ``""``/``0`` where the source had NULL, so their hash
+    cannot tell NULLs apart. When an incoming row hashes like the stored one
+    with NULLs ignored, its NULL-aware hash is persisted instead, so an
+    unchanged member is not mistaken for a changed one.
+    """
+    missing = current_df[ROW_HASH_COLUMN] == 0
+    if not missing.any():
+        return current_df
+    client = get_clickhouse_client(ch_config)
+    rows = _fetch_current_rows(client, dimension, natural_key, current_df.loc[missing, natural_key].tolist())
+    rows[ROW_HASH_COLUMN] = compute_row_hash(rows, tracked_columns).to_numpy(dtype="uint64")
+    incoming = incoming_df.drop_duplicates(natural_key, keep="last").set_index(natural_key)
+    plain = compute_row_hash(incoming, tracked_columns, null_aware=False).to_numpy(dtype="uint64")
+    aware = compute_row_hash(incoming, tracked_columns).to_numpy(dtype="uint64")
+    positions = incoming.index.get_indexer(rows[natural_key])
+    same = positions >= 0
+    same[same] = plain[positions[same]] == rows[ROW_HASH_COLUMN].to_numpy()[same]
+    rows.loc[same, ROW_HASH_COLUMN] = aware[positions[same]]
+    insert_dataframe_columnar(client, dimension, rows)
+    LOGGER.info("Backfilled %s row hashes for %s", len(rows), dimension)
+    return pd.concat(
+        [
+            current_df.loc[~missing, [natural_key, ROW_HASH_COLUMN]].astype({ROW_HASH_COLUMN: "uint64"}),
+            rows[[natural_key, ROW_HASH_COLUMN]],
+        ],
+        ignore_index=True,
+    )
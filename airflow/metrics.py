@@ -0,0 +1,287 @@
+"""
+Per-stage ETL metrics, persisted to ClickHouse and an OpenMetrics text file.
+"""
+
+from __future__ import annotations
+
+import functools
+import inspect
+import os
+import re
+import resource
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import astuple, dataclass, field, fields
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from utilities import METADATA_DIR, get_logger
+
+LOGGER = get_logger("metrics")
+
+METRICS_TABLE = "etl_run_metrics"
+# One <task>.prom file per task under <dir>/<run_id>/, for a textfile collector.
+METRICS_DIR = Path(os.getenv("DWH_METRICS_DIR", str(METADATA_DIR / "metrics")))
+# Buffered records are written once this many are pending, and at task end.
+METRICS_BATCH_SIZE = 500
+
+_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+# ru_maxrss is in kilobytes on Linux and bytes on macOS.
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+@dataclass
+class StageMetric:
+    """One timed stage; field order matches the etl_run_metrics columns."""
+
+    RunID: str
+    TaskName: str
+    Stage: str
+    TableName: str
+    StartedAt: datetime
+    WallSeconds: float = 0.0
+    CpuSeconds: float = 0.0
+    RowsIn: int = 0
+    RowsOut: int = 0
+    BytesMoved: int = 0
+    PeakRssBytes: int = 0
+    Hostname: str = field(default_factory=socket.gethostname)
+
+
+class MetricsRecorder:
+    """
+    Buffers stage metrics for the current task and flushes them in batches.
+
+    ``sink`` receives each batch (normally a ClickHouse insert); everything
+    recorded is also kept for the task's OpenMetrics file.
+    """
+
+    def __init__(self) -> None:
+        self.run_id = ""
+        self.task_name = ""
+        self.sink: Optional[Callable[[List[StageMetric]], None]] = None
+        self._pending: List[StageMetric] = []
+        self._recorded: List[StageMetric] = []
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        """True inside ``collect``; stages outside a task are not recorded."""
+        return bool(self.task_name)
+
+    def record(self, metric: StageMetric) -> None:
+        with self._lock:
+            self._pending.append(metric)
+            self._recorded.append(metric)
+            full = len(self._pending) >= METRICS_BATCH_SIZE
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch or self.sink is None:
+            return 0
+        try:
+            self.sink(batch)
+        except Exception as exc:  # pylint: disable=broad-except
+            # Metrics must never fail the load they describe.
+            LOGGER.warning("Dropped %s stage metrics: %s", len(batch), exc)
+            return 0
+        return len(batch)
+
+    def recorded(self) -> List[StageMetric]:
+        with self._lock:
+            return list(self._recorded)
+
+    def reset(self, run_id: str = "", task_name: str = "", sink=None) -> None:
+        with self._lock:
+            self.run_id = run_id
+            self.task_name = task_name
+            self.sink = sink
+            self._pending = []
+            self._recorded = []
+
+
+RECORDER = MetricsRecorder()
+
+
+class StageTimer:
+    """Handle yielded by ``stage``; set ``rows_out``/``bytes_moved`` before the block ends."""
+
+    def __init__(self, rows_in: Optional[int]) -> None:
+        self.rows_in = rows_in or 0
+        self.rows_out = 0
+        self.bytes_moved = 0
+
+
+@contextmanager
+def stage(name: str, table: str = "", rows_in: Optional[int] = None) -> Iterator[StageTimer]:
+    """
+    Time a block as stage ``name`` of ``table`` and record it on exit.
+
+    CPU time is the process's, so stages running concurrently on threads
+    (parallel extraction) overlap; peak RSS is the process high-water mark
+    at the end of the stage.
+    """
+    timer = StageTimer(rows_in)
+    if not RECORDER.active:
+        yield timer
+        return
+    started_at = datetime.utcnow()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield timer
+    finally:
+        RECORDER.record(
+            StageMetric(
+                RunID=RECORDER.run_id,
+                TaskName=RECORDER.task_name,
+                Stage=name,
+                TableName=table,
+                StartedAt=started_at,
+                WallSeconds=time.perf_counter() - wall_start,
+                CpuSeconds=time.process_time() - cpu_start,
+                RowsIn=int(timer.rows_in),
+                RowsOut=int(timer.rows_out),
+                BytesMoved=int(timer.bytes_moved),
+                PeakRssBytes=peak_rss_bytes(),
+            )
+        )
+
+
+def timed_stage(name: str, table_arg: Optional[str] = None) -> Callable:
+    """
+    Decorator form of ``stage``.
+
+    ``table_arg`` names the parameter holding the table name. A DataFrame
+    result sets ``rows_out`` and ``bytes_moved``; an int result sets
+    ``rows_out``.
+    """
+
+    def decorate(fn: Callable) -> Callable:
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            table = ""
+            if table_arg:
+                table = signature.bind_partial(*args, **kwargs).arguments.get(table_arg, "")
+            with stage(name, str(table)) as timer:
+                result = fn(*args, **kwargs)
+                if isinstance(result, pd.DataFrame):
+                    timer.rows_out = len(result)
+                    timer.bytes_moved = frame_bytes(result)
+                elif isinstance(result, int):
+                    timer.rows_out = result
+                return result
+
+        return wrapper
+
+    return decorate
+
+
+@contextmanager
+def collect(run_id: str, task_name: str, client_factory: Optional[Callable[[], Any]] = None) -> Iterator[MetricsRecorder]:
+    """
+    Scope metrics to one task: buffer, batch-insert into ``etl_run_metrics``
+    through ``client_factory()``'s client and write the OpenMetrics file on exit.
+    """
+    sink = None
+    if client_factory is not None:
+
+        def sink(batch: List[StageMetric]) -> None:
+            insert_metrics(client_factory(), batch)
+
+    RECORDER.reset(run_id, task_name, sink)
+    try:
+        yield RECORDER
+    finally:
+        RECORDER.flush()
+        try:
+            write_openmetrics(RECORDER.recorded(), openmetrics_path(run_id, task_name))
+        except OSError as exc:
+            LOGGER.warning("Could not write OpenMetrics file: %s", exc)
+        RECORDER.reset()
+
+
+def insert_metrics(client, batch: List[StageMetric]) -> int:
+    columns = [column.name for column in fields(StageMetric)]
+    rows = [astuple(metric) for metric in batch]
+    client.execute(
+        f"INSERT INTO {METRICS_TABLE} ({', '.join(columns)}) VALUES",
+        [list(values) for values in zip(*rows)],
+        columnar=True,
+    )
+    return len(batch)
+
+
+def openmetrics_path(run_id: str, task_name: str, metrics_dir: Optional[Path] = None) -> Path:
+    return (metrics_dir or METRICS_DIR) / _UNSAFE_CHARS.sub("_", run_id) / f"{_UNSAFE_CHARS.sub('_', task_name)}.prom"
+
+
+def write_openmetrics(records: List[StageMetric], path: Path) -> Path:
+    """
+    Write ``records`` as OpenMetrics gauges, summed per stage and table.
+
+    Peak RSS is the maximum rather than the sum. The file is replaced
+    atomically so a collector never reads a partial one.
+    """
+    totals: Dict[Tuple[str, str, str, str], Dict[str, float]] = {}
+    for metric in records:
+        key = (metric.RunID, metric.TaskName, metric.Stage, metric.TableName)
+        total = totals.setdefault(key, dict.fromkeys(_OPENMETRICS_FIELDS, 0))
+        for name, attribute in _OPENMETRICS_FIELDS.items():
+            value = getattr(metric, attribute)
+            total[name] = max(total[name], value) if attribute == "PeakRssBytes" else total[name] + value
+
+    lines: List[str] = []
+    for name in _OPENMETRICS_FIELDS:
+        lines.append(f"# TYPE dwh_etl_stage_{name} gauge")
+        for (run_id, task_name, stage_name, table), total in totals.items():
+            labels = ",".join(
+                f'{label}="{_escape(value)}"'
+                for label, value in (("run_id", run_id), ("task", task_name), ("stage", stage_name), ("table", table))
+            )
+            lines.append(f"dwh_etl_stage_{name}{{{labels}}} {_format(total[name])}")
+    lines.append("# EOF")
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".prom.tmp")
+    tmp.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    os.replace(tmp, path)
+    return path
+
+
+def frame_bytes(df: pd.DataFrame) -> int:
+    """In-memory size of ``df``'s columns, without the deep object scan."""
+    return int(df.memory_usage(index=False).sum())
+
+
+def peak_rss_bytes() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+
+
+_OPENMETRICS_FIELDS = {
+    "wall_seconds": "WallSeconds",
+    "cpu_seconds": "CpuSeconds",
+    "rows_in": "RowsIn",
+    "rows_out": "RowsOut",
+    "bytes": "BytesMoved",
+    "peak_rss_bytes": "PeakRssBytes",
+}
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else f"{value:.6f}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,171 @@
+"""
+Opt-in profiling of DAG task callables: cProfile, tracemalloc and a sampler.
+"""
+
+from __future__ import annotations
+
+import cProfile
+import io
+import os
+import pstats
+import re
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterator, Mapping, Optional, Tuple
+
+from utilities import METADATA_DIR, get_logger
+
+LOGGER = get_logger("profiling")
+
+# Artifacts land in <dir>/<run_id>/<task>.*, beside the run's metrics files.
+PROFILE_DIR = Path(os.getenv("DWH_PROFILE_DIR", str(METADATA_DIR / "profiles")))
+DEFAULT_TOP_N = 25
+# Frames kept per tracemalloc allocation; deeper stacks cost more memory.
+TRACEMALLOC_FRAMES = 10
+SAMPLER_INTERVAL_SECONDS = 0.001
+
+_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+@dataclass(frozen=True)
+class ProfileOptions:
+    """
+    What to profile for one task.
+
+    ``tasks`` restricts profiling to those task ids (all tasks when empty).
+    ``sampler`` runs pyinstrument instead of cProfile: both hook the
+    interpreter's profile function, so only one of them can run at a time.
+    """
+
+    enabled: bool = False
+    tasks: Tuple[str, ...] = ()
+    tracemalloc: bool = True
+    sampler: bool = False
+    top_n: int = DEFAULT_TOP_N
+
+    @classmethod
+    def from_setting(cls, setting: Any) -> "ProfileOptions":
+        """
+        Parse a ``profile`` setting: ``true``/``false``, or a mapping such as
+        ``{"tasks": ["load_fact_tables"], "tracemalloc": false, "sampler": true, "top_n": 40}``.
+        """
+        if not setting:
+            return cls()
+        if not isinstance(setting, Mapping):
+            return cls(enabled=True)
+        tasks = setting.get("tasks") or ()
+        return cls(
+            enabled=bool(setting.get("enabled", True)),
+            tasks=(tasks,) if isinstance(tasks, str) else tuple(tasks),
+            tracemalloc=bool(setting.get("tracemalloc", True)),
+            sampler=bool(setting.get("sampler", False)),
+            top_n=int(setting.get("top_n", DEFAULT_TOP_N)),
+        )
+
+    def applies_to(self, task_id: str) -> bool:
+        return self.enabled and (not self.tasks or task_id in self.tasks)
+
+
+def resolve_options(conf: Optional[Mapping[str, Any]], variable_setting: Any = None) -> ProfileOptions:
+    """``dag_run.conf["profile"]`` when the run sets it, else the Variable's setting."""
+    if conf and "profile" in conf:
+        return ProfileOptions.from_setting(conf["profile"])
+    return ProfileOptions.from_setting(variable_setting)
+
+
+def artifact_path(run_id: str, task_name: str, suffix: str, profile_dir: Optional[Path] = None) -> Path:
+    return (profile_dir or PROFILE_DIR) / _UNSAFE_CHARS.sub("_", run_id) / f"{_UNSAFE_CHARS.sub('_', task_name)}{suffix}"
+
+
+@contextmanager
+def profile(run_id: str, task_name: str, options: ProfileOptions) -> Iterator[None]:
+    """
+    Profile the block when ``options`` is enabled, else do nothing.
+
+    Writes ``<task>.pstats`` (or ``<task>.sampler.html`` and ``.txt``) and
+    ``<task>.tracemalloc.txt`` and logs the top-N hotspots. cProfile and the
+    sampler only see the calling thread, so work on extraction's thread pool
+    shows up as time spent waiting on futures. Artifact failures are logged
+    and never fail the task.
+    """
+    if not options.enabled:
+        yield
+        return
+    profiler = _start_sampler() if options.sampler else None
+    cprofiler = None
+    if profiler is None:
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    started_tracing = options.tracemalloc and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    baseline = tracemalloc.take_snapshot() if options.tracemalloc else None
+    try:
+        yield
+    finally:
+        if cprofiler is not None:
+            cprofiler.disable()
+        if profiler is not None:
+            profiler.stop()
+        snapshot = tracemalloc.take_snapshot() if options.tracemalloc else None
+        peak = tracemalloc.get_traced_memory()[1] if options.tracemalloc else 0
+        if started_tracing:
+            tracemalloc.stop()
+        try:
+            if cprofiler is not None:
+                _write_cprofile(cprofiler, run_id, task_name, options.top_n)
+            if profiler is not None:
+                _write_sampler(profiler, run_id, task_name)
+            if snapshot is not None:
+                _write_tracemalloc(baseline, snapshot, peak, run_id, task_name, options.top_n)
+        except OSError as exc:
+            LOGGER.warning("Could not write profile for %s: %s", task_name, exc)
+
+
+def _start_sampler():
+    try:
+        from pyinstrument import Profiler  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        LOGGER.warning("pyinstrument is not installed; falling back to cProfile")
+        return None
+    profiler = Profiler(interval=SAMPLER_INTERVAL_SECONDS)
+    profiler.start()
+    return profiler
+
+
+def _write_cprofile(profiler: cProfile.Profile, run_id: str, task_name: str, top_n: int) -> None:
+    path = artifact_path(run_id, task_name, ".pstats")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(str(path))
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).strip_dirs().sort_stats("cumulative").print_stats(top_n)
+    LOGGER.info("Top %s functions by cumulative time for %s (%s):\n%s", top_n, task_name, path, summary.getvalue())
+
+
+def _write_sampler(profiler, run_id: str, task_name: str) -> None:
+    html_path = artifact_path(run_id, task_name, ".sampler.html")
+    html_path.parent.mkdir(parents=True, exist_ok=True)
+    html_path.write_text(profiler.output_html(), encoding="utf-8")
+    text = profiler.output_text(unicode=False, color=False)
+    artifact_path(run_id, task_name, ".sampler.txt").write_text(text, encoding="utf-8")
+    LOGGER.info("Sampled call tree for %s (%s):\n%s", task_name, html_path, text)
+
+
+def _write_tracemalloc(
+    baseline: tracemalloc.Snapshot,
+    snapshot: tracemalloc.Snapshot,
+    peak: int,
+    run_id: str,
+    task_name: str,
+    top_n: int,
+) -> None:
+    path = artifact_path(run_id, task_name, ".tracemalloc.txt")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    growth = snapshot.filter_traces(ignore).compare_to(baseline.filter_traces(ignore), "lineno")
+    lines = [f"peak traced memory: {peak / 2**20:.1f} MiB", f"top {top_n} allocation sites by growth:"]
+    lines.extend(str(stat) for stat in growth[:top_n])
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    LOGGER.info("Allocation hotspots for %s (%s):\n%s", task_name, path, "\n".join(lines))
@@ -0,0 +1,193 @@
+"""
+Extraction query planning: column projection and range predicates.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import psycopg2.extensions
+
+from utilities import get_logger
+from validation import TABLE_RULES, TableRules
+from watermarks import Bound
+
+LOGGER = get_logger("query_planner")
+
+TIMESTAMP_COLUMN = "modifieddate"
+# Projection override that keeps every source column (SELECT *).
+ALL_COLUMNS = "*"
+
+DIMENSION_TABLES = {
+    "customer": "sales.customer",
+    "product": "production.product",
+    "store": "sales.store",
+    "employee": "humanresources.employee",
+    "vendor": "purchasing.vendor",
+}
+
+FACT_TABLES = {
+    "FactSales": "sales.salesorderdetail",
+    "FactPurchases": "purchasing.purchaseorderdetail",
+    "FactInventory": "production.productinventory",
+    "FactReturns": "sales.salesorderheadersalesreason",
+}
+
+SOURCE_TABLES = {**DIMENSION_TABLES, **FACT_TABLES}
+
+# Primary key per source table; it breaks ties between rows sharing a
+# modifieddate in the per-table watermark.
+SOURCE_KEYS = {
+    "customer": ("customerid",),
+    "product": ("productid",),
+    "store": ("businessentityid",),
+    "employee": ("businessentityid",),
+    "vendor": ("businessentityid",),
+    "FactSales": ("salesorderid", "salesorderdetailid"),
+    "FactPurchases": ("purchaseorderid", "purchaseorderdetailid"),
+    "FactInventory": ("productid", "locationid"),
+    "FactReturns": ("salesorderid", "salesreasonid"),
+}
+
+# Source columns the dimension and fact mappings read, per table. The key
+# columns, modifieddate and every column a validation rule references are
+# added by ``required_columns``, so only mapped attributes are listed here.
+SOURCE_COLUMNS: Dict[str, Tuple[str, ...]] = {
+    "customer": ("personid", "storeid", "territoryid", "accountnumber"),
+    "product": (
+        "name",
+        "productnumber",
+        "color",
+        "standardcost",
+        "listprice",
+        "productsubcategoryid",
+        "sellstartdate",
+        "sellenddate",
+        "discontinueddate",
+    ),
+    "store": ("name", "salespersonid"),
+    "employee": (
+        "jobtitle",
+        "hiredate",
+        "salariedflag",
+        "vacationhours",
+        "sickleavehours",
+        "currentflag",
+    ),
+    "vendor": ("accountnumber", "name", "creditrating", "preferredvendorstatus", "activeflag"),
+    "FactSales": (
+        "productid",
+        "specialofferid",
+        "orderqty",
+        "unitprice",
+        "unitpricediscount",
+        "carriertrackingnumber",
+    ),
+    "FactPurchases": ("productid", "duedate", "orderqty", "unitprice", "receivedqty", "rejectedqty"),
+    "FactInventory": ("shelf", "bin", "quantity"),
+    "FactReturns": (),
+}
+
+
+@dataclass(frozen=True)
+class QueryPlan:
+    """One table's extraction query with its bound parameters."""
+
+    table: str
+    source: str
+    columns: Tuple[str, ...]
+    query: str
+    params: Dict[str, Any] = field(default_factory=dict)
+
+    def explain(self, conn, analyze: bool = False) -> str:
+        """
+        Return Postgres' plan for the query, for review before a run.
+
+        ``analyze`` executes the query (inside the caller's transaction) to
+        report actual row counts and timings.
+        """
+        options = "ANALYZE, BUFFERS, " if analyze else ""
+        # Plain tuple rows: pooled connections default to RealDictCursor.
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute(f"EXPLAIN ({options}FORMAT TEXT) {self.query}", self.params)
+            return "\n".join(row[0] for row in cur.fetchall())
+
+
+def required_columns(table: str, rules: Optional[TableRules] = None) -> Tuple[str, ...]:
+    """Projection for ``table``: watermark columns, mapped columns and validated columns."""
+    rules = rules or TABLE_RULES.get(table, TableRules())
+    referenced: List[str] = [TIMESTAMP_COLUMN, *SOURCE_KEYS[table], *SOURCE_COLUMNS.get(table, ())]
+    referenced.extend(rules.unique)
+    referenced.extend(rules.not_null)
+    referenced.extend(rules.ranges)
+    return tuple(column for column in dict.fromkeys(referenced) if column != ALL_COLUMNS)
+
+
+def source_columns(conn, table: str) -> Tuple[str, ...]:
+    """Columns of ``table``'s source relation, in ordinal order."""
+    schema, relation = SOURCE_TABLES[table].split(".", 1)
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.execute(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_schema = %s AND table_name = %s ORDER BY ordinal_position",
+            (schema, relation),
+        )
+        return tuple(row[0] for row in cur.fetchall())
+
+
+def plan_extraction(
+    table: str,
+    lower: Optional[Bound],
+    upper: datetime,
+    columns: Optional[Sequence[str]] = None,
+    available: Optional[Sequence[str]] = None,
+    start: Optional[datetime] = None,
+) -> QueryPlan:
+    """
+    Plan the incremental query for ``table``.
+
+    The window is the half-open range ``lower < (modifieddate, *key)`` and
+    ``modifieddate < upper``, with every value bound as a parameter, so a
+    ``(modifieddate, *key)`` index serves it as a range scan. Without a
+    watermark the table starts at ``start``, by default one day before
+    ``upper``.
+
+    ``columns`` overrides the projection (``["*"]`` selects everything); the
+    watermark columns are always included. When ``available`` (the source's
+    actual columns) is given, projected columns it lacks are dropped with a
+    warning, and a missing watermark column raises ValueError.
+    """
+    source = SOURCE_TABLES.get(table)
+    if not source:
+        raise ValueError(f"Unknown table {table}")
+    keys = SOURCE_KEYS[table]
+    if columns is not None and ALL_COLUMNS in columns:
+        projection: Tuple[str, ...] = ()
+    else:
+        projection = tuple(dict.fromkeys((TIMESTAMP_COLUMN, *keys, *(columns or required_columns(table)))))
+    if available is not None:
+        missing = [column for column in (TIMESTAMP_COLUMN, *keys) if column not in available]
+        if missing:
+            raise ValueError(f"{source} lacks watermark columns {missing}")
+        dropped = [column for column in projection if column not in available]
+        if dropped:
+            LOGGER.warning("Columns %s not found in %s; skipping them", dropped, source)
+            projection = tuple(column for column in projection if column in available)
+
+    params: Dict[str, Any] = {"upper": upper}
+    if lower is None:
+        params["lower"] = start or upper - timedelta(days=1)
+        condition = f"{TIMESTAMP_COLUMN} >= %(lower)s"
+    else:
+        modified_at, tie_key = lower
+        tie_columns = keys[: len(tie_key)]
+        params["lower"] = modified_at
+        params.update({f"key_{index}": value for index, value in enumerate(tie_key)})
+        left = ", ".join((TIMESTAMP_COLUMN,) + tie_columns)
+        right = ", ".join(["%(lower)s"] + [f"%(key_{index})s" for index in range(len(tie_columns))])
+        condition = f"({left}) > ({right})"
+    select_list = ", ".join(projection) if projection else "*"
+    query = f"SELECT {select_list} FROM {source} WHERE {condition} AND {TIMESTAMP_COLUMN} < %(upper)s"
+    return QueryPlan(table=table, source=source, columns=projection, query=query, params=params)
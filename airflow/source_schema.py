@@ -0,0 +1,143 @@
+"""
+Compact pandas dtypes for extracted source tables.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Any, Dict, List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from utilities import get_logger
+
+LOGGER = get_logger("source_schema")
+
+CATEGORY = "category"
+# AdventureWorks money columns are NUMERIC with at most 4 decimal places.
+MONEY = "decimal(19,4)"
+
+_DECIMAL = re.compile(r"decimal\((\d+),\s*(\d+)\)")
+
+# Per extracted frame: column -> dtype spec. Specs are pandas dtype names
+# (nullable integers such as "Int16"), "category" for low-cardinality strings
+# and "decimal(p,s)" for fixed-point Arrow decimals. Columns not listed keep
+# the dtype derived from their Postgres type (utilities._PG_TYPE_DTYPES).
+# Dimension frames also list the attribute names the SCD2 loaders track.
+SOURCE_DTYPES: Dict[str, Dict[str, str]] = {
+    "customer": {
+        "customerid": "Int32",
+        "personid": "Int32",
+        "storeid": "Int32",
+        "territoryid": "Int8",
+        "City": CATEGORY,
+        "Country": CATEGORY,
+        "CustomerSegment": CATEGORY,
+        "AccountStatus": CATEGORY,
+    },
+    "product": {
+        "productid": "Int32",
+        "productsubcategoryid": "Int16",
+        "color": CATEGORY,
+        "standardcost": MONEY,
+        "listprice": MONEY,
+        "Category": CATEGORY,
+        "ProductStatus": CATEGORY,
+    },
+    "store": {
+        "businessentityid": "Int32",
+        "salespersonid": "Int32",
+        "Region": CATEGORY,
+        "Territory": CATEGORY,
+        "StoreStatus": CATEGORY,
+    },
+    "employee": {
+        "businessentityid": "Int32",
+        "jobtitle": CATEGORY,
+        "vacationhours": "Int16",
+        "sickleavehours": "Int16",
+        "Department": CATEGORY,
+        "Region": CATEGORY,
+        "Territory": CATEGORY,
+    },
+    "vendor": {
+        "businessentityid": "Int32",
+        "creditrating": "Int8",
+    },
+    "FactSales": {
+        "salesorderid": "Int32",
+        "salesorderdetailid": "Int32",
+        "productid": "Int32",
+        "specialofferid": "Int16",
+        "orderqty": "Int16",
+        "unitprice": MONEY,
+        "unitpricediscount": MONEY,
+    },
+    "FactPurchases": {
+        "purchaseorderid": "Int32",
+        "purchaseorderdetailid": "Int32",
+        "productid": "Int32",
+        "orderqty": "Int16",
+        "unitprice": MONEY,
+        "receivedqty": "decimal(8,2)",
+        "rejectedqty": "decimal(8,2)",
+    },
+    "FactInventory": {
+        "productid": "Int32",
+        "locationid": "Int16",
+        "shelf": CATEGORY,
+        "bin": "Int16",
+        "quantity": "Int16",
+    },
+    "FactReturns": {
+        "salesorderid": "Int32",
+        "salesreasonid": "Int16",
+    },
+}
+
+
+def pandas_dtype(spec: str) -> Any:
+    """The pandas dtype for a registry spec."""
+    match = _DECIMAL.fullmatch(spec)
+    if match:
+        return pd.ArrowDtype(pa.decimal128(int(match.group(1)), int(match.group(2))))
+    return spec
+
+
+def categorical_columns(table: str) -> List[str]:
+    return [column for column, spec in SOURCE_DTYPES.get(table, {}).items() if spec == CATEGORY]
+
+
+def apply_source_dtypes(table: str, df: pd.DataFrame, categories: bool = True) -> pd.DataFrame:
+    """
+    Cast ``df``'s registered columns to their compact dtypes, in place.
+
+    With ``categories=False`` categorical columns become plain strings
+    instead; streamed chunks use that so each chunk has the same schema, and
+    the categories are built once on the whole frame.
+    """
+    for column, spec in SOURCE_DTYPES.get(table, {}).items():
+        if column not in df.columns:
+            continue
+        dtype = "string" if spec == CATEGORY and not categories else pandas_dtype(spec)
+        if df[column].dtype == dtype:
+            continue
+        try:
+            df[column] = df[column].astype(dtype)
+        except (TypeError, ValueError, pa.ArrowInvalid) as exc:
+            # Keep the wider dtype rather than fail a load over a registry
+            # entry the source has outgrown.
+            LOGGER.warning("Keeping %s.%s as %s: %s", table, column, df[column].dtype, exc)
+    return df
+
+
+def encode_categories(table: str, arrow_table: pa.Table) -> pa.Table:
+    """Dictionary-encode ``table``'s categorical columns so ``to_pandas`` yields categoricals."""
+    for column in categorical_columns(table):
+        index = arrow_table.schema.get_field_index(column)
+        if index < 0 or pa.types.is_dictionary(arrow_table.schema.field(index).type):
+            continue
+        arrow_table = arrow_table.set_column(index, column, pc.dictionary_encode(arrow_table.column(index)))
+    return arrow_table
@@ -0,0 +1,204 @@
+"""
+On-disk columnar staging for frames handed between DAG tasks.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import shutil
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.ipc as ipc
+
+from source_schema import encode_categories
+from utilities import arrow_to_pandas, get_logger
+
+LOGGER = get_logger("staging")
+
+STAGING_DIR = Path(os.getenv("DWH_STAGING_DIR", "staging"))
+# Staged runs older than this are swept even if they never succeeded.
+STAGING_RETENTION_DAYS = int(os.getenv("DWH_STAGING_RETENTION_DAYS", "7"))
+
+_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+@dataclass
+class StagedTable:
+    table: str
+    path: str
+    row_count: int
+    schema: Dict[str, str]
+    checksum: str
+
+
+def stage_frame_chunks(
+    name: str,
+    chunks: Iterable[pd.DataFrame],
+    run_id: str,
+    staging_dir: Optional[Path] = None,
+) -> Dict[str, Any]:
+    """
+    Append DataFrame chunks to one Arrow IPC file without holding the table in memory.
+    """
+    run_dir = _run_dir(run_id, staging_dir)
+    run_dir.mkdir(parents=True, exist_ok=True)
+    path = run_dir / f"{_safe_name(name)}.arrow"
+
+    writer: Optional[ipc.RecordBatchFileWriter] = None
+    schema: Optional[pa.Schema] = None
+    row_count = 0
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                writer = ipc.new_file(path, schema)
+            elif not table.schema.equals(schema):
+                unified = pa.unify_schemas([schema, table.schema], promote_options="permissive")
+                if not unified.equals(schema):
+                    writer.close()
+                    schema = unified
+                    writer = _reopen_with_schema(path, schema)
+                table = table.cast(schema)
+            writer.write_table(table)
+            row_count += table.num_rows
+        if writer is None:
+            schema = pa.schema([])
+            writer = ipc.new_file(path, schema)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    entry = StagedTable(
+        table=name,
+        path=str(path),
+        row_count=row_count,
+        schema={field.name: str(field.type) for field in schema},
+        checksum=_file_checksum(path),
+    )
+    LOGGER.info("Staged %s rows=%s path=%s", name, row_count, path)
+    return asdict(entry)
+
+
+def load_staged_frame(entry: Dict[str, Any], verify: bool = False) -> pd.DataFrame:
+    """
+    Memory-map a single staged table back into a DataFrame.
+
+    Registered categorical columns come back as categoricals and decimals as
+    Arrow-backed fixed-point columns (see ``source_schema``).
+    """
+    staged = StagedTable(**entry)
+    path = Path(staged.path)
+    if verify and _file_checksum(path) != staged.checksum:
+        raise ValueError(f"Checksum mismatch for staged table {staged.table} at {path}")
+    table = feather.read_table(path, memory_map=True)
+    if table.num_rows != staged.row_count:
+        raise ValueError(
+            f"Row count mismatch for staged table {staged.table}: "
+            f"expected={staged.row_count} actual={table.num_rows}"
+        )
+    return arrow_to_pandas(encode_categories(staged.table, table))
+
+
+def load_staged_frames(
+    manifest: Dict[str, Dict[str, Any]],
+    tables: Optional[Iterable[str]] = None,
+    verify: bool = False,
+) -> Dict[str, pd.DataFrame]:
+    """
+    Open only the requested tables from a manifest (all tables when omitted).
+    """
+    selected = list(tables) if tables is not None else list(manifest.keys())
+    return {
+        name: load_staged_frame(manifest[name], verify=verify)
+        for name in selected
+        if name in manifest
+    }
+
+
+def manifest_for_run(run_id: str, staging_dir: Optional[Path] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Rebuild the manifest of a staged run from its files, e.g. once the
+    extract task's XCom is gone. Table names are taken from the file names.
+    """
+    manifest: Dict[str, Dict[str, Any]] = {}
+    for path in sorted(_run_dir(run_id, staging_dir).glob("*.arrow")):
+        table = feather.read_table(path, memory_map=True)
+        entry = StagedTable(
+            table=path.stem,
+            path=str(path),
+            row_count=table.num_rows,
+            schema={field.name: str(field.type) for field in table.schema},
+            checksum=_file_checksum(path),
+        )
+        manifest[entry.table] = asdict(entry)
+    return manifest
+
+
+def cleanup_staged_run(run_id: str, staging_dir: Optional[Path] = None) -> None:
+    run_dir = _run_dir(run_id, staging_dir)
+    if not run_dir.exists():
+        return
+    shutil.rmtree(run_dir)
+    LOGGER.info("Removed staged run %s", run_dir)
+
+
+def sweep_staged_runs(retention_days: Optional[int] = None, staging_dir: Optional[Path] = None) -> List[str]:
+    """
+    Remove staged runs last written more than ``retention_days`` ago.
+
+    Failed runs keep their files so their tasks can be cleared and rerun;
+    this bounds how long they stay around.
+    """
+    root = staging_dir or STAGING_DIR
+    if not root.exists():
+        return []
+    retention_days = STAGING_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = time.time() - retention_days * 86_400
+    removed = []
+    for run_dir in root.iterdir():
+        if run_dir.is_dir() and run_dir.stat().st_mtime < cutoff:
+            shutil.rmtree(run_dir)
+            removed.append(run_dir.name)
+    if removed:
+        LOGGER.info("Swept %s staged runs older than %s days from %s", len(removed), retention_days, root)
+    return removed
+
+
+def _reopen_with_schema(path: Path, schema: pa.Schema) -> ipc.RecordBatchFileWriter:
+    # A column that was all-null in the first chunk was written with the null
+    # type. IPC files cannot be rewritten in place, so copy the batches written
+    # so far into a new file with the widened schema and keep it open.
+    tmp_path = path.with_suffix(".arrow.tmp")
+    path.replace(tmp_path)
+    writer = ipc.new_file(path, schema)
+    with pa.memory_map(str(tmp_path)) as source:
+        reader = ipc.open_file(source)
+        for index in range(reader.num_record_batches):
+            writer.write_table(pa.Table.from_batches([reader.get_batch(index)]).cast(schema))
+    tmp_path.unlink()
+    return writer
+
+
+def _run_dir(run_id: str, staging_dir: Optional[Path]) -> Path:
+    return (staging_dir or STAGING_DIR) / _safe_name(run_id)
+
+
+def _safe_name(value: str) -> str:
+    return _UNSAFE_CHARS.sub("_", value)
+
+
+def _file_checksum(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
@@ -4,19 +4,26 @@ Utility helpers shared across the DWH Airflow project.
 
 from __future__ import annotations
 
-import json
 import logging
 import os
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import astuple, dataclass
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 import pandas as pd
-import pendulum
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 from clickhouse_driver import Client as ClickHouseClient
+from clickhouse_driver.errors import UnknownCompressionMethod
 
 
 @dataclass
@@ -35,6 +42,38 @@ class ClickHouseConfig:
     user: str
     password: str
     database: str
+    compression: Optional[str] = None
+    insert_block_size: Optional[int] = None
+    settings_profile: str = "default"
+    pool_size: int = 8
+    # Client-side block bound and concurrency of bulk_insert.insert_frame.
+    insert_chunk_rows: int = 250_000
+    insert_workers: int = 4
+    insert_deduplication: bool = True
+
+
+def postgres_config_from_env() -> PostgresConfig:
+    """Source connection for command-line tools, from the DWH_PG_* variables."""
+    return PostgresConfig(
+        host=os.environ["DWH_PG_HOST"],
+        port=int(os.getenv("DWH_PG_PORT", "5432")),
+        database=os.environ["DWH_PG_DB"],
+        user=os.environ["DWH_PG_USER"],
+        password=os.getenv("DWH_PG_PASSWORD", ""),
+    )
+
+
+def clickhouse_config_from_env() -> ClickHouseConfig:
+    """Warehouse connection for command-line tools, from the DWH_CH_* variables."""
+    return ClickHouseConfig(
+        host=os.environ["DWH_CH_HOST"],
+        port=int(os.getenv("DWH_CH_PORT", "9000")),
+        user=os.getenv("DWH_CH_USER", "default"),
+        password=os.getenv("DWH_CH_PASSWORD", ""),
+        database=os.environ["DWH_CH_DB"],
+        settings_profile=os.getenv("DWH_CH_SETTINGS_PROFILE", "bulk_insert"),
+        insert_workers=int(os.getenv("DWH_CH_INSERT_WORKERS", "4")),
+    )
 
 
 def get_logger(name: str = "dwh_etl") -> logging.Logger:
@@ -56,17 +95,205 @@ def get_postgres_conn(cfg: PostgresConfig):
     )
 
 
-def get_clickhouse_client(cfg: ClickHouseConfig) -> ClickHouseClient:
-    return ClickHouseClient(
+def get_postgres_pool(cfg: PostgresConfig, maxconn: int, minconn: int = 1) -> psycopg2.pool.ThreadedConnectionPool:
+    return psycopg2.pool.ThreadedConnectionPool(
+        minconn,
+        maxconn,
         host=cfg.host,
         port=cfg.port,
+        dbname=cfg.database,
         user=cfg.user,
         password=cfg.password,
-        database=cfg.database,
-        send_receive_timeout=60,
+        cursor_factory=psycopg2.extras.RealDictCursor,
     )
 
 
+@contextmanager
+def pooled_postgres_conn(pool: psycopg2.pool.ThreadedConnectionPool) -> Iterator[Any]:
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+# Named ClickHouse settings bundles selected through ClickHouseConfig.settings_profile.
+CLICKHOUSE_SETTINGS_PROFILES: Dict[str, Dict[str, Any]] = {
+    "default": {},
+    "bulk_insert": {
+        "max_insert_block_size": 1_048_576,
+        "max_threads": 8,
+    },
+    "mutation": {
+        "mutations_sync": 1,
+    },
+}
+
+# Idle clients older than this are pinged before being handed out again.
+CLICKHOUSE_HEALTHCHECK_AFTER_SECONDS = 60.0
+# How long acquire() waits for a pooled client before giving up.
+CLICKHOUSE_ACQUIRE_TIMEOUT_SECONDS = 300.0
+
+
+class ClickHouseClientManager:
+    """
+    Bounded pool of native-protocol clients for one ClickHouse config.
+
+    ``client()`` checks a client out for the duration of a ``with`` block.
+    ``thread_client()`` keeps one unpooled client per thread, so repeated
+    ``get_clickhouse_client`` calls inside a task reuse the same connection
+    without holding pool slots that worker threads would never give back.
+    """
+
+    def __init__(self, cfg: ClickHouseConfig) -> None:
+        self.cfg = cfg
+        self._idle: "queue.LifoQueue[Tuple[ClickHouseClient, float]]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._local = threading.local()
+
+    def acquire(self, timeout: Optional[float] = None) -> ClickHouseClient:
+        timeout = CLICKHOUSE_ACQUIRE_TIMEOUT_SECONDS if timeout is None else timeout
+        while True:
+            try:
+                client, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if time.monotonic() - idle_since < CLICKHOUSE_HEALTHCHECK_AFTER_SECONDS or self._is_healthy(client):
+                return client
+            self._discard(client)
+
+        with self._lock:
+            if self._created < self.cfg.pool_size:
+                self._created += 1
+                return self._create()
+        try:
+            client, _ = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(
+                f"No ClickHouse client released within {timeout}s (pool_size={self.cfg.pool_size})"
+            ) from None
+        return client
+
+    def release(self, client: ClickHouseClient) -> None:
+        self._idle.put((client, time.monotonic()))
+
+    @contextmanager
+    def client(self, timeout: Optional[float] = None) -> Iterator[ClickHouseClient]:
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except Exception:
+            # The connection state is unknown after a failed query.
+            self._discard(client)
+            raise
+        self.release(client)
+
+    def thread_client(self) -> ClickHouseClient:
+        # Not counted against pool_size: the client lives as long as its
+        # thread and is closed when the thread-local is collected.
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._create()
+            self._local.client = client
+        return client
+
+    def close_all(self) -> None:
+        while True:
+            try:
+                client, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(client)
+
+    def _create(self) -> ClickHouseClient:
+        settings = dict(CLICKHOUSE_SETTINGS_PROFILES.get(self.cfg.settings_profile, {}))
+        if self.cfg.insert_block_size:
+            settings["insert_block_size"] = self.cfg.insert_block_size
+        kwargs: Dict[str, Any] = {
+            "host": self.cfg.host,
+            "port": self.cfg.port,
+            "user": self.cfg.user,
+            "password": self.cfg.password,
+            "database": self.cfg.database,
+            "send_receive_timeout": 60,
+            "settings": settings,
+        }
+        if self.cfg.compression:
+            try:
+                return ClickHouseClient(compression=self.cfg.compression, **kwargs)
+            except UnknownCompressionMethod:
+                # lz4/zstd are optional extras of clickhouse-driver.
+                logging.getLogger("utilities").warning(
+                    "ClickHouse compression %s unavailable; connecting uncompressed",
+                    self.cfg.compression,
+                )
+        return ClickHouseClient(**kwargs)
+
+    def _is_healthy(self, client: ClickHouseClient) -> bool:
+        try:
+            return bool(client.connection.ping())
+        except Exception:  # pylint: disable=broad-except
+            return False
+
+    def _discard(self, client: ClickHouseClient) -> None:
+        try:
+            client.disconnect()
+        except Exception:  # pylint: disable=broad-except
+            pass
+        with self._lock:
+            self._created -= 1
+
+
+_CLICKHOUSE_MANAGERS: Dict[Tuple[Any, ...], ClickHouseClientManager] = {}
+_CLICKHOUSE_MANAGERS_LOCK = threading.Lock()
+
+
+def get_clickhouse_manager(cfg: ClickHouseConfig) -> ClickHouseClientManager:
+    key = astuple(cfg)
+    with _CLICKHOUSE_MANAGERS_LOCK:
+        manager = _CLICKHOUSE_MANAGERS.get(key)
+        if manager is None:
+            manager = _CLICKHOUSE_MANAGERS[key] = ClickHouseClientManager(cfg)
+    return manager
+
+
+def get_clickhouse_client(cfg: ClickHouseConfig) -> ClickHouseClient:
+    return get_clickhouse_manager(cfg).thread_client()
+
+
+def insert_dataframe_columnar(
+    client: ClickHouseClient,
+    table: str,
+    df: pd.DataFrame,
+    settings: Optional[Dict[str, Any]] = None,
+) -> int:
+    """
+    Insert a DataFrame as one columnar block instead of a list of row dicts.
+
+    clickhouse-driver's NumPy column writers do not cover Decimal, so columns
+    are handed over as lists produced by the C-level ``tolist`` conversion.
+    ``settings`` are per-query settings such as ``insert_deduplication_token``.
+    """
+    if df.empty:
+        return 0
+    columns = ", ".join(f"`{column}`" for column in df.columns)
+    data = [_column_values(df[column]) for column in df.columns]
+    client.execute(f"INSERT INTO {table} ({columns}) VALUES", data, columnar=True, settings=settings)
+    return len(df)
+
+
+def _column_values(series: pd.Series) -> List[Any]:
+    values = series.tolist()
+    if series.hasnans:
+        return [None if pd.isna(value) else value for value in values]
+    return values
+
+
 def get_processing_batch_id(processing_date: str, suffix: Optional[str] = None) -> str:
     base = f"{processing_date.replace('-', '')}"
     if suffix:
@@ -76,43 +303,187 @@ def get_processing_batch_id(processing_date: str, suffix: Optional[str] = None)
 
 METADATA_DIR = Path(os.getenv("DWH_METADATA_DIR", "metadata"))
 METADATA_DIR.mkdir(exist_ok=True)
-LAST_RUN_FILE = METADATA_DIR / "last_run.json"
 
 
-def load_last_run_time(task_name: str) -> Optional[datetime]:
-    if not LAST_RUN_FILE.exists():
-        return None
-    with LAST_RUN_FILE.open("r", encoding="utf-8") as handle:
-        payload = json.load(handle)
-    ts = payload.get(task_name)
-    return pendulum.parse(ts) if ts else None
+DEFAULT_ITERSIZE = 50_000
 
+# Postgres type OIDs mapped to the pandas dtype each streamed chunk is cast to,
+# so every chunk of a table carries the same dtypes regardless of its nulls.
+_PG_TYPE_DTYPES = {
+    16: "boolean",  # bool
+    20: "Int64",  # int8
+    21: "Int16",  # int2
+    23: "Int32",  # int4
+    700: "float32",  # float4
+    701: "float64",  # float8
+    25: "string",  # text
+    1042: "string",  # bpchar
+    1043: "string",  # varchar
+    2950: "string",  # uuid
+    1082: "datetime64[ns]",  # date
+    1114: "datetime64[ns]",  # timestamp
+    # Fixed point instead of Python Decimal objects; source_schema narrows
+    # registered columns to their real precision.
+    1700: pd.ArrowDtype(pa.decimal128(38, 10)),  # numeric
+}
 
-def save_last_run_time(task_name: str, dt: datetime) -> None:
-    payload: Dict[str, str] = {}
-    if LAST_RUN_FILE.exists():
-        with LAST_RUN_FILE.open("r", encoding="utf-8") as handle:
-            payload = json.load(handle)
-    payload[task_name] = dt.isoformat()
-    with LAST_RUN_FILE.open("w", encoding="utf-8") as handle:
-        json.dump(payload, handle, indent=2)
+_PG_TYPE_ARROW = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1082: pa.date32(),
+    1114: pa.timestamp("us"),
+}
 
+DEFAULT_COPY_BLOCK_SIZE = 16 << 20
 
-def dataframe_from_query(conn, query: str, params: Optional[tuple] = None) -> pd.DataFrame:
-    with conn.cursor() as cur:
+
+def dataframe_from_query(
+    conn,
+    query: str,
+    params: Optional[Union[tuple, Dict[str, Any]]] = None,
+    itersize: int = DEFAULT_ITERSIZE,
+) -> pd.DataFrame:
+    chunks = list(iter_dataframes_from_query(conn, query, params, itersize=itersize))
+    if len(chunks) == 1:
+        return chunks[0]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def iter_dataframes_from_query(
+    conn,
+    query: str,
+    params: Optional[Union[tuple, Dict[str, Any]]] = None,
+    itersize: int = DEFAULT_ITERSIZE,
+    cursor_name: Optional[str] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Stream a query through a server-side cursor as typed DataFrame chunks.
+
+    Rows are fetched as plain tuples ``itersize`` at a time, so peak memory is
+    bounded by the chunk size rather than the result size. At least one
+    (possibly empty) chunk is always yielded so callers keep the column set.
+    """
+    name = cursor_name or f"dwh_stream_{uuid.uuid4().hex[:12]}"
+    with conn.cursor(name=name, cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.itersize = itersize
         cur.execute(query, params)
-        rows = cur.fetchall()
-    return pd.DataFrame(rows)
+        rows = cur.fetchmany(itersize)
+        columns = [col.name for col in cur.description]
+        type_codes = [col.type_code for col in cur.description]
+        yield _typed_chunk(rows, columns, type_codes)
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            yield _typed_chunk(rows, columns, type_codes)
 
 
-def log_row_counts(logger: logging.Logger, label: str, df: pd.DataFrame) -> None:
-    logger.info("%s rowcount=%s columns=%s", label, len(df), list(df.columns))
+def iter_dataframes_from_copy(
+    conn,
+    query: str,
+    params: Optional[Union[tuple, Dict[str, Any]]] = None,
+    block_size: int = DEFAULT_COPY_BLOCK_SIZE,
+) -> Iterator[pd.DataFrame]:
+    """
+    Stream a query through ``COPY (...) TO STDOUT`` into typed DataFrame chunks.
+
+    The CSV bytes are piped from a background thread straight into Arrow's
+    streaming CSV reader, so no per-row Python objects are built. Column types
+    come from the query's own result description so every block parses the
+    same way. Yields at least one (possibly empty) chunk.
+    """
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        bound_query = cur.mogrify(query, params).decode("utf-8")
+        cur.execute(f"SELECT * FROM ({bound_query}) AS copy_probe LIMIT 0")
+        description = list(cur.description)
+    columns = [col.name for col in description]
+    type_codes = [col.type_code for col in description]
+    schema = pa.schema([(col.name, _arrow_type(col)) for col in description])
+
+    read_fd, write_fd = os.pipe()
+    errors: List[BaseException] = []
 
+    def pump() -> None:
+        try:
+            with os.fdopen(write_fd, "wb") as sink, conn.cursor() as copy_cur:
+                copy_cur.copy_expert(f"COPY ({bound_query}) TO STDOUT WITH (FORMAT csv)", sink)
+        except BaseException as exc:  # pylint: disable=broad-except
+            errors.append(exc)
 
-def determine_processing_window(last_run: Optional[datetime], current: datetime) -> Dict[str, datetime]:
-    if not last_run:
-        last_run = current - timedelta(days=1)
-    return {"from": last_run, "to": current}
+    thread = threading.Thread(target=pump, name="pg_copy", daemon=True)
+    thread.start()
+    try:
+        with os.fdopen(read_fd, "rb") as source:
+            try:
+                reader = pa_csv.open_csv(
+                    source,
+                    read_options=pa_csv.ReadOptions(column_names=columns, block_size=block_size),
+                    convert_options=pa_csv.ConvertOptions(
+                        column_types=schema,
+                        true_values=["t"],
+                        false_values=["f"],
+                        strings_can_be_null=True,
+                        quoted_strings_can_be_null=False,
+                    ),
+                )
+            except pa.ArrowInvalid as exc:
+                # COPY of an empty result produces no bytes at all.
+                if "Empty CSV file" not in str(exc):
+                    raise
+                reader = []
+            emitted = False
+            for batch in reader:
+                emitted = True
+                yield _apply_pg_dtypes(arrow_to_pandas(batch), columns, type_codes)
+            if not emitted:
+                yield _apply_pg_dtypes(arrow_to_pandas(schema.empty_table()), columns, type_codes)
+    finally:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def arrow_to_pandas(data: Union[pa.Table, pa.RecordBatch]) -> pd.DataFrame:
+    """Convert Arrow data to pandas, keeping decimals as Arrow-backed columns."""
+    return data.to_pandas(date_as_object=False, types_mapper=_arrow_decimal_dtype)
+
+
+def _arrow_decimal_dtype(arrow_type: pa.DataType) -> Optional[pd.ArrowDtype]:
+    return pd.ArrowDtype(arrow_type) if pa.types.is_decimal(arrow_type) else None
+
+
+def _arrow_type(column) -> pa.DataType:
+    if column.type_code == 1700:
+        # Unconstrained NUMERIC (the AdventureWorks money columns) carries no
+        # typmod; a scale of 10 is well beyond the 4 places money ever uses.
+        if column.precision and column.scale is not None:
+            return pa.decimal128(column.precision, column.scale)
+        return pa.decimal128(38, 10)
+    return _PG_TYPE_ARROW.get(column.type_code, pa.string())
+
+
+def _typed_chunk(rows: List[tuple], columns: List[str], type_codes: List[int]) -> pd.DataFrame:
+    df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=False)
+    return _apply_pg_dtypes(df, columns, type_codes)
+
+
+def _apply_pg_dtypes(df: pd.DataFrame, columns: List[str], type_codes: List[int]) -> pd.DataFrame:
+    for column, type_code in zip(columns, type_codes):
+        dtype = _PG_TYPE_DTYPES.get(type_code)
+        if dtype is None:
+            continue
+        if type_code == 2950 and df[column].dtype == object:
+            df[column] = df[column].map(lambda value: None if value is None else str(value))
+        df[column] = df[column].astype(dtype)
+    return df
+
+
+def log_row_counts(logger: logging.Logger, label: str, df: pd.DataFrame) -> None:
+    logger.info("%s rowcount=%s columns=%s", label, len(df), list(df.columns))
 
 
 def ensure_dataframe(df: Optional[pd.DataFrame]) -> pd.DataFrame:
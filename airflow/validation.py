@@ -4,10 +4,14 @@ Data quality validation utilities.
 
 from __future__ import annotations
 
-from typing import Dict, List, Tuple
+from dataclasses import dataclass, field
+from typing import Dict, List, Mapping, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+import metrics
+from error_handling import ErrorRecordWriter
 from utilities import get_logger
 
 LOGGER = get_logger("validation")
@@ -15,21 +19,140 @@ LOGGER = get_logger("validation")
 
 ValidationResult = Tuple[str, bool, str]
 
+# Stands for "every column" (``not_null``/``unique``) or "every numeric
+# column" (``ranges``) in a TableRules declaration.
+ALL_COLUMNS = "*"
 
-def validate_extracted_data(frames: Dict[str, pd.DataFrame]) -> List[ValidationResult]:
+Bounds = Tuple[Optional[float], Optional[float]]
+
+
+@dataclass(frozen=True)
+class TableRules:
+    """
+    Declarative checks for one extracted table.
+
+    ``unique`` is the natural key (duplicates beyond the first occurrence are
+    flagged), ``not_null`` the required columns and ``ranges`` maps a column
+    to inclusive ``(min, max)`` bounds, either of which may be None.
     """
-    Run column-level checks on extracted dataframes.
+
+    unique: Tuple[str, ...] = ()
+    not_null: Tuple[str, ...] = ()
+    ranges: Mapping[str, Bounds] = field(default_factory=dict)
+
+
+@dataclass
+class TableValidation:
+    """Outcome of validating one frame: check results plus offending-row masks."""
+
+    table: str
+    rows: int
+    results: List[ValidationResult]
+    masks: Dict[str, np.ndarray]
+
+    @property
+    def invalid(self) -> np.ndarray:
+        """Rows failing any rule."""
+        combined = np.zeros(self.rows, dtype=bool)
+        for mask in self.masks.values():
+            combined |= mask
+        return combined
+
+
+# Legacy checks, used for tables without an entry in TABLE_RULES.
+DEFAULT_RULES = TableRules(
+    unique=(ALL_COLUMNS,),
+    not_null=(ALL_COLUMNS,),
+    ranges={ALL_COLUMNS: (0, None)},
+)
+
+# Keyed by the frame names produced by extraction (AdventureWorks column names).
+TABLE_RULES: Dict[str, TableRules] = {
+    "customer": TableRules(
+        unique=("customerid",),
+        not_null=("customerid", "modifieddate"),
+    ),
+    "product": TableRules(
+        unique=("productid",),
+        not_null=("productid", "name", "productnumber"),
+        ranges={"listprice": (0, None), "standardcost": (0, None)},
+    ),
+    "store": TableRules(
+        unique=("businessentityid",),
+        not_null=("businessentityid", "name"),
+    ),
+    "employee": TableRules(
+        unique=("businessentityid",),
+        not_null=("businessentityid", "jobtitle"),
+        ranges={"vacationhours": (-40, 240), "sickleavehours": (0, 120)},
+    ),
+    "vendor": TableRules(
+        unique=("businessentityid",),
+        not_null=("businessentityid", "name"),
+        ranges={"creditrating": (1, 5)},
+    ),
+    "FactSales": TableRules(
+        unique=("salesorderid", "salesorderdetailid"),
+        not_null=("salesorderid", "productid", "orderqty", "unitprice"),
+        ranges={"orderqty": (1, None), "unitprice": (0, None), "unitpricediscount": (0, 1)},
+    ),
+    "FactPurchases": TableRules(
+        unique=("purchaseorderid", "purchaseorderdetailid"),
+        not_null=("purchaseorderid", "productid", "orderqty", "unitprice"),
+        ranges={
+            "orderqty": (1, None),
+            "unitprice": (0, None),
+            "receivedqty": (0, None),
+            "rejectedqty": (0, None),
+        },
+    ),
+    "FactInventory": TableRules(
+        unique=("productid", "locationid"),
+        not_null=("productid", "locationid", "quantity"),
+        ranges={"quantity": (0, None)},
+    ),
+    "FactReturns": TableRules(
+        unique=("salesorderid", "salesreasonid"),
+        not_null=("salesorderid", "salesreasonid"),
+    ),
+}
+
+
+def validate_extracted_data(
+    frames: Dict[str, pd.DataFrame],
+    error_writer: Optional[ErrorRecordWriter] = None,
+    processing_batch_id: str = "",
+    rules: Optional[Mapping[str, TableRules]] = None,
+) -> List[ValidationResult]:
+    """
+    Run the configured rules on extracted dataframes.
+
+    Failed checks are also queued on ``error_writer`` when one is given.
     """
     results: List[ValidationResult] = []
     for name, df in frames.items():
-        tests = [
-            _check_nulls(name, df),
-            _check_duplicates(name, df),
-            _check_numeric_ranges(name, df),
-        ]
-        for test in tests:
-            if test:
-                results.append(test)
+        with metrics.stage("validate", name, rows_in=len(df)) as timer:
+            outcome = validate_frame(name, df, (rules or TABLE_RULES).get(name, DEFAULT_RULES))
+            timer.rows_out = outcome.rows - int(outcome.invalid.sum())
+            timer.bytes_moved = metrics.frame_bytes(df)
+        for check in outcome.results:
+            results.append(check)
+            if error_writer is not None and not check[1]:
+                mask = outcome.masks.get(check[0])
+                error_writer.add(
+                    error_type="ValidationFailure",
+                    error_message=check[2],
+                    failed_data={
+                        "check": check[0],
+                        "rows": outcome.rows,
+                        "offending_rows": int(mask.sum()) if mask is not None else None,
+                    },
+                    source_table=name,
+                    natural_key=check[0],
+                    processing_batch_id=processing_batch_id,
+                    task_name="validate_extracted_data",
+                    is_recoverable=False,
+                )
 
     failures = [result for result in results if not result[1]]
     if failures:
@@ -39,32 +162,91 @@ def validate_extracted_data(frames: Dict[str, pd.DataFrame]) -> List[ValidationR
     return results
 
 
-def _check_nulls(name: str, df: pd.DataFrame) -> ValidationResult:
-    null_counts = df.isna().sum()
-    offending = {col: int(count) for col, count in null_counts.items() if count > 0}
-    status = len(offending) == 0
-    message = f"Null counts={offending}" if offending else "No nulls detected"
-    return (f"{name}_nulls", status, message)
-
-
-def _check_duplicates(name: str, df: pd.DataFrame) -> ValidationResult:
-    if df.empty:
-        return (f"{name}_duplicates", True, "empty dataframe")
-    dup_count = int(df.duplicated().sum())
-    status = dup_count == 0
-    message = f"{dup_count} duplicates detected" if dup_count else "No duplicates"
-    return (f"{name}_duplicates", status, message)
-
+def validate_frame(name: str, df: pd.DataFrame, rules: TableRules = DEFAULT_RULES) -> TableValidation:
+    """
+    Evaluate all of ``rules`` on ``df`` in one pass over the referenced columns.
 
-def _check_numeric_ranges(name: str, df: pd.DataFrame) -> ValidationResult:
-    numeric_cols = df.select_dtypes(include=["number"]).columns
-    negatives = {
-        col: int((df[col] < 0).sum())
-        for col in numeric_cols
-        if (df[col] < 0).any()
+    Each column's null mask is computed once and shared by the not-null and
+    range checks. ``masks`` maps each check name to a boolean array of
+    offending rows, aligned with ``df``'s positions.
+    """
+    rows = len(df)
+    numeric = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col].dtype)]
+    not_null = _expand(rules.not_null, list(df.columns))
+    unique = _expand(rules.unique, list(df.columns))
+    ranges: Dict[str, Bounds] = {}
+    for column, bounds in rules.ranges.items():
+        for target in _expand((column,), numeric):
+            ranges[target] = bounds
+
+    referenced = set(not_null) | set(ranges) | set(unique)
+    missing = sorted(col for col in referenced if col not in df.columns)
+    null_masks = {
+        col: df[col].isna().to_numpy()
+        for col in dict.fromkeys(not_null + list(ranges))
+        if col in df.columns
     }
-    status = len(negatives) == 0
-    message = f"Negative values {negatives}" if negatives else "No negative values"
-    return (f"{name}_range", status, message)
-
 
+    results: List[ValidationResult] = []
+    masks: Dict[str, np.ndarray] = {}
+
+    check = f"{name}_nulls"
+    offending: Dict[str, int] = {}
+    null_mask = np.zeros(rows, dtype=bool)
+    for col in not_null:
+        if col in null_masks and null_masks[col].any():
+            offending[col] = int(null_masks[col].sum())
+            null_mask |= null_masks[col]
+    masks[check] = null_mask
+    results.append(
+        (check, not offending, f"Null counts={offending}" if offending else "No nulls detected")
+    )
+
+    check = f"{name}_duplicates"
+    key = [col for col in unique if col in df.columns]
+    if rows and key:
+        dup_mask = df.duplicated(subset=key).to_numpy()
+        dup_count = int(dup_mask.sum())
+        message = f"{dup_count} duplicates detected" if dup_count else "No duplicates"
+    else:
+        dup_mask = np.zeros(rows, dtype=bool)
+        dup_count = 0
+        message = "empty dataframe" if not rows else "No unique key configured"
+    masks[check] = dup_mask
+    results.append((check, dup_count == 0, message))
+
+    check = f"{name}_range"
+    out_of_range: Dict[str, int] = {}
+    range_mask = np.zeros(rows, dtype=bool)
+    for col, (low, high) in ranges.items():
+        if col not in df.columns:
+            continue
+        present = ~null_masks[col]
+        values = df[col].to_numpy(dtype="float64", na_value=np.nan)[present]
+        bad = np.zeros(len(values), dtype=bool)
+        if low is not None:
+            bad |= values < low
+        if high is not None:
+            bad |= values > high
+        if bad.any():
+            out_of_range[col] = int(bad.sum())
+            range_mask[np.flatnonzero(present)[bad]] = True
+    masks[check] = range_mask
+    results.append(
+        (
+            check,
+            not out_of_range,
+            f"Out of range values {out_of_range}" if out_of_range else "All values within range",
+        )
+    )
+
+    if missing:
+        results.append((f"{name}_columns", False, f"Missing columns {missing}"))
+    return TableValidation(table=name, rows=rows, results=results, masks=masks)
+
+
+def _expand(columns: Tuple[str, ...], available: List[str]) -> List[str]:
+    expanded: List[str] = []
+    for column in columns:
+        expanded.extend(available if column == ALL_COLUMNS else [column])
+    return list(dict.fromkeys(expanded))
@@ -0,0 +1,213 @@
+"""
+Per-table extraction watermarks with atomic compare-and-set updates.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from utilities import METADATA_DIR, get_logger
+
+LOGGER = get_logger("watermarks")
+
+# Must live on storage shared by all workers, like DWH_STAGING_DIR.
+WATERMARK_DB = Path(os.getenv("DWH_WATERMARK_DB", str(METADATA_DIR / "watermarks.sqlite3")))
+
+# High-water mark: max modifieddate plus the primary key of the last row at
+# that timestamp, compared as a tuple so rows sharing a timestamp are not lost.
+Bound = Tuple[datetime, Tuple[Any, ...]]
+
+
+class WatermarkConflict(RuntimeError):
+    """Another run advanced the watermark since it was read."""
+
+
+@dataclass(frozen=True)
+class Watermark:
+    table: str
+    modified_at: Optional[datetime]
+    tie_key: Tuple[Any, ...]
+    previous_modified_at: Optional[datetime]
+    previous_tie_key: Tuple[Any, ...]
+    run_id: str
+    staged: Optional[Dict[str, Any]]
+    version: int
+
+    @property
+    def bound(self) -> Optional[Bound]:
+        return (self.modified_at, self.tie_key) if self.modified_at else None
+
+    def lower_bound_for(self, run_id: Optional[str]) -> Optional[Bound]:
+        """
+        Where extraction for ``run_id`` starts: the watermark it left behind
+        if it already advanced it (a rerun), else the current one.
+        """
+        if run_id and run_id == self.run_id:
+            return (self.previous_modified_at, self.previous_tie_key) if self.previous_modified_at else None
+        return self.bound
+
+
+class WatermarkStore:
+    """SQLite-backed watermarks; every update is a single versioned statement."""
+
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.path = Path(path or WATERMARK_DB)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS watermarks (
+                    table_name TEXT PRIMARY KEY,
+                    modified_at TEXT,
+                    tie_key TEXT NOT NULL,
+                    previous_modified_at TEXT,
+                    previous_tie_key TEXT NOT NULL,
+                    run_id TEXT NOT NULL,
+                    staged TEXT,
+                    version INTEGER NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+                """
+            )
+
+    def get(self, table: str) -> Optional[Watermark]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM watermarks WHERE table_name = ?", (table,)).fetchone()
+        return _from_row(row) if row else None
+
+    def all(self) -> List[Watermark]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT * FROM watermarks ORDER BY table_name").fetchall()
+        return [_from_row(row) for row in rows]
+
+    def advance(
+        self,
+        table: str,
+        expected: Optional[Watermark],
+        new_bound: Optional[Bound],
+        run_id: str,
+        staged: Optional[Dict[str, Any]] = None,
+    ) -> Watermark:
+        """
+        Set ``table``'s watermark to ``new_bound`` if it is still ``expected``.
+
+        A run that advances its own watermark again keeps the bound it started
+        from as ``previous``, so further reruns extract the same slice.
+        Raises WatermarkConflict when another writer got there first.
+        """
+        if expected is not None and expected.run_id == run_id:
+            previous = (expected.previous_modified_at, expected.previous_tie_key)
+        else:
+            previous = (expected.modified_at, expected.tie_key) if expected else (None, ())
+        bound = new_bound or (expected.bound if expected else None) or (None, ())
+        values = (
+            _iso(bound[0]),
+            json.dumps(list(bound[1])),
+            _iso(previous[0]),
+            json.dumps(list(previous[1])),
+            run_id,
+            json.dumps(staged) if staged is not None else None,
+            datetime.utcnow().isoformat(),
+        )
+        with closing(self._connect()) as conn:
+            if expected is None:
+                try:
+                    conn.execute(
+                        """
+                        INSERT INTO watermarks (
+                            modified_at, tie_key, previous_modified_at, previous_tie_key,
+                            run_id, staged, updated_at, table_name, version
+                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+                        """,
+                        values + (table,),
+                    )
+                    changed = 1
+                except sqlite3.IntegrityError:
+                    changed = 0
+            else:
+                changed = conn.execute(
+                    """
+                    UPDATE watermarks
+                    SET modified_at = ?, tie_key = ?, previous_modified_at = ?, previous_tie_key = ?,
+                        run_id = ?, staged = ?, updated_at = ?, version = version + 1
+                    WHERE table_name = ? AND version = ?
+                    """,
+                    values + (table, expected.version),
+                ).rowcount
+        if not changed:
+            raise WatermarkConflict(f"Watermark for {table} changed concurrently")
+        LOGGER.info("Watermark %s advanced to %s run_id=%s", table, bound, run_id)
+        return self.get(table)
+
+    def reset(self, table: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM watermarks WHERE table_name = ?", (table,))
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit: each statement is its own transaction, which is all the
+        # compare-and-set needs.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+
+class HighWaterTracker:
+    """Running max of ``(modifieddate, *key_columns)`` over streamed chunks."""
+
+    def __init__(self, key_columns: Tuple[str, ...], timestamp_column: str = "modifieddate") -> None:
+        self.key_columns = key_columns
+        self.timestamp_column = timestamp_column
+        self.high_water: Optional[Bound] = None
+
+    def track(self, chunks):
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+    def update(self, chunk: pd.DataFrame) -> None:
+        if chunk.empty or self.timestamp_column not in chunk:
+            return
+        timestamps = pd.to_datetime(chunk[self.timestamp_column])
+        latest = timestamps.max()
+        if pd.isna(latest):
+            return
+        # Only rows at the latest timestamp can carry the max key.
+        tied = chunk.loc[timestamps == latest, list(self.key_columns)]
+        last = tied.sort_values(list(self.key_columns)).iloc[-1] if len(tied) else []
+        candidate = (latest.to_pydatetime(), tuple(_plain(value) for value in last))
+        if self.high_water is None or candidate > self.high_water:
+            self.high_water = candidate
+
+
+def _from_row(row: sqlite3.Row) -> Watermark:
+    return Watermark(
+        table=row["table_name"],
+        modified_at=_parse(row["modified_at"]),
+        tie_key=tuple(json.loads(row["tie_key"])),
+        previous_modified_at=_parse(row["previous_modified_at"]),
+        previous_tie_key=tuple(json.loads(row["previous_tie_key"])),
+        run_id=row["run_id"],
+        staged=json.loads(row["staged"]) if row["staged"] else None,
+        version=row["version"],
+    )
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def _parse(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def _plain(value: Any) -> Any:
+    return value.item() if hasattr(value, "item") else value
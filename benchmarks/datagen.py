@@ -0,0 +1,153 @@
+"""
+Seeded, AdventureWorks-shaped synthetic frames for the benchmarks.
+"""
+
+from __future__ import annotations
+
+from decimal import Decimal
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from aggregation import date_key
+
+SIZES = {
+    "10k": 10_000,
+    "1m": 1_000_000,
+    "10m": 10_000_000,
+}
+
+# Natural key and tracked columns per dimension, as the DAG passes them to
+# loading.load_dimension_scd2.
+DIMENSIONS: Dict[str, Tuple[str, Dict[str, str]]] = {
+    "customer": (
+        "CustomerID",
+        {
+            "CustomerName": "string",
+            "Email": "string",
+            "City": "string",
+            "Country": "string",
+            "CustomerSegment": "string",
+            "AccountStatus": "string",
+        },
+    ),
+    "product": (
+        "ProductID",
+        {
+            "ListPrice": "decimal",
+            "Cost": "decimal",
+            "Category": "string",
+            "ProductStatus": "string",
+        },
+    ),
+    "store": (
+        "StoreID",
+        {
+            "Address": "string",
+            "Region": "string",
+            "Territory": "string",
+            "ManagerName": "string",
+            "StoreStatus": "string",
+        },
+    ),
+    "employee": (
+        "EmployeeID",
+        {
+            "JobTitle": "string",
+            "Department": "string",
+            "Region": "string",
+            "Territory": "string",
+            "SalesQuota": "decimal",
+        },
+    ),
+}
+
+FK_COLUMNS = {
+    "customer": "CustomerKey",
+    "product": "ProductKey",
+    "store": "StoreKey",
+    "employee": "EmployeeKey",
+}
+
+# Fact dates span a year, so partitioned inserts fan out over 12 months.
+SALES_START = "2025-01-01"
+SALES_DAYS = 365
+
+_CATEGORIES = {
+    "Country": ["United States", "Canada", "France", "Germany", "Australia", "United Kingdom"],
+    "City": ["Seattle", "Toronto", "Paris", "Berlin", "Sydney", "London", "Bothell", "Redmond"],
+    "CustomerSegment": ["Individual", "Store", "Corporate"],
+    "AccountStatus": ["Active", "Inactive", "Suspended"],
+    "Category": ["Bikes", "Components", "Clothing", "Accessories"],
+    "ProductStatus": ["Active", "Discontinued"],
+    "Region": ["North America", "Europe", "Pacific"],
+    "Territory": ["Northwest", "Northeast", "Central", "Southwest", "Southeast", "France", "Germany"],
+    "StoreStatus": ["Open", "Closed"],
+    "JobTitle": ["Sales Representative", "Sales Manager", "Buyer", "Technician"],
+    "Department": ["Sales", "Purchasing", "Production", "Marketing"],
+}
+
+
+def make_dimension(name: str, rows: int, seed: int = 7) -> pd.DataFrame:
+    """Incoming dimension frame: natural key plus tracked columns."""
+    rng = np.random.default_rng(seed)
+    natural_key, tracked = DIMENSIONS[name]
+    data: Dict[str, object] = {natural_key: np.arange(1, rows + 1, dtype=np.int64)}
+    for column, kind in tracked.items():
+        if kind == "decimal":
+            data[column] = _decimals(rng, rows, 1, 5_000)
+        elif column in _CATEGORIES:
+            data[column] = rng.choice(_CATEGORIES[column], rows)
+        else:
+            data[column] = pd.Series(rng.integers(0, rows, rows)).map(lambda value, c=column: f"{c}-{value}")
+    return pd.DataFrame(data)
+
+
+def mutate_dimension(df: pd.DataFrame, name: str, change_rate: float, new_rate: float, seed: int = 11) -> pd.DataFrame:
+    """Copy of ``df`` with a share of rows changed and a share of new keys appended."""
+    rng = np.random.default_rng(seed)
+    natural_key, tracked = DIMENSIONS[name]
+    incoming = df.copy()
+    changed = rng.random(len(incoming)) < change_rate
+    column = next(col for col, kind in tracked.items() if kind == "string")
+    incoming.loc[changed, column] = incoming.loc[changed, column].astype(str) + "-v2"
+    new_rows = make_dimension(name, max(int(len(df) * new_rate), 1), seed=seed + 1)
+    new_rows[natural_key] += int(df[natural_key].max())
+    return pd.concat([incoming, new_rows], ignore_index=True)
+
+
+def sales_date_keys(rng: np.random.Generator, rows: int, start: str = SALES_START, days: int = SALES_DAYS) -> np.ndarray:
+    """Warehouse date keys (days since the epoch) spread evenly over ``days`` from ``start``."""
+    return (date_key(start) + rng.integers(0, days, rows)).astype("uint32")
+
+
+def make_sales_order_details(rows: int, dimension_rows: int, miss_rate: float = 0.01, seed: int = 42) -> pd.DataFrame:
+    """Fact frame keyed by natural ids, with ``miss_rate`` of customers unknown."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "SalesDateKey": sales_date_keys(rng, rows),
+            "CustomerKey": rng.integers(1, dimension_rows + 1, rows),
+            "ProductKey": rng.integers(1, dimension_rows + 1, rows),
+            "StoreKey": rng.integers(1, dimension_rows + 1, rows),
+            "EmployeeKey": rng.integers(1, dimension_rows + 1, rows),
+            "SalesAmount": rng.uniform(1, 2_000, rows).round(2),
+            "Quantity": rng.integers(1, 10, rows).astype("uint32"),
+            "DiscountAmount": np.zeros(rows),
+            "TransactionCount": np.ones(rows, dtype="uint32"),
+            "OrderNumber": pd.Series(np.arange(43659, 43659 + rows)).map("SO{}".format),
+        }
+    )
+    misses = rng.random(rows) < miss_rate
+    df.loc[misses, "CustomerKey"] = dimension_rows + 1
+    return df
+
+
+def make_lookup_maps(dimension_rows: int) -> Dict[str, Dict[int, int]]:
+    keys = range(1, dimension_rows + 1)
+    return {name: {key: key + 1_000_000 for key in keys} for name in FK_COLUMNS}
+
+
+def _decimals(rng: np.random.Generator, rows: int, low: float, high: float) -> list:
+    return [Decimal(f"{value:.2f}") for value in rng.uniform(low, high, rows)]
@@ -0,0 +1,127 @@
+"""
+Rows/sec benchmark for loading.load_fact_table against the row-wise loader it replaced.
+
+Usage: python benchmarks/fact_loader_benchmark.py [--rows 10000 100000] [--miss-rate 0.01]
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sys
+import time
+from decimal import Decimal
+from typing import Dict
+
+AIRFLOW_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "airflow")
+if AIRFLOW_DIR not in sys.path:
+    sys.path.append(AIRFLOW_DIR)
+
+import numpy as np
+import pandas as pd
+
+import loading
+from aggregation import date_key
+from error_handling import log_error_record
+from fake_clickhouse import RecordingClient, patched_clickhouse
+from transformation import build_fact_payload
+
+FK_COLUMNS = {
+    "customer": "CustomerKey",
+    "product": "ProductKey",
+    "store": "StoreKey",
+    "employee": "EmployeeKey",
+}
+
+
+def make_fact_frame(rows: int, miss_rate: float, seed: int = 42) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "SalesDateKey": (date_key("2025-01-01") + rng.integers(0, 365, rows)).astype("uint32"),
+            "CustomerKey": rng.integers(1, 20_000, rows),
+            "ProductKey": rng.integers(1, 500, rows),
+            "StoreKey": rng.integers(1, 700, rows),
+            "EmployeeKey": rng.integers(1, 300, rows),
+            "SalesAmount": [Decimal(f"{value:.2f}") for value in rng.uniform(1, 2_000, rows)],
+            "Quantity": rng.integers(1, 10, rows).astype("uint32"),
+            "DiscountAmount": [Decimal("0.00")] * rows,
+            "TransactionCount": np.ones(rows, dtype="uint32"),
+            "OrderNumber": [f"SO{43659 + index}" for index in range(rows)],
+        }
+    )
+    misses = rng.random(rows) < miss_rate
+    df.loc[misses, "CustomerKey"] = 0
+    return df
+
+
+def make_lookup_maps() -> Dict[str, Dict[int, int]]:
+    return {
+        "customer": {key: key + 1_000_000 for key in range(1, 20_000)},
+        "product": {key: key + 1_000_000 for key in range(1, 500)},
+        "store": {key: key + 1_000_000 for key in range(1, 700)},
+        "employee": {key: key + 1_000_000 for key in range(1, 300)},
+    }
+
+
+def legacy_load_fact_table(fact_name, fact_df, lookup_maps, fk_columns, client, processing_batch_id):
+    # The iterrows loader as it was before the vectorized rewrite.
+    enriched = build_fact_payload(fact_name, fact_df, lookup_maps, fk_columns)
+    success_rows = []
+    error_rows = 0
+    for idx, row in enriched.iterrows():
+        if row.isnull().any():
+            log_error_record(
+                client=client,
+                error_type="ForeignKeyMissing",
+                error_message=f"Null FK in {fact_name}",
+                failed_data={key: str(value) for key, value in row.to_dict().items()},
+                source_table=fact_name,
+                natural_key=str(idx),
+                processing_batch_id=processing_batch_id,
+                task_name="load_fact_tables",
+                is_recoverable=True,
+            )
+            error_rows += 1
+            continue
+        success_rows.append(row.to_dict())
+    if success_rows:
+        client.execute(f"INSERT INTO {fact_name} VALUES", success_rows)
+    return len(success_rows), error_rows
+
+
+def run(rows: int, miss_rate: float) -> None:
+    fact_df = make_fact_frame(rows, miss_rate)
+    lookup_maps = make_lookup_maps()
+
+    legacy_client = RecordingClient()
+    started = time.perf_counter()
+    legacy_load_fact_table("FactSales", fact_df, lookup_maps, FK_COLUMNS, legacy_client, "bench")
+    legacy_seconds = time.perf_counter() - started
+
+    with patched_clickhouse(loading, RecordingClient()) as vector_client:
+        started = time.perf_counter()
+        loading.load_fact_table("FactSales", fact_df, lookup_maps, FK_COLUMNS, None, "bench")
+        vector_seconds = time.perf_counter() - started
+
+    print(
+        f"rows={rows:>9} "
+        f"legacy={rows / legacy_seconds:>12,.0f} rows/s ({legacy_client.calls} calls) "
+        f"vectorized={rows / vector_seconds:>12,.0f} rows/s ({vector_client.calls} calls) "
+        f"speedup={legacy_seconds / vector_seconds:.1f}x"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--miss-rate", type=float, default=0.01)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    for rows in args.rows:
+        run(rows, args.miss_rate)
+
+
+if __name__ == "__main__":
+    main()
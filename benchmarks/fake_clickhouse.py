@@ -0,0 +1,128 @@
+"""
+In-process stand-in for clickhouse_driver.Client used by the benchmarks.
+"""
+
+from __future__ import annotations
+
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+
+from utilities import ClickHouseConfig
+
+_INSERT_TABLE = re.compile(r"INSERT\s+INTO\s+`?([\w.]+)", re.IGNORECASE)
+_ALTER_TABLE = re.compile(r"ALTER\s+TABLE\s+`?([\w.]+)`?\s+(\w+)", re.IGNORECASE)
+
+
+class RecordingClient:
+    """
+    Accepts every call, keeps nothing but counters, and answers SELECTs with no rows.
+
+    Per target table it counts inserted rows and insert blocks (``INSERT ...
+    SELECT`` counts a block with no client-side rows). It also counts
+    mutations (``ALTER ... UPDATE``/``DELETE``) and partition operations
+    (``ALTER ... DROP``/``REPLACE PARTITION``). An insert whose
+    ``insert_deduplication_token`` was already seen for its table is dropped
+    and counted as deduplicated, like ClickHouse does. Counters are safe to
+    update from concurrent insert blocks.
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.rows = 0
+        self.inserts = 0
+        self.mutations = 0
+        self.partition_ops = 0
+        self.insert_rows: Counter = Counter()
+        self.insert_blocks: Counter = Counter()
+        self.table_mutations: Counter = Counter()
+        self.deduplicated = 0
+        self._tokens: Set[Tuple[str, str]] = set()
+        self._lock = threading.Lock()
+
+    def execute(self, query: str, params: Any = None, columnar: bool = False, **kwargs: Any) -> Any:
+        with self._lock:
+            self.calls += 1
+        statement = query.lstrip().upper()
+        if statement.startswith("INSERT"):
+            match = _INSERT_TABLE.match(query.lstrip())
+            table = match.group(1) if match else ""
+            token = (kwargs.get("settings") or {}).get("insert_deduplication_token")
+            if token is not None:
+                with self._lock:
+                    if (table, token) in self._tokens:
+                        self.deduplicated += 1
+                        return None
+                    self._tokens.add((table, token))
+            rows = 0
+            if params and " VALUES" in statement:
+                rows = len(params[0]) if columnar else len(params)
+            self._record_insert(table, rows)
+            return None
+        if statement.startswith("ALTER"):
+            match = _ALTER_TABLE.match(query.lstrip())
+            action = match.group(2).upper() if match else ""
+            with self._lock:
+                if action in ("UPDATE", "DELETE"):
+                    self.mutations += 1
+                    self.table_mutations[match.group(1)] += 1
+                else:
+                    self.partition_ops += 1
+            return None
+        if kwargs.get("with_column_types"):
+            return [], []
+        return []
+
+    def counters(self) -> Dict[str, Any]:
+        """JSON-safe copy of every counter."""
+        return {
+            "calls": self.calls,
+            "rows": self.rows,
+            "inserts": self.inserts,
+            "mutations": self.mutations,
+            "partition_ops": self.partition_ops,
+            "deduplicated": self.deduplicated,
+            "insert_rows": dict(self.insert_rows),
+            "insert_blocks": dict(self.insert_blocks),
+            "table_mutations": dict(self.table_mutations),
+        }
+
+    def _record_insert(self, table: str, rows: int) -> None:
+        with self._lock:
+            self.inserts += 1
+            self.rows += rows
+            self.insert_rows[table] += rows
+            self.insert_blocks[table] += 1
+
+
+class StandInManager:
+    """``ClickHouseClientManager`` stand-in whose pooled clients are all ``client``."""
+
+    def __init__(self, client: RecordingClient, cfg: Optional[ClickHouseConfig] = None) -> None:
+        self._client = client
+        self.cfg = cfg or ClickHouseConfig(host="", port=0, user="", password="", database="")
+
+    @contextmanager
+    def client(self, timeout: Any = None) -> Iterator[RecordingClient]:
+        yield self._client
+
+
+@contextmanager
+def patched_clickhouse(module: Any, client: RecordingClient) -> Iterator[RecordingClient]:
+    """
+    Route ``module.get_clickhouse_client`` (and ``get_clickhouse_manager``,
+    when the module uses it) to ``client`` for the duration of the block.
+    """
+    original_client = module.get_clickhouse_client
+    original_manager = getattr(module, "get_clickhouse_manager", None)
+    module.get_clickhouse_client = lambda cfg: client
+    if original_manager is not None:
+        module.get_clickhouse_manager = lambda cfg: StandInManager(client)
+    try:
+        yield client
+    finally:
+        module.get_clickhouse_client = original_client
+        if original_manager is not None:
+            module.get_clickhouse_manager = original_manager
@@ -0,0 +1,382 @@
+"""
+Record-and-replay throughput harness for the validate/load/aggregate pipeline.
+
+Usage:
+    python benchmarks/replay.py capture --run-id RUN_ID --processing-date 2025-06-01 --snapshot DIR
+    python benchmarks/replay.py replay --snapshot DIR [--repeat 3] [--apply-mode insert] [--output results.json]
+    python benchmarks/replay.py compare OLD.json NEW.json
+
+``capture`` copies a staged run's extracted tables and records the ClickHouse
+reads the load tasks start from (current dimension rows and key lookups),
+using the DWH_CH_* environment variables. ``replay`` runs the snapshot
+through validation, the SCD2 dimension loads, the fact loads and the
+aggregate refresh against an in-process ClickHouse stand-in, and reports
+time per stage with insert volumes and mutation counts.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+AIRFLOW_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "airflow")
+if AIRFLOW_DIR not in sys.path:
+    sys.path.append(AIRFLOW_DIR)
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+import key_cache
+import loading
+import staging
+import validation
+from error_handling import ErrorRecordWriter
+from fake_clickhouse import RecordingClient, patched_clickhouse
+from utilities import clickhouse_config_from_env, get_clickhouse_client, get_processing_batch_id
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "results")
+SNAPSHOT_FILE = "snapshot.json"
+INPUTS_DIR = "inputs"
+READS_DIR = "reads"
+
+# ClickHouse column types whose Python values Arrow would infer too narrowly.
+_ARROW_TYPES = {
+    "UInt8": pa.uint8(),
+    "UInt16": pa.uint16(),
+    "UInt32": pa.uint32(),
+    "UInt64": pa.uint64(),
+    "Int8": pa.int8(),
+    "Int16": pa.int16(),
+    "Int32": pa.int32(),
+    "Int64": pa.int64(),
+    "Date": pa.date32(),
+}
+_NULLABLE = re.compile(r"^Nullable\((.*)\)$")
+
+
+def _query_key(query: str) -> str:
+    return " ".join(query.split())
+
+
+def _to_arrow(columns: List[List[Any]], column_types: List[Tuple[str, str]]) -> pa.Table:
+    arrays = []
+    for values, (_, ch_type) in zip(columns, column_types):
+        match = _NULLABLE.match(ch_type)
+        arrays.append(pa.array(values, type=_ARROW_TYPES.get(match.group(1) if match else ch_type)))
+    return pa.Table.from_arrays(arrays, names=[name for name, _ in column_types])
+
+
+class CapturingClient:
+    """
+    Read-only proxy over a real client that keeps every SELECT result.
+
+    Anything other than a SELECT raises, so a capture can never write to the
+    warehouse it reads from.
+    """
+
+    def __init__(self, client) -> None:
+        self.client = client
+        self.reads: Dict[str, Tuple[pa.Table, List[Tuple[str, str]]]] = {}
+
+    def execute(self, query: str, params: Any = None, columnar: bool = False, with_column_types: bool = False, **kwargs):
+        if not query.lstrip().upper().startswith("SELECT"):
+            raise RuntimeError(f"Capture is read-only, refusing: {query[:80]}")
+        data, column_types = self.client.execute(
+            query, params, columnar=columnar, with_column_types=True, **kwargs
+        )
+        columns = data if columnar else [list(column) for column in zip(*data)] or [[] for _ in column_types]
+        self.reads[_query_key(query)] = (_to_arrow(columns, column_types), column_types)
+        return (data, column_types) if with_column_types else data
+
+
+class ReplayClient(RecordingClient):
+    """``RecordingClient`` that answers recorded SELECTs with their captured rows."""
+
+    def __init__(self, reads: Dict[str, Tuple[pa.Table, List[Tuple[str, str]]]]) -> None:
+        super().__init__()
+        self.reads = reads
+
+    def execute(self, query: str, params: Any = None, columnar: bool = False, **kwargs: Any) -> Any:
+        recorded = self.reads.get(_query_key(query))
+        if recorded is None:
+            return super().execute(query, params, columnar=columnar, **kwargs)
+        self.calls += 1
+        table, column_types = recorded
+        columns = [column.to_pylist() for column in table.columns]
+        data = columns if columnar else list(zip(*columns))
+        return (data, column_types) if kwargs.get("with_column_types") else data
+
+
+@contextmanager
+def _empty_key_cache() -> Iterator[None]:
+    # Every SurrogateKeyCache starts empty, so lookups issue the same full
+    # refresh query at capture and at replay.
+    original = key_cache.KEY_CACHE_DIR
+    with tempfile.TemporaryDirectory() as cache_dir:
+        key_cache.KEY_CACHE_DIR = Path(cache_dir)
+        try:
+            yield
+        finally:
+            key_cache.KEY_CACHE_DIR = original
+
+
+def capture(
+    run_id: str,
+    processing_date: str,
+    snapshot_dir: Path,
+    client,
+    staging_dir: Optional[Path] = None,
+) -> Dict[str, Any]:
+    """Copy ``run_id``'s staged tables into ``snapshot_dir`` and record the load tasks' reads."""
+    source = staging.manifest_for_run(run_id, staging_dir)
+    if not source:
+        raise ValueError(f"No staged tables found for run {run_id}")
+    inputs_dir = snapshot_dir / INPUTS_DIR
+    inputs_dir.mkdir(parents=True, exist_ok=True)
+    for entry in source.values():
+        shutil.copyfile(entry["path"], inputs_dir / Path(entry["path"]).name)
+
+    proxy = CapturingClient(client)
+    with _empty_key_cache():
+        for spec in loading.DIMENSION_SPECS.values():
+            proxy.execute(spec.current_query, with_column_types=True)
+        for spec in loading.FACT_SPECS.values():
+            spec.lookup_maps(proxy)
+
+    reads_dir = snapshot_dir / READS_DIR
+    reads_dir.mkdir(parents=True, exist_ok=True)
+    reads = []
+    for index, (query, (table, column_types)) in enumerate(proxy.reads.items()):
+        path = reads_dir / f"{index:03d}.arrow"
+        feather.write_feather(table, path, compression="uncompressed")
+        reads.append(
+            {
+                "query": query,
+                "path": str(path.relative_to(snapshot_dir)),
+                "rows": table.num_rows,
+                "column_types": column_types,
+            }
+        )
+
+    snapshot = {
+        "run_id": run_id,
+        "processing_date": processing_date,
+        "captured": datetime.utcnow().isoformat(),
+        "inputs": {name: entry["row_count"] for name, entry in source.items()},
+        "reads": reads,
+    }
+    with (snapshot_dir / SNAPSHOT_FILE).open("w", encoding="utf-8") as handle:
+        json.dump(snapshot, handle, indent=2)
+    print(f"Captured {len(source)} tables and {len(reads)} reads into {snapshot_dir}")
+    return snapshot
+
+
+def _load_snapshot(snapshot_dir: Path) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]], Dict[str, Any]]:
+    with (snapshot_dir / SNAPSHOT_FILE).open("r", encoding="utf-8") as handle:
+        snapshot = json.load(handle)
+    manifest = staging.manifest_for_run(INPUTS_DIR, snapshot_dir)
+    reads = {
+        read["query"]: (
+            feather.read_table(snapshot_dir / read["path"]),
+            [tuple(column_type) for column_type in read["column_types"]],
+        )
+        for read in snapshot["reads"]
+    }
+    return snapshot, manifest, reads
+
+
+def replay_once(snapshot: Dict[str, Any], manifest, reads, apply_mode: Optional[str] = None) -> Dict[str, Any]:
+    """Run the snapshot through every load stage once; returns per-stage timings and counters."""
+    processing_date = snapshot["processing_date"]
+    client = ReplayClient(reads)
+    stages: List[Dict[str, Any]] = []
+
+    def run_stage(name: str, fn: Callable[[], Any]) -> Any:
+        before = client.counters()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = fn()
+        after = client.counters()
+        stages.append(
+            {
+                "stage": name,
+                "seconds": time.perf_counter() - wall_start,
+                "cpu_seconds": time.process_time() - cpu_start,
+                "inserts": after["inserts"] - before["inserts"],
+                "insert_rows": after["rows"] - before["rows"],
+                "mutations": after["mutations"] - before["mutations"],
+                "partition_ops": after["partition_ops"] - before["partition_ops"],
+            }
+        )
+        return result
+
+    def frames(tables: List[str]) -> Dict[str, pd.DataFrame]:
+        # Each DAG task memory-maps its own frames; reading is part of its cost.
+        return staging.load_staged_frames(manifest, tables)
+
+    def validate() -> Any:
+        with ErrorRecordWriter(client) as error_writer:
+            return validation.validate_extracted_data(
+                frames(list(manifest)), error_writer, get_processing_batch_id(processing_date, "validation")
+            )
+
+    def load_dimension(spec: loading.DimensionSpec) -> Any:
+        data, column_types = client.execute(spec.current_query, with_column_types=True)
+        current = pd.DataFrame(data, columns=[name for name, _ in column_types])
+        incoming = frames([spec.source]).get(spec.source, pd.DataFrame())
+        return loading.load_dimension_spec(spec, current, incoming, processing_date, None, apply_mode)
+
+    def load_fact(spec: loading.FactSpec) -> Dict[str, Any]:
+        return loading.load_fact_spec(
+            spec,
+            frames([spec.source]).get(spec.source, pd.DataFrame()),
+            None,
+            get_processing_batch_id(processing_date, spec.name),
+        )
+
+    with _empty_key_cache(), patched_clickhouse(loading, client):
+        started = time.perf_counter()
+        run_stage("validate", validate)
+        for spec in loading.DIMENSION_SPECS.values():
+            run_stage(f"load_dim_{spec.name}", lambda spec=spec: load_dimension(spec))
+        loads = [run_stage(f"load_{spec.name}", lambda spec=spec: load_fact(spec)) for spec in loading.FACT_SPECS.values()]
+        touched = {load["fact"]: load["date_keys"] for load in loads}
+        run_stage("update_aggregates", lambda: loading.update_aggregates(processing_date, None, touched or None))
+        total = time.perf_counter() - started
+    return {"seconds": total, "stages": stages, "clickhouse": client.counters()}
+
+
+def replay(snapshot_dir: Path, repeat: int = 1, apply_mode: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Replay ``snapshot_dir`` ``repeat`` times and report median timings.
+
+    Counters come from the last run; they are identical across runs of the
+    same code.
+    """
+    snapshot, manifest, reads = _load_snapshot(snapshot_dir)
+    runs = [replay_once(snapshot, manifest, reads, apply_mode) for _ in range(repeat)]
+    input_rows = sum(snapshot["inputs"].values())
+    stages = runs[-1]["stages"]
+    for index, stage in enumerate(stages):
+        stage["seconds"] = float(np.median([run["stages"][index]["seconds"] for run in runs]))
+        stage["cpu_seconds"] = float(np.median([run["stages"][index]["cpu_seconds"] for run in runs]))
+    seconds = float(np.median([run["seconds"] for run in runs]))
+    for stage in stages:
+        print(
+            f"{stage['stage']:<28} {stage['seconds'] * 1000:>10.1f}ms "
+            f"inserts={stage['inserts']:>5} rows={stage['insert_rows']:>10} "
+            f"mutations={stage['mutations']:>4} partition_ops={stage['partition_ops']:>4}"
+        )
+    print(f"{'total':<28} {seconds * 1000:>10.1f}ms rows/s={input_rows / seconds if seconds else 0:,.0f}")
+    return {
+        "snapshot": str(snapshot_dir),
+        "run_id": snapshot["run_id"],
+        "processing_date": snapshot["processing_date"],
+        "apply_mode": apply_mode or loading.SCD2_APPLY_MODE,
+        "repeat": repeat,
+        "input_rows": input_rows,
+        "seconds": seconds,
+        "rows_per_second": input_rows / seconds if seconds else None,
+        "stages": stages,
+        "clickhouse": runs[-1]["clickhouse"],
+    }
+
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path, encoding="utf-8") as handle:
+        old = json.load(handle)["results"]
+    with open(new_path, encoding="utf-8") as handle:
+        new = json.load(handle)["results"]
+    if old["snapshot"] != new["snapshot"]:
+        print(f"Warning: different snapshots {old['snapshot']} and {new['snapshot']}")
+    old_stages = {stage["stage"]: stage for stage in old["stages"]}
+    for stage in new["stages"]:
+        before = old_stages.get(stage["stage"])
+        if before is None:
+            print(f"{stage['stage']:<28} new stage")
+            continue
+        ratio = stage["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+        changes = [
+            f"{counter} {before[counter]}->{stage[counter]}"
+            for counter in ("inserts", "insert_rows", "mutations", "partition_ops")
+            if before[counter] != stage[counter]
+        ]
+        # Sub-millisecond stages are noise; only flag slowdowns worth a look.
+        slower = ratio > 1.10 and stage["seconds"] - before["seconds"] > 0.005
+        flag = "  REGRESSION" if slower else ""
+        print(f"{stage['stage']:<28} time x{ratio:5.2f}{flag}  {', '.join(changes)}")
+    print(f"{'total':<28} time x{new['seconds'] / old['seconds']:5.2f}")
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Pipeline record-and-replay harness")
+    commands = parser.add_subparsers(dest="command", required=True)
+    capture_parser = commands.add_parser("capture", help="Snapshot a staged run and its ClickHouse reads")
+    capture_parser.add_argument("--run-id", required=True)
+    capture_parser.add_argument("--processing-date", required=True, help="The run's ds (YYYY-MM-DD)")
+    capture_parser.add_argument("--snapshot", required=True, type=Path)
+    capture_parser.add_argument("--staging-dir", type=Path, help="Default: DWH_STAGING_DIR")
+    replay_parser = commands.add_parser("replay", help="Replay a snapshot against the stand-in")
+    replay_parser.add_argument("--snapshot", required=True, type=Path)
+    replay_parser.add_argument("--repeat", type=int, default=1)
+    replay_parser.add_argument("--apply-mode", choices=["mutation", "insert"], help="SCD2 apply mode")
+    replay_parser.add_argument("--output", help="JSON file to write (default: benchmarks/results/replay_<commit>_<time>.json)")
+    compare_parser = commands.add_parser("compare", help="Compare two replay result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.old, args.new)
+        return
+    if args.command == "capture":
+        client = get_clickhouse_client(clickhouse_config_from_env())
+        capture(args.run_id, args.processing_date, args.snapshot, client, args.staging_dir)
+        return
+
+    logging.disable(logging.WARNING)
+    results = replay(args.snapshot, args.repeat, args.apply_mode)
+    commit = _git_commit()
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"replay_{commit}_{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as handle:
+        json.dump(
+            {
+                "commit": commit,
+                "created": datetime.utcnow().isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            },
+            handle,
+            indent=2,
+        )
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Micro-benchmarks for the transform and load hot paths.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--size 10k 1m 10m] [--repeat 5] [--output results.json]
+    python benchmarks/run_benchmarks.py --compare old.json new.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+
+AIRFLOW_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "airflow")
+if AIRFLOW_DIR not in sys.path:
+    sys.path.append(AIRFLOW_DIR)
+
+import numpy as np
+
+import loading
+import transformation
+import validation
+from datagen import (
+    DIMENSIONS,
+    FK_COLUMNS,
+    SIZES,
+    make_dimension,
+    make_lookup_maps,
+    make_sales_order_details,
+    mutate_dimension,
+)
+from fake_clickhouse import RecordingClient, patched_clickhouse
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "results")
+
+
+def measure(name: str, rows: int, fn: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    p50 = float(np.percentile(timings, 50))
+    result = {
+        "benchmark": name,
+        "rows": rows,
+        "repeat": repeat,
+        "p50_seconds": p50,
+        "p95_seconds": float(np.percentile(timings, 95)),
+        "max_seconds": max(timings),
+        "rows_per_second": rows / p50 if p50 else None,
+        "peak_memory_bytes": peak,
+    }
+    print(
+        f"{name:<28} rows={rows:>10} p50={p50 * 1000:>10.1f}ms "
+        f"p95={result['p95_seconds'] * 1000:>10.1f}ms "
+        f"rows/s={result['rows_per_second']:>14,.0f} peak={peak / 2**20:>8.1f}MiB"
+    )
+    return result
+
+
+def run_size(label: str, repeat: int) -> List[Dict[str, Any]]:
+    rows = SIZES[label]
+    results: List[Dict[str, Any]] = []
+
+    customer_natural_key, customer_tracked = DIMENSIONS["customer"]
+    current = make_dimension("customer", rows)
+    incoming = mutate_dimension(current, "customer", change_rate=0.05, new_rate=0.01)
+    current_hashes = current[[customer_natural_key]].assign(
+        RowHash=transformation.compute_row_hash(current, customer_tracked)
+    )
+    results.append(
+        measure(
+            "detect_scd2_changes",
+            len(incoming),
+            lambda: transformation.detect_scd2_changes(
+                current, incoming, customer_natural_key, list(customer_tracked)
+            ),
+            repeat,
+        )
+    )
+    results.append(
+        measure(
+            "detect_scd2_changes_by_hash",
+            len(incoming),
+            lambda: transformation.detect_scd2_changes_by_hash(
+                current_hashes, incoming, customer_natural_key, customer_tracked
+            ),
+            repeat,
+        )
+    )
+
+    fact_df = make_sales_order_details(rows, dimension_rows=min(rows, 100_000))
+    lookup_maps = make_lookup_maps(min(rows, 100_000))
+    results.append(
+        measure(
+            "build_fact_payload",
+            rows,
+            lambda: transformation.build_fact_payload("FactSales", fact_df, lookup_maps, FK_COLUMNS),
+            repeat,
+        )
+    )
+
+    frames = {name: make_dimension(name, rows) for name in DIMENSIONS}
+    frames["FactSales"] = fact_df
+    rules = {
+        name: validation.TableRules(unique=(natural_key,), not_null=(natural_key,))
+        for name, (natural_key, _) in DIMENSIONS.items()
+    }
+    rules["FactSales"] = validation.TableRules(
+        unique=("OrderNumber",),
+        not_null=tuple(FK_COLUMNS.values()),
+        ranges={"SalesAmount": (0, None), "Quantity": (1, None), "DiscountAmount": (0, None)},
+    )
+    results.append(
+        measure(
+            "validate_extracted_data",
+            sum(len(frame) for frame in frames.values()),
+            lambda: validation.validate_extracted_data(frames, rules=rules),
+            repeat,
+        )
+    )
+
+    with patched_clickhouse(loading, RecordingClient()):
+        results.append(
+            measure(
+                "load_fact_table",
+                rows,
+                lambda: loading.load_fact_table("FactSales", fact_df, lookup_maps, FK_COLUMNS, None, "bench"),
+                repeat,
+            )
+        )
+    for result in results:
+        result["size"] = label
+    return results
+
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path, encoding="utf-8") as handle:
+        old = {(r["size"], r["benchmark"]): r for r in json.load(handle)["results"]}
+    with open(new_path, encoding="utf-8") as handle:
+        new = {(r["size"], r["benchmark"]): r for r in json.load(handle)["results"]}
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key]["p50_seconds"] / old[key]["p50_seconds"]
+        memory = new[key]["peak_memory_bytes"] / max(old[key]["peak_memory_bytes"], 1)
+        flag = "  REGRESSION" if ratio > 1.10 else ""
+        print(f"{key[0]:>4} {key[1]:<28} time x{ratio:5.2f}  memory x{memory:5.2f}{flag}")
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Transform/load micro-benchmarks")
+    parser.add_argument("--size", nargs="+", choices=sorted(SIZES), default=["10k"])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="JSON file to write (default: benchmarks/results/<commit>_<time>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    logging.disable(logging.WARNING)
+    results: List[Dict[str, Any]] = []
+    for label in args.size:
+        results.extend(run_size(label, args.repeat))
+
+    commit = _git_commit()
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{commit}_{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as handle:
+        json.dump(
+            {
+                "commit": commit,
+                "created": datetime.utcnow().isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            },
+            handle,
+            indent=2,
+        )
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -47,6 +47,8 @@ CREATE TABLE IF NOT EXISTS DimCustomer
     ValidFromDate Date,
     ValidToDate Nullable(Date),
     IsCurrent UInt8,
+    RowHash UInt64 DEFAULT 0,
+    LoadedAt DateTime64(3) DEFAULT now64(3),
     SourceUpdateDate Date,
     EffectiveStartDate Date,
     EffectiveEndDate Nullable(Date)
@@ -73,6 +75,8 @@ CREATE TABLE IF NOT EXISTS DimProduct
     ValidFromDate Date,
     ValidToDate Nullable(Date),
     IsCurrent UInt8,
+    RowHash UInt64 DEFAULT 0,
+    LoadedAt DateTime64(3) DEFAULT now64(3),
     SourceUpdateDate Date,
     EffectiveStartDate Date,
     EffectiveEndDate Nullable(Date)
@@ -102,6 +106,8 @@ CREATE TABLE IF NOT EXISTS DimStore
     ValidFromDate Date,
     ValidToDate Nullable(Date),
     IsCurrent UInt8,
+    RowHash UInt64 DEFAULT 0,
+    LoadedAt DateTime64(3) DEFAULT now64(3),
     SourceUpdateDate Date
 )
 ENGINE = ReplacingMergeTree(ValidFromDate)
@@ -124,6 +130,8 @@ CREATE TABLE IF NOT EXISTS DimEmployee
     ValidFromDate Date,
     ValidToDate Nullable(Date),
     IsCurrent UInt8,
+    RowHash UInt64 DEFAULT 0,
+    LoadedAt DateTime64(3) DEFAULT now64(3),
     SourceUpdateDate Date
 )
 ENGINE = ReplacingMergeTree(ValidFromDate)
@@ -170,6 +178,7 @@ CREATE TABLE IF NOT EXISTS DimVendor
     ValidFromDate Date,
     ValidToDate Nullable(Date),
     IsCurrent UInt8,
+    LoadedAt DateTime64(3) DEFAULT now64(3),
     SourceUpdateDate Date
 )
 ENGINE = ReplacingMergeTree(ValidFromDate)
@@ -206,7 +215,8 @@ CREATE TABLE IF NOT EXISTS DimWarehouse
     ManagerKey Nullable(UInt32),
     ValidFromDate Date,
     ValidToDate Nullable(Date),
-    IsCurrent UInt8
+    IsCurrent UInt8,
+    LoadedAt DateTime64(3) DEFAULT now64(3)
 )
 ENGINE = ReplacingMergeTree(ValidFromDate)
 ORDER BY (WarehouseID, ValidFromDate)
@@ -17,6 +17,9 @@ ENGINE = MergeTree()
 ORDER BY (SalesDateKey, StoreKey, ProductKey, CustomerKey)
 PARTITION BY toYYYYMM(toDate(SalesDateKey));
 
+-- Backfill chunks are assembled here and swapped in with REPLACE PARTITION (airflow/backfill.py).
+CREATE TABLE IF NOT EXISTS FactSales_staging AS FactSales;
+
 CREATE TABLE IF NOT EXISTS FactPurchases
 (
     PurchaseDateKey UInt32,
@@ -14,21 +14,35 @@ ENGINE = SummingMergeTree((TotalRevenue, TotalQuantity, TotalDiscount, Transacti
 ORDER BY (SalesDateKey, StoreKey, ProductCategoryKey)
 PARTITION BY toYYYYMM(toDate(SalesDateKey));
 
-CREATE MATERIALIZED VIEW IF NOT EXISTS mv_agg_daily_sales
-TO agg_daily_sales
-AS
-SELECT
-    SalesDateKey,
-    StoreKey,
-    ProductCategoryKey,
-    sum(SalesAmount) AS TotalRevenue,
-    sum(Quantity) AS TotalQuantity,
-    sum(DiscountAmount) AS TotalDiscount,
-    count() AS TransactionCount
-FROM FactSales
-INNER JOIN DimProduct ON FactSales.ProductKey = DimProduct.ProductKey
-INNER JOIN DimProductCategory ON DimProduct.Category = DimProductCategory.CategoryName
-GROUP BY SalesDateKey, StoreKey, ProductCategoryKey;
+-- Mergeable daily states: the only aggregate read from FactSales. Weekly,
+-- monthly and regional rollups merge these states, so averages, min/max and
+-- distinct counts stay exact at every grain.
+CREATE TABLE IF NOT EXISTS agg_daily_sales_state
+(
+    SalesDateKey UInt32,
+    StoreKey UInt32,
+    ProductCategoryKey UInt32,
+    CustomerSegmentKey UInt32,
+    TotalRevenue SimpleAggregateFunction(sum, Decimal(38, 2)),
+    TotalQuantity SimpleAggregateFunction(sum, UInt64),
+    TotalDiscount SimpleAggregateFunction(sum, Decimal(38, 2)),
+    TransactionCount SimpleAggregateFunction(sum, UInt64),
+    RevenueAvg AggregateFunction(avg, Decimal(18, 2)),
+    RevenueMin SimpleAggregateFunction(min, Decimal(18, 2)),
+    RevenueMax SimpleAggregateFunction(max, Decimal(18, 2)),
+    OrderCount AggregateFunction(uniqExact, String),
+    CustomerCount AggregateFunction(uniqExact, UInt32)
+)
+ENGINE = AggregatingMergeTree()
+ORDER BY (SalesDateKey, StoreKey, ProductCategoryKey, CustomerSegmentKey)
+PARTITION BY toYYYYMM(toDate(SalesDateKey));
+
+-- Aggregates are rebuilt per touched partition by aggregation.refresh_aggregates:
+-- each partition is assembled in its <table>_staging copy and swapped in with
+-- REPLACE PARTITION, one row per key. There is no materialized view feeding
+-- them, so reruns do not double count.
+CREATE TABLE IF NOT EXISTS agg_daily_sales_state_staging AS agg_daily_sales_state;
+CREATE TABLE IF NOT EXISTS agg_daily_sales_staging AS agg_daily_sales;
 
 CREATE TABLE IF NOT EXISTS agg_weekly_sales
 (
@@ -95,4 +109,7 @@ ENGINE = SummingMergeTree((Revenue, GrowthRate))
 ORDER BY (MonthStartDateKey, RegionKey, SalesTerritoryKey)
 PARTITION BY toYYYYMM(toDate(MonthStartDateKey));
 
-
+CREATE TABLE IF NOT EXISTS agg_weekly_sales_staging AS agg_weekly_sales;
+CREATE TABLE IF NOT EXISTS agg_monthly_sales_staging AS agg_monthly_sales;
+CREATE TABLE IF NOT EXISTS agg_monthly_product_performance_staging AS agg_monthly_product_performance;
+CREATE TABLE IF NOT EXISTS agg_regional_sales_staging AS agg_regional_sales;
@@ -2,7 +2,7 @@
 
 CREATE TABLE IF NOT EXISTS error_records
 (
-    ErrorID UInt64,
+    ErrorID UInt128,
     ErrorDate DateTime,
     SourceTable String,
     RecordNaturalKey String,
@@ -23,16 +23,96 @@ ENGINE = MergeTree()
 ORDER BY (ErrorDate, SourceTable, ErrorType)
 PARTITION BY toYYYYMM(ErrorDate);
 
+-- Status transitions of error_records rows, appended by the reprocessing task
+-- instead of mutating error_records. The row with the highest Version is the
+-- current status of an ErrorID.
+CREATE TABLE IF NOT EXISTS error_record_status
+(
+    ErrorID UInt128,
+    Status String,
+    RetryCount UInt8,
+    IsResolved UInt8,
+    ResolutionComment Nullable(String),
+    LastAttemptDate DateTime,
+    Version UInt64
+)
+ENGINE = ReplacingMergeTree(Version)
+ORDER BY ErrorID;
+
+-- error_records with their latest status applied.
+CREATE VIEW IF NOT EXISTS error_records_current AS
+SELECT
+    e.ErrorID AS ErrorID,
+    e.ErrorDate AS ErrorDate,
+    e.SourceTable AS SourceTable,
+    e.RecordNaturalKey AS RecordNaturalKey,
+    e.ErrorType AS ErrorType,
+    e.ErrorSeverity AS ErrorSeverity,
+    e.ErrorMessage AS ErrorMessage,
+    e.ErrorDetails AS ErrorDetails,
+    e.FailedData AS FailedData,
+    e.ProcessingBatchID AS ProcessingBatchID,
+    e.TaskName AS TaskName,
+    e.IsRecoverable AS IsRecoverable,
+    greatest(e.RetryCount, s.RetryCount) AS RetryCount,
+    greatest(e.LastAttemptDate, s.LastAttemptDate) AS LastAttemptDate,
+    greatest(e.IsResolved, s.IsResolved) AS IsResolved,
+    if(s.ErrorID = 0, e.ResolutionComment, s.ResolutionComment) AS ResolutionComment,
+    if(s.ErrorID = 0, if(e.IsResolved = 1, 'Resolved', 'Open'), s.Status) AS Status
+FROM error_records AS e
+LEFT JOIN (SELECT * FROM error_record_status FINAL) AS s ON e.ErrorID = s.ErrorID;
+
+-- Error counts per hour and per day (Grain = 'hour' / 'day'), kept current by
+-- the materialized views below as error_records are written. ResolvedCount is
+-- added by error_handling.reprocess_foreign_key_errors, in the bucket of the
+-- original ErrorDate, so ErrorCount - ResolvedCount is the open backlog.
 CREATE TABLE IF NOT EXISTS error_monitoring_summary
 (
     SnapshotDate DateTime,
+    Grain String,
+    SourceTable String,
     ErrorType String,
+    TaskName String,
+    ProcessingBatchID String,
     ErrorCount UInt64,
     RecoverableCount UInt64,
-    CriticalCount UInt64
+    CriticalCount UInt64,
+    ResolvedCount UInt64
 )
-ENGINE = SummingMergeTree((ErrorCount, RecoverableCount, CriticalCount))
-ORDER BY (SnapshotDate, ErrorType)
+ENGINE = SummingMergeTree((ErrorCount, RecoverableCount, CriticalCount, ResolvedCount))
+ORDER BY (Grain, SnapshotDate, SourceTable, ErrorType, TaskName, ProcessingBatchID)
 PARTITION BY toYYYYMM(SnapshotDate);
 
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_error_monitoring_hourly
+TO error_monitoring_summary
+AS
+SELECT
+    toStartOfHour(ErrorDate) AS SnapshotDate,
+    'hour' AS Grain,
+    SourceTable,
+    ErrorType,
+    TaskName,
+    ProcessingBatchID,
+    count() AS ErrorCount,
+    countIf(IsRecoverable = 1) AS RecoverableCount,
+    countIf(IsRecoverable = 0) AS CriticalCount,
+    toUInt64(0) AS ResolvedCount
+FROM error_records
+GROUP BY SnapshotDate, SourceTable, ErrorType, TaskName, ProcessingBatchID;
 
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_error_monitoring_daily
+TO error_monitoring_summary
+AS
+SELECT
+    toDateTime(toDate(ErrorDate)) AS SnapshotDate,
+    'day' AS Grain,
+    SourceTable,
+    ErrorType,
+    TaskName,
+    ProcessingBatchID,
+    count() AS ErrorCount,
+    countIf(IsRecoverable = 1) AS RecoverableCount,
+    countIf(IsRecoverable = 0) AS CriticalCount,
+    toUInt64(0) AS ResolvedCount
+FROM error_records
+GROUP BY SnapshotDate, SourceTable, ErrorType, TaskName, ProcessingBatchID;
@@ -15,6 +15,33 @@ ADD PROJECTION IF NOT EXISTS proj_purchases_by_vendor
     GROUP BY PurchaseDateKey, VendorKey
 );
 
+-- Row hash of the SCD2 tracked columns (see transformation.compute_row_hash).
+-- Existing rows keep 0 until the next dimension load backfills them.
+ALTER TABLE DimCustomer ADD COLUMN IF NOT EXISTS RowHash UInt64 DEFAULT 0 AFTER IsCurrent;
+ALTER TABLE DimProduct ADD COLUMN IF NOT EXISTS RowHash UInt64 DEFAULT 0 AFTER IsCurrent;
+ALTER TABLE DimStore ADD COLUMN IF NOT EXISTS RowHash UInt64 DEFAULT 0 AFTER IsCurrent;
+ALTER TABLE DimEmployee ADD COLUMN IF NOT EXISTS RowHash UInt64 DEFAULT 0 AFTER IsCurrent;
+
+-- Insertion time of each dimension version; key_cache.SurrogateKeyCache
+-- refreshes incrementally on it. Materializing stamps existing rows once.
+ALTER TABLE DimCustomer ADD COLUMN IF NOT EXISTS LoadedAt DateTime64(3) DEFAULT now64(3) AFTER RowHash;
+ALTER TABLE DimProduct ADD COLUMN IF NOT EXISTS LoadedAt DateTime64(3) DEFAULT now64(3) AFTER RowHash;
+ALTER TABLE DimStore ADD COLUMN IF NOT EXISTS LoadedAt DateTime64(3) DEFAULT now64(3) AFTER RowHash;
+ALTER TABLE DimEmployee ADD COLUMN IF NOT EXISTS LoadedAt DateTime64(3) DEFAULT now64(3) AFTER RowHash;
+ALTER TABLE DimVendor ADD COLUMN IF NOT EXISTS LoadedAt DateTime64(3) DEFAULT now64(3) AFTER IsCurrent;
+ALTER TABLE DimWarehouse ADD COLUMN IF NOT EXISTS LoadedAt DateTime64(3) DEFAULT now64(3) AFTER IsCurrent;
+ALTER TABLE DimCustomer MATERIALIZE COLUMN LoadedAt;
+ALTER TABLE DimProduct MATERIALIZE COLUMN LoadedAt;
+ALTER TABLE DimStore MATERIALIZE COLUMN LoadedAt;
+ALTER TABLE DimEmployee MATERIALIZE COLUMN LoadedAt;
+ALTER TABLE DimVendor MATERIALIZE COLUMN LoadedAt;
+ALTER TABLE DimWarehouse MATERIALIZE COLUMN LoadedAt;
+
+-- agg_daily_sales is maintained by partition replacement (aggregation.py); the
+-- materialized view would add every fact insert a second time.
+DROP VIEW IF EXISTS mv_agg_daily_sales;
+CREATE TABLE IF NOT EXISTS agg_daily_sales_staging AS agg_daily_sales;
+
 -- TTL rules for error records (archive after 90 days)
 ALTER TABLE error_records
 MODIFY TTL ErrorDate + INTERVAL 90 DAY
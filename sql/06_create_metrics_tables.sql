@@ -0,0 +1,40 @@
+-- ETL Run Metrics
+
+-- One row per timed stage (extract, validate, scd_diff, key_lookup,
+-- fact_insert, aggregate_refresh) and table, written in batches by
+-- airflow/metrics.py at the end of each task.
+CREATE TABLE IF NOT EXISTS etl_run_metrics
+(
+    RunID String,
+    TaskName String,
+    Stage String,
+    TableName String,
+    StartedAt DateTime64(3),
+    WallSeconds Float64,
+    CpuSeconds Float64,
+    RowsIn UInt64,
+    RowsOut UInt64,
+    BytesMoved UInt64,
+    PeakRssBytes UInt64,
+    Hostname String
+)
+ENGINE = MergeTree()
+ORDER BY (Stage, TableName, StartedAt)
+PARTITION BY toYYYYMM(StartedAt)
+TTL toDateTime(StartedAt) + INTERVAL 180 DAY;
+
+-- Per-run breakdown of the nightly window.
+CREATE VIEW IF NOT EXISTS etl_run_stage_summary AS
+SELECT
+    RunID,
+    Stage,
+    TableName,
+    min(StartedAt) AS StartedAt,
+    sum(WallSeconds) AS WallSeconds,
+    sum(CpuSeconds) AS CpuSeconds,
+    sum(RowsIn) AS RowsIn,
+    sum(RowsOut) AS RowsOut,
+    sum(BytesMoved) AS BytesMoved,
+    max(PeakRssBytes) AS PeakRssBytes
+FROM etl_run_metrics
+GROUP BY RunID, Stage, TableName;
@@ -0,0 +1,21 @@
+-- Insert Deduplication
+
+-- airflow/bulk_insert.py tags every block it writes to these tables with an
+-- insert_deduplication_token built from the processing batch id, the block's
+-- partition and index, and a digest of its rows. Plain MergeTree tables
+-- only check tokens when they keep a deduplication window, so that a task
+-- retry after a partial insert skips the blocks that already landed.
+-- The window must cover every block of one load.
+-- Replicated tables deduplicate by default (replicated_deduplication_window).
+-- Partition-swap staging tables are left out on purpose: they are refilled
+-- after DROP PARTITION and are written with insert_deduplicate = 0.
+
+ALTER TABLE FactSales MODIFY SETTING non_replicated_deduplication_window = 1000;
+ALTER TABLE FactPurchases MODIFY SETTING non_replicated_deduplication_window = 1000;
+ALTER TABLE FactInventory MODIFY SETTING non_replicated_deduplication_window = 1000;
+ALTER TABLE FactReturns MODIFY SETTING non_replicated_deduplication_window = 1000;
+
+ALTER TABLE DimCustomer MODIFY SETTING non_replicated_deduplication_window = 1000;
+ALTER TABLE DimProduct MODIFY SETTING non_replicated_deduplication_window = 1000;
+ALTER TABLE DimStore MODIFY SETTING non_replicated_deduplication_window = 1000;
+ALTER TABLE DimEmployee MODIFY SETTING non_replicated_deduplication_window = 1000;
@@ -0,0 +1,27 @@
+-- Error ID Widening
+
+-- error_handling.ErrorIdGenerator issues UInt128 ids (milliseconds, sequence
+-- and a 64-bit random node per process), which sql/04 creates for new
+-- deployments. Run this once on deployments whose ErrorID columns are UInt64;
+-- existing ids keep their values.
+
+ALTER TABLE error_records MODIFY COLUMN ErrorID UInt128;
+
+-- ErrorID is the sorting key of error_record_status, which cannot change type
+-- in place: copy the rows into a widened table and swap the two.
+CREATE TABLE error_record_status_u128
+(
+    ErrorID UInt128,
+    Status String,
+    RetryCount UInt8,
+    IsResolved UInt8,
+    ResolutionComment Nullable(String),
+    LastAttemptDate DateTime,
+    Version UInt64
+)
+ENGINE = ReplacingMergeTree(Version)
+ORDER BY ErrorID;
+
+INSERT INTO error_record_status_u128 SELECT * FROM error_record_status;
+EXCHANGE TABLES error_record_status AND error_record_status_u128;
+DROP TABLE error_record_status_u128;